@@ -0,0 +1,92 @@
+"""
+Audio Format Conversions
+
+Small conversions between the containers TTS providers send back and the ones Fably asks for:
+raw PCM is wrapped in a WAV header and unwrapped again with the wave module, without decoding
+anything, and other formats are transcoded with soundfile as a last resort.
+"""
+
+import io
+import logging
+import struct
+import wave
+from typing import Optional
+
+from fably.audio_stitching import sniff_format
+
+# OpenAI-compatible servers send raw PCM as 16 bit mono at 24 kHz.
+PCM_SAMPLE_RATE = 24000
+PCM_SAMPLE_WIDTH = 2
+PCM_CHANNELS = 1
+
+WAV_HEADER_SIZE = 44
+STREAM_SIZE = b"\xff\xff\xff\xff"
+
+
+def pcm_to_wav(data: bytes, sample_rate: int = PCM_SAMPLE_RATE, channels: int = PCM_CHANNELS,
+               sample_width: int = PCM_SAMPLE_WIDTH) -> bytes:
+    """Wrap raw little-endian PCM samples in a WAV header."""
+    output = io.BytesIO()
+    with wave.open(output, "wb") as writer:
+        writer.setnchannels(channels)
+        writer.setsampwidth(sample_width)
+        writer.setframerate(sample_rate)
+        writer.writeframes(data)
+    return output.getvalue()
+
+
+def wav_stream_header(sample_rate: int = PCM_SAMPLE_RATE, channels: int = PCM_CHANNELS,
+                      sample_width: int = PCM_SAMPLE_WIDTH) -> bytes:
+    """
+    Header of a WAV stream whose length isn't known yet: like streaming servers do, the sizes
+    are set to their maximum, which decoders read as "until the end of the data".
+    """
+    header = pcm_to_wav(b"", sample_rate, channels, sample_width)
+    return header[:4] + STREAM_SIZE + header[8:40] + STREAM_SIZE
+
+
+def seal_wav_header(header: bytes, total_size: int) -> Optional[bytes]:
+    """
+    The header made by wav_stream_header() with the actual sizes of a complete stream of
+    total_size bytes, or None if the header isn't one of a stream of unknown length.
+    """
+    if len(header) < WAV_HEADER_SIZE or header[:4] != b"RIFF" or header[36:44] != b"data" + STREAM_SIZE:
+        return None
+    return (
+        header[:4] + struct.pack("<I", total_size - 8)
+        + header[8:40] + struct.pack("<I", total_size - WAV_HEADER_SIZE)
+    )
+
+
+def wav_to_pcm(data: bytes) -> bytes:
+    """The raw PCM samples of a WAV file."""
+    with wave.open(io.BytesIO(data), "rb") as reader:
+        return reader.readframes(reader.getnframes())
+
+
+def transcode(data: bytes, audio_format: str) -> bytes:
+    """
+    Convert encoded audio to the given format ("pcm" for raw samples).
+    Audio already in that format is returned as is.
+    """
+    detected = sniff_format(data)
+    if audio_format == "pcm":
+        if detected is None:
+            return data
+        if detected != "wav":
+            data = transcode(data, "wav")
+        return wav_to_pcm(data)
+    if detected is None:
+        # Without a container it can only be raw PCM.
+        data = pcm_to_wav(data)
+        detected = "wav"
+    if detected == audio_format:
+        return data
+
+    import soundfile as sf
+
+    logging.debug("Transcoding %s audio to %s", detected, audio_format)
+    samples, sample_rate = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    output = io.BytesIO()
+    sf.write(output, samples, sample_rate, format=audio_format.upper())
+    return output.getvalue()
@@ -0,0 +1,376 @@
+"""
+Audio Output Engine
+
+This module keeps a single PCM output stream open for as long as the speaker runs and feeds
+it decoded buffers from a queue, so consecutive paragraphs play back-to-back without forking
+a player process and re-opening the ALSA device for every one of them.
+
+When PortAudio is not usable (common on some Pi images) it falls back to the player processes
+used by utils.play_audio_file(), behind the same interface.
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import soundfile as sf
+
+from fably import utils
+
+
+def decode_audio_file(audio_file: Path):
+    """
+    Decode an audio file into a float32 array of shape (frames, channels).
+
+    Returns:
+        Tuple of (samples, sample_rate)
+    """
+    try:
+        return sf.read(str(audio_file), dtype="float32", always_2d=True)
+    except Exception as e:
+        # Older libsndfile builds cannot read mp3, pydub goes through ffmpeg instead.
+        logging.debug("soundfile could not decode %s (%s), trying pydub", audio_file, e)
+        from pydub import AudioSegment
+
+        segment = AudioSegment.from_file(str(audio_file))
+        samples = np.array(segment.get_array_of_samples(), dtype=np.float32)
+        samples = samples.reshape((-1, segment.channels)) / float(1 << (8 * segment.sample_width - 1))
+        return samples, segment.frame_rate
+
+
+def convert_buffer(samples, sample_rate: int, target_rate: int, target_channels: int):
+    """Convert decoded samples to the sample rate and channel count of the output stream."""
+    if samples.shape[1] != target_channels:
+        if target_channels == 1:
+            samples = samples.mean(axis=1, keepdims=True)
+        else:
+            samples = np.repeat(samples[:, :1], target_channels, axis=1)
+
+    if sample_rate != target_rate and len(samples):
+        # Linear interpolation is plenty for speech and cheap enough for a Pi Zero.
+        frames = int(round(len(samples) * target_rate / sample_rate))
+        positions = np.linspace(0, len(samples) - 1, frames)
+        samples = np.stack(
+            [np.interp(positions, np.arange(len(samples)), samples[:, channel]) for channel in range(samples.shape[1])],
+            axis=1,
+        )
+
+    return np.ascontiguousarray(samples, dtype=np.float32)
+
+
+class PlaybackHandle:
+    """Tracks the playback of one queued buffer."""
+
+    def __init__(self, label):
+        self.label = label
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+
+    def mark_started(self):
+        if not self.started.is_set():
+            self.started_at = time.perf_counter()
+            self.started.set()
+
+    def mark_finished(self, cancelled=False):
+        if not self.finished.is_set():
+            self.cancelled = cancelled
+            self.finished_at = time.perf_counter()
+            self.started.set()
+            self.finished.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the buffer has been played (or dropped), returns False on timeout."""
+        return self.finished.wait(timeout)
+
+
+class AudioOutputEngine:
+    """
+    Long-lived playback engine built on a single sounddevice output stream.
+
+    Buffers are decoded in the calling thread, converted to the stream format and appended to
+    a queue that the PortAudio callback drains, so there is no gap between consecutive buffers
+    as long as the next one is enqueued before the current one ends.
+
+    Args:
+        device: sounddevice output device (None for the system default)
+        blocksize: Frames per callback, larger values are more robust on slow boards
+        latency: sounddevice latency setting
+    """
+
+    def __init__(self, device=None, blocksize: int = 2048, latency="high"):
+        self.device = device
+        self.blocksize = blocksize
+        self.latency = latency
+        self.sample_rate = None
+        self.channels = None
+        self._stream = None
+        self._lock = threading.Lock()
+        self._buffers = collections.deque()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._played_any = False
+        self._draining = False
+        self._starving = False
+        # Bumped by clear(), buffers decoded for an earlier generation are dropped.
+        self._generation = 0
+        self._stats = {
+            "buffers_played": 0,
+            "frames_played": 0,
+            "underruns": 0,
+            "gaps": 0,
+        }
+
+    def _open(self, sample_rate: int, channels: int):
+        logging.debug("Opening output stream at %i Hz with %i channel(s)", sample_rate, channels)
+        self._stream = utils.sd.OutputStream(
+            samplerate=sample_rate,
+            channels=channels,
+            dtype="float32",
+            blocksize=self.blocksize,
+            latency=self.latency,
+            device=self.device,
+            callback=self._callback,
+        )
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._stream.start()
+
+    def _callback(self, outdata, frames, _time, status):
+        if status.output_underflow:
+            self._stats["underruns"] += 1
+
+        written = 0
+        with self._lock:
+            while written < frames and self._buffers:
+                entry = self._buffers[0]
+                handle, samples, position = entry
+                if position == 0:
+                    handle.mark_started()
+                count = min(frames - written, len(samples) - position)
+                outdata[written:written + count] = samples[position:position + count]
+                written += count
+                entry[2] = position + count
+                if entry[2] >= len(samples):
+                    self._buffers.popleft()
+                    handle.mark_finished()
+                    self._stats["buffers_played"] += 1
+                    self._played_any = True
+
+            if written < frames:
+                outdata[written:] = 0
+                if not self._buffers:
+                    # Running dry while the speaker still has paragraphs to play is an audible gap.
+                    if self._played_any and not self._draining and not self._starving:
+                        self._stats["gaps"] += 1
+                    self._starving = True
+                    self._idle.set()
+
+        self._stats["frames_played"] += written
+
+    def enqueue(self, audio_file: Path) -> PlaybackHandle:
+        """Decode an audio file and queue it for playback right after what is already queued."""
+        generation = self._generation
+        samples, sample_rate = decode_audio_file(audio_file)
+        return self.enqueue_buffer(samples, sample_rate, label=str(audio_file), generation=generation)
+
+    def enqueue_buffer(self, samples, sample_rate: int, label=None, generation: Optional[int] = None) -> PlaybackHandle:
+        """
+        Queue already decoded float32 samples of shape (frames, channels) for playback.
+        The buffer is dropped if the output was cleared since the given generation (by default, since this call).
+        """
+        if generation is None:
+            generation = self._generation
+        if self._stream is None:
+            self._open(sample_rate, samples.shape[1])
+        samples = convert_buffer(samples, sample_rate, self.sample_rate, self.channels)
+
+        handle = PlaybackHandle(label)
+        if not len(samples):
+            handle.mark_finished()
+            return handle
+
+        with self._lock:
+            if generation != self._generation:
+                # Decoded while the output was interrupted, it belongs to the audio that was dropped.
+                handle.mark_finished(cancelled=True)
+                return handle
+            self._buffers.append([handle, samples, 0])
+            self._starving = False
+            self._idle.clear()
+        return handle
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything queued has been played."""
+        self._draining = True
+        try:
+            return self._idle.wait(timeout)
+        finally:
+            with self._lock:
+                self._draining = False
+                if not self._buffers:
+                    self._played_any = False
+
+    def clear(self):
+        """Drop everything that is queued, including the buffer currently playing."""
+        with self._lock:
+            self._generation += 1
+            while self._buffers:
+                handle, _, _ = self._buffers.popleft()
+                handle.mark_finished(cancelled=True)
+            self._played_any = False
+            self._idle.set()
+
+    def interrupt(self):
+        """
+        Silence the output right away: drop everything queued and discard the audio already
+        handed to the device, then restart the stream so it can be reused.
+        """
+        self.clear()
+        if self._stream is not None:
+            self._stream.abort()
+            self._stream.start()
+
+    def close(self):
+        """Stop and close the output stream."""
+        self.clear()
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+        logging.debug("Audio output stats: %s", self.stats())
+
+    def stats(self) -> Dict[str, int]:
+        """Get playback counters, including PortAudio underruns and gaps between buffers."""
+        return dict(self._stats)
+
+
+class SubprocessOutput:
+    """
+    Fallback output with the same interface as AudioOutputEngine that plays each file
+    with utils.play_audio_file() from a single worker thread.
+    """
+
+    def __init__(self, sound_driver: str = "alsa"):
+        self.sound_driver = sound_driver
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._generation = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stats = {
+            "buffers_played": 0,
+            "frames_played": 0,
+            "underruns": 0,
+            "gaps": 0,
+        }
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            handle, audio_file = item
+            handle.mark_started()
+            try:
+                utils.play_audio_file(audio_file, self.sound_driver)
+                self._stats["buffers_played"] += 1
+            except Exception as e:
+                logging.error("Playback of %s failed: %s", audio_file, e)
+            handle.mark_finished()
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.set()
+
+    def enqueue(self, audio_file: Path) -> PlaybackHandle:
+        generation = self._generation
+        handle = PlaybackHandle(str(audio_file))
+        with self._lock:
+            if generation != self._generation:
+                handle.mark_finished(cancelled=True)
+                return handle
+            self._pending += 1
+            self._idle.clear()
+            self._queue.put((handle, Path(audio_file)))
+        return handle
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        return self._idle.wait(timeout)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].mark_finished(cancelled=True)
+                self._done()
+
+    def interrupt(self):
+        self.clear()
+        utils.stop_playback()
+
+    def close(self):
+        self.clear()
+        self._queue.put(None)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._stats)
+
+
+def output_device(sound_driver: str = "alsa"):
+    """
+    PortAudio output device for a sound driver: the default device of PortAudio's ALSA host API
+    for "alsa", the system default (None) for "sounddevice". Raises if the driver has no output device.
+    """
+    if sound_driver == "alsa":
+        for hostapi in utils.sd.query_hostapis():
+            if hostapi["name"] == "ALSA" and hostapi["default_output_device"] >= 0:
+                return hostapi["default_output_device"]
+        raise RuntimeError("PortAudio has no ALSA output device")
+    utils.sd.query_devices(kind="output")
+    return None
+
+
+def preferred_sample_rate(sound_driver: str = "alsa", persistent: bool = True) -> Optional[int]:
+    """
+    Native sample rate of the output device that open_output() would use, so TTS can be
+    requested at that rate and played without resampling. None when it can't be told.
+    """
+    if persistent and utils.SOUNDDEVICE_AVAILABLE:
+        try:
+            device = output_device(sound_driver)
+            return int(utils.sd.query_devices(device, kind="output")["default_samplerate"])
+        except Exception as e:
+            logging.debug("Could not query the output sample rate: %s", e)
+    return None
+
+
+def open_output(sound_driver: str = "alsa", persistent: bool = True):
+    """
+    Open the best available audio output for a sound driver: the persistent stream engine when
+    PortAudio has a usable output device for it, the per-file player processes otherwise.
+    """
+    if persistent and utils.SOUNDDEVICE_AVAILABLE:
+        try:
+            return AudioOutputEngine(device=output_device(sound_driver))
+        except Exception as e:
+            logging.info("No usable PortAudio output device (%s), falling back to %s players", e, sound_driver)
+    return SubprocessOutput(sound_driver)
@@ -0,0 +1,136 @@
+"""
+Audio Stitching
+
+Joins the audio of consecutive text chunks into a single file, so a paragraph that had to be
+split to fit a TTS model's character limit still plays as one piece:
+
+- MP3 frames are concatenated as they are. ID3 tags are dropped, except the leading tag of the
+  first chunk, and so are Xing/Info header frames: in the middle of a file they decode as a
+  short click or gap, and at the start they would announce the length of the first chunk only.
+  The encoder delay and padding of every chunk stay in, a short gap at each boundary, which is
+  why TTSService asks providers that can for WAV chunks and encodes the stitched audio once.
+- WAV files are joined by concatenating their PCM data under a single header.
+- Other formats are decoded and re-encoded with soundfile.
+"""
+
+import io
+import logging
+import wave
+from typing import List, Optional
+
+# Bitrates in kbps by [MPEG-1][bitrate index] for Layer III, MPEG-2/2.5 use the second row.
+MP3_BITRATES = [
+    [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+]
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """Guess the container of encoded audio from its first bytes."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    if data[:3] == b"ID3" or (len(data) > 1 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if data[:4] == b"fLaC":
+        return "flac"
+    if data[:4] == b"OggS":
+        return "ogg"
+    return None
+
+
+def _skip_id3v2(data: bytes) -> int:
+    """Offset of the first byte after a leading ID3v2 tag."""
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _mp3_frame_length(header: bytes) -> Optional[int]:
+    """Length in bytes of the MP3 frame starting with this 4 byte header, None if it isn't one."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03  # 3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5
+    layer = (header[1] >> 1) & 0x03  # 1: Layer III
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[0 if version == 3 else 1][bitrate_index] * 1000
+    if not bitrate:
+        return None
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+
+def mp3_frames(data: bytes) -> bytes:
+    """The MP3 frames of a file, without ID3 tags and without a leading Xing/Info frame."""
+    start = _skip_id3v2(data)
+    end = len(data) - 128 if data[-128:-125] == b"TAG" else len(data)
+    frame_length = _mp3_frame_length(data[start:start + 4])
+    if frame_length and any(tag in data[start:start + min(frame_length, 64)] for tag in (b"Xing", b"Info")):
+        start += frame_length
+    return data[start:end]
+
+
+def stitch_mp3(chunks: List[bytes]) -> bytes:
+    tag = chunks[0][:_skip_id3v2(chunks[0])]
+    return tag + b"".join(mp3_frames(chunk) for chunk in chunks)
+
+
+def stitch_wav(chunks: List[bytes]) -> bytes:
+    params = None
+    frames = []
+    for chunk in chunks:
+        with wave.open(io.BytesIO(chunk), "rb") as reader:
+            chunk_params = (reader.getnchannels(), reader.getsampwidth(), reader.getframerate())
+            if params is None:
+                params = chunk_params
+            elif chunk_params != params:
+                raise ValueError(f"Cannot stitch WAV chunks with different formats: {params} and {chunk_params}")
+            frames.append(reader.readframes(reader.getnframes()))
+
+    output = io.BytesIO()
+    with wave.open(output, "wb") as writer:
+        writer.setnchannels(params[0])
+        writer.setsampwidth(params[1])
+        writer.setframerate(params[2])
+        writer.writeframes(b"".join(frames))
+    return output.getvalue()
+
+
+def stitch_with_soundfile(chunks: List[bytes], audio_format: str) -> bytes:
+    import numpy as np
+    import soundfile as sf
+
+    decoded = [sf.read(io.BytesIO(chunk), dtype="float32", always_2d=True) for chunk in chunks]
+    sample_rate = decoded[0][1]
+    if any(rate != sample_rate for _, rate in decoded):
+        raise ValueError("Cannot stitch audio chunks with different sample rates")
+    output = io.BytesIO()
+    sf.write(output, np.concatenate([samples for samples, _ in decoded]), sample_rate, format=audio_format.upper())
+    return output.getvalue()
+
+
+def stitch_audio(chunks: List[bytes], audio_format: Optional[str] = None) -> bytes:
+    """
+    Join encoded audio chunks into one file of the same format.
+
+    Args:
+        chunks: Encoded audio, in playback order
+        audio_format: Expected format, only used when it can't be told from the data
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    if audio_format == "pcm":
+        return b"".join(chunks)
+    detected = sniff_format(chunks[0]) or audio_format
+    if detected == "mp3":
+        return stitch_mp3(chunks)
+    if detected == "wav":
+        return stitch_wav(chunks)
+    logging.debug("Stitching %i %s chunks with soundfile", len(chunks), detected)
+    return stitch_with_soundfile(chunks, detected)
@@ -0,0 +1,372 @@
+"""
+Pipeline Benchmark
+
+This module runs the real story pipeline (run_story_loop) fully offline, with an in-process
+fake LLM client that streams tokens at a given rate, a fake TTS provider with a given latency
+and output size, and a null audio sink that "plays" audio by waiting for its duration and
+records when each paragraph started and finished.
+
+It reports time-to-first-audio, the gaps between paragraphs and the total wall time, and
+compares them with stored baselines so that latency regressions show up before they reach
+a Pi:
+
+    fably --bench pipeline --paragraphs 5 --save-baseline
+    fably --bench pipeline --paragraphs 5
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import click
+
+from fably import fably
+from fably import tracing
+from fably import utils
+from fably.audio_output import PlaybackHandle
+from fably.cli_utils import Context
+from fably.runtime import runtime
+from fably.tts_service import TTSProvider, TTSService
+
+BASELINES_FILE = "bench_baselines.json"
+METRICS = ["time_to_first_audio", "max_gap", "total"]
+
+WORDS = "bir zamanlar uzak bir ormanda küçük ve meraklı bir tavşan yaşarmış her sabah".split()
+
+
+def fake_story(paragraphs: int, sentences_per_paragraph: int, words_per_sentence: int) -> List[str]:
+    """Deterministic story text, split into the tokens the fake LLM streams."""
+    tokens = []
+    position = 0
+    for paragraph in range(paragraphs):
+        for _ in range(sentences_per_paragraph):
+            for word in range(words_per_sentence):
+                text = WORDS[position % len(WORDS)]
+                position += 1
+                if word == 0:
+                    text = text.capitalize()
+                if word == words_per_sentence - 1:
+                    text += "."
+                tokens.append(text + " ")
+        if paragraph < paragraphs - 1:
+            tokens.append("\n\n")
+    return tokens
+
+
+class FakeStream:
+    """Async iterator of chat completion chunks, shaped like the OpenAI client's stream."""
+
+    def __init__(self, tokens: List[str], tokens_per_second: float, first_token_latency: float):
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.closed = False
+
+    @staticmethod
+    def _chunk(content):
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.first_token_latency)
+        for token in self.tokens:
+            if self.closed:
+                return
+            yield self._chunk(token)
+            if self.tokens_per_second:
+                await asyncio.sleep(1.0 / self.tokens_per_second)
+        yield self._chunk(None)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeLLMClient:
+    """Stands in for ctx.llm_client: chat.completions.create() returns a FakeStream."""
+
+    def __init__(self, tokens: List[str], tokens_per_second: float = 30.0, first_token_latency: float = 0.5):
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **params):
+        self.requests.append(params)
+        if not params.get("stream"):
+            # Non-streaming requests, such as story summaries, get a short answer right away.
+            await asyncio.sleep(self.first_token_latency)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="".join(self.tokens[:20])))])
+        return FakeStream(self.tokens, self.tokens_per_second, self.first_token_latency)
+
+
+class FakeTTSProvider(TTSProvider):
+    """TTS provider that waits for a fixed latency plus a per-character time and returns silence."""
+
+    def __init__(self, latency: float = 0.4, seconds_per_char: float = 0.0, bytes_per_char: int = 1000):
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+        self.bytes_per_char = bytes_per_char
+        self.calls = 0
+
+    async def synthesize(self, text: str, voice: str, **kwargs) -> bytes:
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.seconds_per_char * len(text))
+        return bytes(len(text) * self.bytes_per_char)
+
+    async def get_available_voices(self) -> List[Dict[str, str]]:
+        return [{"id": "bench", "name": "Bench", "provider": "fake"}]
+
+    def get_supported_formats(self) -> List[str]:
+        return ["mp3", "wav"]
+
+
+class NullAudioSink:
+    """
+    Audio output with the interface of audio_output.AudioOutputEngine that plays nothing.
+    Each file "plays" for its size divided by bytes_per_second, one after the other, and the
+    start and end of every paragraph are recorded.
+    """
+
+    def __init__(self, bytes_per_second: int = 16000):
+        self.bytes_per_second = bytes_per_second
+        self.timeline: List[Dict[str, Any]] = []
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            handle, audio_file, enqueued_at = item
+            duration = audio_file.stat().st_size / self.bytes_per_second
+            handle.mark_started()
+            self._stop.wait(duration)
+            handle.mark_finished(cancelled=self._stop.is_set())
+            self.timeline.append({
+                "file": audio_file.name,
+                "enqueued": enqueued_at,
+                "started": handle.started_at,
+                "finished": handle.finished_at,
+            })
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.set()
+
+    def enqueue(self, audio_file: Path) -> PlaybackHandle:
+        handle = PlaybackHandle(str(audio_file))
+        with self._lock:
+            self._pending += 1
+            self._idle.clear()
+        self._queue.put((handle, Path(audio_file), time.perf_counter()))
+        return handle
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        return self._idle.wait(timeout)
+
+    def clear(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].mark_finished(cancelled=True)
+                self._done()
+
+    def interrupt(self):
+        self.clear()
+        self._stop.set()
+
+    def close(self):
+        self.clear()
+        self._queue.put(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"buffers_played": len(self.timeline), "frames_played": 0, "underruns": 0, "gaps": 0}
+
+
+def make_context(story_dir: Path, llm_client, tts_provider, sink, lookahead: int, granularity: str) -> Context:
+    """Build the context run_story_loop() needs, wired to the fakes."""
+    ctx = Context()
+    ctx.stories_path = story_dir
+    ctx.prompt_file = story_dir / "prompt.txt"
+    utils.write_to_file(ctx.prompt_file, "Tell a short story.")
+    ctx.llm_client = llm_client
+    ctx.llm_model = "fake"
+    ctx.max_tokens = 2000
+    ctx.temperature = 1.0
+    ctx.tts_service = TTSService()
+    ctx.tts_service.add_provider("fake", tts_provider)
+    ctx.tts_provider = "fake"
+    ctx.tts_voice = "bench"
+    ctx.tts_model = "fake"
+    ctx.tts_format = "mp3"
+    ctx.tts_lookahead = lookahead
+    ctx.segment_granularity = granularity
+    ctx.continuation_patterns = []
+    ctx.ignore_cache = True
+    ctx.audio_output = sink
+    return ctx
+
+
+async def run_once(options: Dict[str, Any], chrome_trace: Optional[Path] = None) -> Dict[str, Any]:
+    """Tell one fake story and measure it, exporting its trace to chrome_trace if given."""
+    tokens = fake_story(options["paragraphs"], options["sentences"], options["words"])
+    llm_client = FakeLLMClient(tokens, options["tokens_per_second"], options["first_token_latency"])
+    tts_provider = FakeTTSProvider(options["tts_latency"], options["tts_seconds_per_char"], options["tts_bytes_per_char"])
+    sink = NullAudioSink(options["sink_bytes_per_second"])
+    with tempfile.TemporaryDirectory(prefix="fably-bench-") as story_dir:
+        ctx = make_context(
+            Path(story_dir), llm_client, tts_provider, sink, options["tts_lookahead"], options["segment_granularity"]
+        )
+        started = time.perf_counter()
+        try:
+            await fably.run_story_loop(ctx, "bench story")
+        finally:
+            sink.close()
+        total = time.perf_counter() - started
+        if chrome_trace is not None:
+            # The story directory is temporary, its trace.json is converted before it goes.
+            for trace_file in Path(story_dir).glob(f"*/{tracing.TRACE_FILE}"):
+                tracing.export_chrome_trace(trace_file, chrome_trace)
+
+    timeline = sorted(sink.timeline, key=lambda entry: entry["started"])
+    gaps = [max(0.0, b["started"] - a["finished"]) for a, b in zip(timeline, timeline[1:])]
+    return {
+        "time_to_first_audio": timeline[0]["started"] - started if timeline else None,
+        "gaps": gaps,
+        "max_gap": max(gaps) if gaps else 0.0,
+        "total": total,
+        "segments": len(timeline),
+        "tts_calls": tts_provider.calls,
+    }
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Median of each metric over the runs."""
+    summary = {}
+    for metric in METRICS:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        summary[metric] = round(statistics.median(values), 4) if values else None
+    summary["segments"] = runs[-1]["segments"]
+    return summary
+
+
+def scenario_key(options: Dict[str, Any]) -> str:
+    """Baselines are stored per scenario, i.e. per combination of benchmark options."""
+    return ",".join(f"{key}={options[key]}" for key in sorted(options) if key != "runs")
+
+
+def load_baselines(baselines_file: Path) -> Dict[str, Any]:
+    try:
+        with open(baselines_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def compare(summary: Dict[str, Any], baseline: Optional[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Print the results next to the baseline and return the metrics that regressed."""
+    regressions = []
+    for metric in METRICS:
+        value = summary[metric]
+        reference = baseline.get(metric) if baseline else None
+        line = f"  {metric:<20} {value if value is None else f'{value:8.3f}s'}"
+        if value is not None and reference is not None:
+            delta = value - reference
+            line += f"   baseline {reference:8.3f}s   {delta:+.3f}s"
+            # Small absolute slack so that near-zero metrics (gaps) don't flap.
+            if value > reference * (1 + tolerance) + 0.05:
+                line += "   REGRESSION"
+                regressions.append(metric)
+        click.echo(line)
+    return regressions
+
+
+@click.group()
+def bench():
+    """Offline benchmarks."""
+
+
+@bench.command()
+@click.option("--paragraphs", type=click.IntRange(min=1), default=5, help="Paragraphs in the fake story.")
+@click.option("--sentences", type=click.IntRange(min=1), default=3, help="Sentences per paragraph.")
+@click.option("--words", type=click.IntRange(min=1), default=12, help="Words per sentence.")
+@click.option("--tokens-per-second", type=float, default=30.0, help="Rate at which the fake LLM streams tokens.")
+@click.option("--first-token-latency", type=float, default=0.5, help="Seconds before the fake LLM's first token.")
+@click.option("--tts-latency", type=float, default=0.4, help="Fixed latency of each fake TTS request in seconds.")
+@click.option("--tts-seconds-per-char", type=float, default=0.002, help="Extra fake TTS latency per character.")
+@click.option("--tts-bytes-per-char", type=int, default=1000, help="Bytes of audio the fake TTS returns per character.")
+@click.option(
+    "--sink-bytes-per-second", type=int, default=160000,
+    help="Playback rate of the null audio sink. 16000 is real time for 128 kbps mp3, the default plays 10x faster.",
+)
+@click.option("--tts-lookahead", type=click.IntRange(min=1), default=3, help="Paragraphs synthesized ahead of playback.")
+@click.option(
+    "--segment-granularity", type=click.Choice(["sentence", "clause", "paragraph"]), default="sentence",
+    help="Where streamed text is cut before TTS.",
+)
+@click.option("--runs", type=click.IntRange(min=1), default=3, help="Number of runs, the median is reported.")
+@click.option("--baselines", "baselines_file", type=click.Path(dir_okay=False), default=None,
+              help=f"Baselines file. Defaults to {BASELINES_FILE} in the fably directory.")
+@click.option("--save-baseline", is_flag=True, default=False, help="Store the results as the baseline for this scenario.")
+@click.option("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before a metric is a regression.")
+@click.option("--chrome-trace", type=click.Path(dir_okay=False), default=None,
+              help="Write the pipeline trace of the last run to this file in Chrome trace format.")
+@click.option("--debug", is_flag=True, default=False, help="Enable debug logging.")
+def pipeline(runs, baselines_file, save_baseline, tolerance, chrome_trace, debug, **options):
+    """
+    Runs run_story_loop() end to end with a fake LLM, a fake TTS provider and a null audio sink,
+    and reports time-to-first-audio, inter-paragraph gaps and total wall time against baselines.
+    Exits with status 1 when a metric regressed.
+    """
+    logging.basicConfig(level=logging.DEBUG if debug else logging.WARNING)
+    baselines_file = Path(baselines_file) if baselines_file else utils.resolve(BASELINES_FILE)
+    try:
+        results = []
+        for run in range(runs):
+            result = runtime.run(run_once(options, Path(chrome_trace) if chrome_trace else None))
+            results.append(result)
+            click.echo(
+                f"Run {run + 1}/{runs}: first audio {result['time_to_first_audio']:.3f}s, "
+                f"max gap {result['max_gap']:.3f}s, total {result['total']:.3f}s, "
+                f"{result['segments']} segments"
+            )
+    finally:
+        runtime.shutdown()
+    if chrome_trace:
+        click.echo(f"Chrome trace written to {chrome_trace}")
+
+    summary = summarize(results)
+    baselines = load_baselines(baselines_file)
+    key = scenario_key(options)
+    click.echo("\nMedian over %i run(s):" % runs)
+    regressions = compare(summary, baselines.get(key), tolerance)
+
+    if save_baseline:
+        baselines[key] = summary
+        utils.write_atomically(baselines_file, json.dumps(baselines, indent=2, sort_keys=True))
+        click.echo(f"\nBaseline saved to {baselines_file}")
+    elif key not in baselines:
+        click.echo("\nNo baseline for this scenario yet, run again with --save-baseline to store one.")
+    elif regressions:
+        raise click.exceptions.Exit(1)
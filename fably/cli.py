@@ -11,13 +11,17 @@ import click
 
 from dotenv import load_dotenv
 
+from fably import audio_output
 from fably import fably
 from fably import utils
 from fably import leds
+from fably.runtime import runtime
 from fably.tts_service import initialize_tts_service, tts_service
+from fably.tts_health import HEALTH_FILE
+from fably.voice_catalog import CATALOG_FILE
 from fably.voice_manager import voice_manager
 
-from fably.cli_utils import pass_context
+from fably.cli_utils import StoryCommand, pass_context
 
 import threading
 import time
@@ -26,11 +30,20 @@ GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/openai"
 DEEPSEEK_URL = "https://api.deepseek.com/v1"
 OLLAMA_URL = "http://127.0.0.1:11434/v1"
 ELEVENLABS_URL = "https://api.elevenlabs.io"
+ELEVENLABS_MAX_SAMPLE_RATE = 24000
+LOCAL_TTS_URL = ""
 
 PROMPT_FILE = "./fably/prompt.txt"
 QUERIES_PATH = "./queries"
 STORIES_PATH = "./stories"
 MODELS_PATH = "./models"
+TTS_CACHE_PATH = "./tts_cache"
+TTS_CACHE_SIZE = 200
+TTS_MAX_CONCURRENCY = 3
+TTS_RATE_LIMIT = 0
+TTS_MAX_RETRIES = 3
+TTS_STREAMING = False
+VOICE_CATALOG_TTL = 24
 SOUND_MODEL = "vosk-model-small-tr-0.3"  # Türkçe model (güncellenmiş)
 SAMPLE_RATE = 24000
 LLM_URL = GEMINI_URL
@@ -42,6 +55,14 @@ TTS_URL = GEMINI_URL
 TTS_MODEL = "tts-1"
 TTS_VOICE = "nova"
 TTS_FORMAT = "mp3"
+SEGMENT_GRANULARITY = "sentence"
+SEGMENT_MIN_CHARS = 40
+SEGMENT_MAX_CHARS = 600
+TTS_LOOKAHEAD = 3
+QUEUE_MAX_ITEMS = 8
+QUEUE_MAX_BYTES = 2 * 1024 * 1024
+CONTEXT_TOKENS = 1200
+SUMMARY_TOKENS = 300
 LANGUAGE = "tr"  # Sadece Türkçe
 BUTTON_GPIO_PIN = 17
 HOLD_TIME = 3
@@ -69,7 +90,7 @@ STARTING_COLORS = [0xFF0000, 0xFF0000, 0xFF0000]
 load_dotenv()
 
 
-@click.command()
+@click.command(cls=StoryCommand)
 @click.argument("query", required=False, default=None, nargs=1)
 @click.option(
     "--prompt-file",
@@ -168,26 +189,132 @@ load_dotenv()
 )
 @click.option(
     "--tts-format",
-    default=TTS_FORMAT,
-    help=f'The TTS format to use when generating stories. Defaults to "%s".' % TTS_FORMAT,
+    default=None,
+    help=f'The TTS format to use when generating stories, "auto" asks the provider for uncompressed audio at the output device\'s sample rate. Defaults to "%s", or "auto" with the local provider.' % TTS_FORMAT,
 )
 @click.option(
     "--tts-provider",
-    type=click.Choice(["elevenlabs"], case_sensitive=False),
+    type=click.Choice(["elevenlabs", "local"], case_sensitive=False),
     default="elevenlabs",
-    help=f'The TTS provider to use. Defaults to "elevenlabs".',
+    help=f'The TTS provider to use, "local" needs --local-tts-url. Defaults to "elevenlabs".',
+)
+@click.option(
+    "--segment-granularity",
+    type=click.Choice(["sentence", "clause", "paragraph"], case_sensitive=False),
+    default=SEGMENT_GRANULARITY,
+    help=f'Where to cut the streamed story text into pieces sent to TTS. Defaults to "%s".' % SEGMENT_GRANULARITY,
+)
+@click.option(
+    "--segment-min-chars",
+    type=int,
+    default=SEGMENT_MIN_CHARS,
+    help="Shorter pieces are merged with the following ones before being sent to TTS. Defaults to %s." % SEGMENT_MIN_CHARS,
+)
+@click.option(
+    "--segment-max-chars",
+    type=int,
+    default=SEGMENT_MAX_CHARS,
+    help="Longer pieces are split at a word boundary before being sent to TTS (0 = no limit). Defaults to %s." % SEGMENT_MAX_CHARS,
+)
+@click.option(
+    "--tts-lookahead",
+    type=click.IntRange(min=1),
+    default=TTS_LOOKAHEAD,
+    help="How many paragraphs to synthesize concurrently ahead of playback. Defaults to %s." % TTS_LOOKAHEAD,
+)
+@click.option(
+    "--queue-max-items",
+    type=click.IntRange(min=0),
+    default=QUEUE_MAX_ITEMS,
+    help="Maximum number of paragraphs buffered between pipeline stages (0 = no limit). Defaults to %s." % QUEUE_MAX_ITEMS,
+)
+@click.option(
+    "--queue-max-bytes",
+    type=click.IntRange(min=0),
+    default=QUEUE_MAX_BYTES,
+    help="Maximum bytes of story text buffered between pipeline stages (0 = no limit). Defaults to %s." % QUEUE_MAX_BYTES,
+)
+@click.option(
+    "--tts-cache-path",
+    default=TTS_CACHE_PATH,
+    help=f'The directory to cache synthesized audio in, shared by all stories and voice previews. Defaults to "%s".' % TTS_CACHE_PATH,
+)
+@click.option(
+    "--tts-cache-size",
+    type=click.IntRange(min=0),
+    default=TTS_CACHE_SIZE,
+    help="Size budget of the TTS audio cache in MB, least recently used audio is evicted first (0 = disabled). Defaults to %s." % TTS_CACHE_SIZE,
+)
+@click.option(
+    "--tts-max-concurrency",
+    type=click.IntRange(min=0),
+    default=TTS_MAX_CONCURRENCY,
+    help="Maximum concurrent requests per TTS provider, match it to your plan (0 = no limit). Defaults to %s." % TTS_MAX_CONCURRENCY,
+)
+@click.option(
+    "--tts-rate-limit",
+    type=click.FloatRange(min=0),
+    default=TTS_RATE_LIMIT,
+    help="Maximum requests per minute per TTS provider (0 = no limit). Defaults to %s." % TTS_RATE_LIMIT,
+)
+@click.option(
+    "--tts-max-retries",
+    type=click.IntRange(min=0),
+    default=TTS_MAX_RETRIES,
+    help="Retries of a TTS request after throttling, server or network errors. Defaults to %s." % TTS_MAX_RETRIES,
+)
+@click.option(
+    "--tts-streaming/--no-tts-streaming",
+    default=TTS_STREAMING,
+    help="Download paragraph audio from the provider's streaming endpoint straight to disk instead of buffering it in memory. Defaults to %s." % TTS_STREAMING,
+)
+@click.option(
+    "--context-tokens",
+    type=click.IntRange(min=1),
+    default=CONTEXT_TOKENS,
+    help="Token budget for the most recent paragraphs in a continuation prompt, older ones are summarized. Defaults to %s." % CONTEXT_TOKENS,
+)
+@click.option(
+    "--summary-tokens",
+    type=click.IntRange(min=50),
+    default=SUMMARY_TOKENS,
+    help="Approximate size of the rolling story summary used for continuations. Defaults to %s." % SUMMARY_TOKENS,
 )
 @click.option(
     "--elevenlabs-url",
     default=ELEVENLABS_URL,
     help=f'The URL of the ElevenLabs API endpoint. Defaults to "%s".' % ELEVENLABS_URL,
 )
+@click.option(
+    "--elevenlabs-max-sample-rate",
+    type=click.Choice(["16000", "22050", "24000", "44100"]),
+    default=str(ELEVENLABS_MAX_SAMPLE_RATE),
+    help="Highest PCM sample rate requested from ElevenLabs with --tts-format auto, 44100 needs a Pro plan. Defaults to %s." % ELEVENLABS_MAX_SAMPLE_RATE,
+)
+@click.option(
+    "--local-tts-url",
+    default=LOCAL_TTS_URL,
+    help="URL of an OpenAI-compatible TTS server on the local network (e.g. servers/tts_server at http://host:5001), "
+    "used when --tts-provider is local and as the fallback of the other provider otherwise. Defaults to none.",
+)
+@click.option(
+    "--voice-catalog-ttl",
+    type=click.FloatRange(min=0),
+    default=VOICE_CATALOG_TTL,
+    help="Hours voices are served from the voice catalog before they are revalidated in the background. Defaults to %s." % VOICE_CATALOG_TTL,
+)
 @click.option(
     "--list-voices",
     is_flag=True,
     default=False,
     help="List all available voices from configured providers and exit.",
 )
+@click.option(
+    "--tts-stats",
+    is_flag=True,
+    default=False,
+    help="Show the latency, throughput and error rate of each TTS provider over its recent requests and exit.",
+)
 @click.option(
     "--voice-cycle",
     is_flag=True,
@@ -275,6 +402,17 @@ load_dotenv()
     default=SOUND_DRIVER,
     help="Which driver to use to emit sound.",
 )
+@click.option(
+    "--persistent-audio/--no-persistent-audio",
+    default=True,
+    help="Keep one audio output stream open and decode in process instead of starting a player per paragraph.",
+)
+@click.option(
+    "--chrome-trace",
+    is_flag=True,
+    default=False,
+    help="Also save each story's pipeline trace in Chrome trace format (trace.chrome.json).",
+)
 @click.option(
     "--trim-first-frame",
     is_flag=True,
@@ -320,8 +458,26 @@ def cli(
     tts_voice,
     tts_format,
     tts_provider,
+    segment_granularity,
+    segment_min_chars,
+    segment_max_chars,
+    tts_lookahead,
+    queue_max_items,
+    queue_max_bytes,
+    tts_cache_path,
+    tts_cache_size,
+    tts_max_concurrency,
+    tts_rate_limit,
+    tts_max_retries,
+    tts_streaming,
+    context_tokens,
+    summary_tokens,
     elevenlabs_url,
+    elevenlabs_max_sample_rate,
+    local_tts_url,
+    voice_catalog_ttl,
     list_voices,
+    tts_stats,
     voice_cycle,
     voice_preview,
     query_guard,
@@ -335,6 +491,8 @@ def cli(
     debug,
     ignore_cache,
     sound_driver,
+    persistent_audio,
+    chrome_trace,
     trim_first_frame,
     noise_reduction,
     noise_sensitivity,
@@ -350,6 +508,11 @@ def cli(
     else:
         logging.basicConfig(level=logging.INFO)
 
+    if segment_max_chars and segment_min_chars > segment_max_chars:
+        raise click.BadParameter(
+            f"must not be larger than --segment-max-chars ({segment_max_chars})", param_hint="--segment-min-chars"
+        )
+
     ctx.sound_model = sound_model
     ctx.llm_url = llm_url
     ctx.llm_model = llm_model
@@ -365,9 +528,21 @@ def cli(
     ctx.sample_rate = sample_rate
     ctx.max_tokens = max_tokens
     ctx.tts_voice = tts_voice
-    ctx.tts_format = tts_format
+    # The local server makes WAV, asking it for MP3 would transcode every paragraph on the device.
+    ctx.tts_format = tts_format or ("auto" if tts_provider == "local" else TTS_FORMAT)
     ctx.tts_provider = tts_provider
+    ctx.segment_granularity = segment_granularity
+    ctx.segment_min_chars = segment_min_chars
+    ctx.segment_max_chars = segment_max_chars
+    ctx.tts_lookahead = tts_lookahead
+    ctx.queue_max_items = queue_max_items
+    ctx.queue_max_bytes = queue_max_bytes
+    ctx.context_tokens = context_tokens
+    ctx.summary_tokens = summary_tokens
     ctx.elevenlabs_url = elevenlabs_url
+    ctx.elevenlabs_max_sample_rate = int(elevenlabs_max_sample_rate)
+    ctx.local_tts_url = local_tts_url
+    ctx.voice_catalog_ttl = voice_catalog_ttl
     ctx.voice_cycle = voice_cycle
     ctx.language = LANGUAGE  # Sabit Türkçe
     ctx.query_guard = query_guard
@@ -383,6 +558,8 @@ def cli(
     ctx.loop = loop
     ctx.web_app = web_app
     ctx.sound_driver = sound_driver
+    ctx.persistent_audio = persistent_audio
+    ctx.chrome_trace = chrome_trace
     ctx.trim_first_frame = trim_first_frame
     ctx.noise_reduction = noise_reduction
     ctx.noise_sensitivity = noise_sensitivity
@@ -395,6 +572,12 @@ def cli(
     ctx.queries_path = utils.resolve(queries_path)
     ctx.stories_path = utils.resolve(stories_path)
     ctx.models_path = utils.resolve(models_path)
+    ctx.tts_cache_path = utils.resolve(tts_cache_path)
+    ctx.tts_cache_size = tts_cache_size
+    ctx.tts_max_concurrency = tts_max_concurrency
+    ctx.tts_rate_limit = tts_rate_limit
+    ctx.tts_max_retries = tts_max_retries
+    ctx.tts_streaming = tts_streaming
 
     ctx.leds = leds.LEDs(STARTING_COLORS)
 
@@ -410,11 +593,25 @@ def cli(
         if ctx.gemini_api_key:
             tts_args['gemini_key'] = ctx.gemini_api_key
         tts_args['gemini_url'] = GEMINI_URL
+        if ctx.local_tts_url:
+            tts_args['local_url'] = ctx.local_tts_url
+        tts_args['elevenlabs_max_sample_rate'] = ctx.elevenlabs_max_sample_rate
         initialize_tts_service(**tts_args)
+        tts_service.enable_cache(ctx.tts_cache_path, ctx.tts_cache_size * 1024 * 1024)
+        tts_service.enable_voice_catalog(utils.resolve(CATALOG_FILE), ctx.voice_catalog_ttl * 3600)
+        tts_service.track_health(utils.resolve(HEALTH_FILE))
+        tts_service.scheduler.configure(
+            max_concurrency=ctx.tts_max_concurrency,
+            rate_limit=ctx.tts_rate_limit,
+            max_retries=ctx.tts_max_retries,
+        )
         
         # Set the TTS service in context
         ctx.tts_service = tts_service
         
+        # Provider sessions live on the runtime loop: pre-connect now, close them on shutdown.
+        runtime.add_shutdown_hook(tts_service.close)
+        
         # Set default provider if not specified or invalid
         available_providers = tts_service.get_available_providers()
         if ctx.tts_provider not in available_providers:
@@ -424,6 +621,10 @@ def cli(
             else:
                 logging.warning("No TTS providers available")
         
+        # The local server and ElevenLabs back each other up: whichever isn't selected takes over failed requests.
+        if "local" in available_providers and "elevenlabs" in available_providers:
+            tts_service.set_fallback_provider(ctx.tts_provider, "elevenlabs" if ctx.tts_provider == "local" else "local")
+        
         # Set current voice in voice manager
         voice_manager.set_voice(ctx.tts_voice, ctx.tts_provider)
         
@@ -431,15 +632,30 @@ def cli(
         logging.warning(f"Failed to initialize enhanced TTS service: {str(e)}")
         ctx.tts_service = None
     
+    if ctx.tts_format == "auto":
+        try:
+            ctx.tts_format, ctx.tts_sample_rate = tts_service.negotiate_format(
+                ctx.tts_provider, audio_output.preferred_sample_rate(ctx.sound_driver, ctx.persistent_audio)
+            )
+            logging.info(f"Requesting {ctx.tts_format} audio at {ctx.tts_sample_rate or 'the default'} Hz from {ctx.tts_provider}")
+        except ValueError as e:
+            logging.warning(f"Could not negotiate the TTS format ({str(e)}), using {TTS_FORMAT}")
+            ctx.tts_format = TTS_FORMAT
+    
     # Handle special commands
     if list_voices:
-        import asyncio
-        asyncio.run(handle_list_voices())
+        runtime.run(handle_list_voices())
+        runtime.shutdown()
+        return
+    
+    if tts_stats:
+        handle_tts_stats()
+        runtime.shutdown()
         return
     
     if voice_preview:
-        import asyncio
-        asyncio.run(handle_voice_preview(voice_preview, ctx.tts_provider))
+        runtime.run(handle_voice_preview(voice_preview, ctx.tts_provider))
+        runtime.shutdown()
         return
     
     if web_app:
@@ -468,10 +684,18 @@ def cli(
     if ctx.sound_driver == "alsa" and platform.system() != "Linux":
         ctx.sound_driver = "sounddevice"
 
+    if ctx.tts_service is not None:
+        # Pre-connect to the TTS provider while the story is being written.
+        runtime.spawn(ctx.tts_service.warmup())
+
     try:
         fably.main(ctx, query)
+    except Exception as e:
+        logging.debug("Story failed", exc_info=True)
+        raise click.ClickException(f"Failed to tell the story: {e}") from e
     finally:
         ctx.leds.stop()
+        runtime.shutdown()
 
 
 async def handle_list_voices():
@@ -513,6 +737,35 @@ async def handle_list_voices():
         print(f"❌ Error listing voices: {str(e)}")
 
 
+def handle_tts_stats():
+    """Handle the --tts-stats command."""
+    print("\n📈 TTS Provider Statistics (recent requests):\n")
+    
+    def format_stats(stats):
+        def ms(seconds):
+            return f"{seconds * 1000:.0f} ms" if seconds is not None else "-"
+        
+        error_rate = f"{stats['error_rate'] * 100:.0f}%" if stats["error_rate"] is not None else "-"
+        throughput = f"{stats['bytes_per_second'] / 1024:.1f} KB/s" if stats["bytes_per_second"] else "-"
+        return (
+            f"{stats['requests']} requests, errors: {error_rate}, "
+            f"p50: {ms(stats['p50'])}, p95: {ms(stats['p95'])}, throughput: {throughput}"
+        )
+    
+    all_stats = tts_service.health.stats()
+    if not all_stats:
+        print("  No requests recorded yet")
+        return
+    
+    for provider_name, stats in all_stats.items():
+        status = "healthy" if stats["healthy"] else f"degraded ({stats['consecutive_failures']} failures in a row)"
+        print(f"📢 {provider_name.upper()} - {status}")
+        print(f"  {format_stats(stats)}")
+        for model, model_stats in stats["models"].items():
+            print(f"  • {model}: {format_stats(model_stats)}")
+        print()
+
+
 async def handle_voice_preview(voice_id: str, provider: str = "elevenlabs"):
     """Handle the --voice-preview command."""
     print(f"\n🎧 Generating voice preview for: {voice_id}")
@@ -560,7 +813,6 @@ def add_voice_cycling_to_button_handler(ctx):
     
     def enhanced_released():
         import time
-        import asyncio
         
         # Check if this is a double-tap after a short delay
         def check_double_tap():
@@ -571,11 +823,8 @@ def add_voice_cycling_to_button_handler(ctx):
                 logging.info("Double-tap detected - cycling voice")
                 
                 try:
-                    # Run voice cycling in new event loop
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    
-                    new_voice, new_provider = loop.run_until_complete(
+                    # Run voice cycling on the shared runtime loop, alongside any story being told
+                    new_voice, new_provider = runtime.run(
                         voice_manager.cycle_voice(1)
                     )
                     
@@ -588,7 +837,7 @@ def add_voice_cycling_to_button_handler(ctx):
                     
                     # Generate and play announcement
                     announcement_file = utils.resolve("temp_voice_announcement.mp3")
-                    loop.run_until_complete(
+                    runtime.run(
                         tts_service.synthesize(
                             text=announcement_text,
                             voice=new_voice,
@@ -603,8 +852,6 @@ def add_voice_cycling_to_button_handler(ctx):
                     if announcement_file.exists():
                         announcement_file.unlink()
                     
-                    loop.close()
-                    
                 except Exception as e:
                     logging.error(f"Voice cycling failed: {str(e)}")
                 
@@ -663,3 +910,6 @@ if __name__ == "__main__":
         gpio_story_listener(ctx)
     except KeyboardInterrupt:
         sys.exit("\nInterrupted by user")
+    finally:
+        # The GPIO listener restarted the runtime for its stories.
+        runtime.shutdown()
@@ -2,6 +2,9 @@
 Utility functions for command lines.
 """
 
+import importlib
+import sys
+
 import click
 
 from fably import utils
@@ -19,6 +22,8 @@ class Context:
         self.trim_first_frame = False
         self.sounds_path = utils.resolve("sounds")
         self.sound_driver = "alsa"
+        self.persistent_audio = True
+        self.chrome_trace = False
         self.sample_rate = 16000
         self.language = "en"
         self.stt_url = None
@@ -30,6 +35,18 @@ class Context:
         self.tts_url = None
         self.tts_model = None
         self.tts_voice = None
+        self.segment_granularity = "sentence"
+        self.segment_min_chars = 40
+        self.segment_max_chars = 600
+        self.tts_lookahead = 3
+        self.tts_streaming = False
+        self.tts_format = "mp3"
+        self.tts_sample_rate = None
+        self.queue_max_items = 8
+        self.queue_max_bytes = 2 * 1024 * 1024
+        self.context_tokens = 1200
+        self.summary_tokens = 300
+        self.manifest = None
         self.running = True
 
     def persist_runtime_params(self, output_file, **kwargs):
@@ -54,3 +71,41 @@ class Context:
 
 
 pass_context = click.make_pass_decorator(Context, ensure=True)
+
+
+class StoryCommand(click.Command):
+    """
+    The top level fably command, which tells the story given as QUERY.
+
+    A few tools are reached through it with an option that must come first (e.g.
+    `fably --bench pipeline`), so that no story query is ever mistaken for one. The rest of the
+    arguments then go to the tool. Tools are imported only when used so they don't slow down the
+    start of the storyteller.
+    """
+
+    tools = {
+        "--bench": ("fably.bench", "bench", "Run an offline benchmark instead of telling a story (see `fably --bench --help`)."),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name, (_, _, help_text) in self.tools.items():
+            self.params.append(click.Option(
+                [name], is_flag=True, expose_value=False, help=f"{help_text} Must be the first argument.",
+                callback=self._misplaced_tool,
+            ))
+
+    @staticmethod
+    def _misplaced_tool(ctx, param, value):
+        # Tools are dispatched in main(), one found by the parser came after other arguments.
+        if value:
+            raise click.UsageError(f"{param.opts[0]} must be the first argument.", ctx=ctx)
+
+    def main(self, args=None, prog_name=None, **kwargs):
+        args = list(sys.argv[1:] if args is None else args)
+        if args and args[0] in self.tools:
+            module_name, attribute, _ = self.tools[args[0]]
+            command = getattr(importlib.import_module(module_name), attribute)
+            prog_name = f"{prog_name or 'fably'} {args[0]}"
+            return command.main(args[1:], prog_name=prog_name, **kwargs)
+        return super().main(args, prog_name=prog_name, **kwargs)
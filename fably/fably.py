@@ -3,12 +3,19 @@ Main Fably logic (cleaned for Gemini LLM and ElevenLabs TTS only).
 """
 
 import asyncio
+import collections
 import concurrent.futures
 import logging
 import shutil
-import time
-import threading
+from pathlib import Path
+from fably import audio_output
+from fably import story_memory
+from fably import tracing
 from fably import utils
+from fably.manifest import MANIFEST_FILE, StoryManifest, probe_duration, text_hash
+from fably.queues import PipelineQueue
+from fably.runtime import runtime
+from fably.text_segmenter import SEGMENT, TextSegmenter
 
 # --- LLM and TTS provider usage should be via ctx.llm_client and ctx.tts_service (abstraction) ---
 
@@ -31,36 +38,123 @@ def generate_story(ctx, query, prompt):
     return ctx.llm_client.chat.completions.create(**completion_params)
 
 
-async def synthesize_audio(ctx, story_path, index, text=None):
+async def close_stream(stream):
     """
-    Fetches TTS audio for a given paragraph of a story and saves it to a file.
+    Closes an LLM response stream, whether the client exposes a sync or an async close().
+    """
+    close = getattr(stream, "close", None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        logging.debug("Failed to close the story stream: %s", e)
+
+
+async def synthesize_audio(ctx, story_path, index, text=None, segment=None):
+    """
+    Fetches TTS audio for a given paragraph of a story, or for one segment of it, and saves it to a file.
     Uses the TTS service abstraction for multi-provider support.
+
+    When the story has a manifest, cached audio is found there without touching the filesystem
+    and newly synthesized audio is recorded in it.
     """
-    logging.debug("Synthesizing audio for paragraph %i...", index)
-    audio_file_path = story_path / f"paragraph_{index}.{ctx.tts_format}"
-    if audio_file_path.exists():
-        logging.debug("Paragraph %i audio already exists at %s", index, audio_file_path)
-        return audio_file_path
-    if not text:
-        text_file_path = story_path / f"paragraph_{index}.txt"
-        if text_file_path.exists():
-            logging.debug("Reading paragraph %i text from %s ...", index, text_file_path)
-            text = utils.read_from_file(text_file_path)
-        else:
-            raise ValueError(f"No text found for paragraph {index} in {story_path}")
-    # Use the TTS service abstraction
-    await ctx.tts_service.synthesize(
-        text=text,
-        voice=ctx.tts_voice,
-        provider=getattr(ctx, 'tts_provider', 'elevenlabs'),
-        output_file=audio_file_path,
-        format=ctx.tts_format,
-        model=ctx.tts_model
-    )
+    logging.debug("Synthesizing audio for paragraph %i (segment %s)...", index, segment)
+    manifest = getattr(ctx, "manifest", None)
+    if manifest is not None and manifest.story_path != story_path:
+        manifest = None
+    if segment is None:
+        audio_file_path = story_path / f"paragraph_{index}.{ctx.tts_format}"
+    else:
+        audio_file_path = story_path / f"paragraph_{index}_{segment}.{ctx.tts_format}"
+    with tracing.span("paragraph.synthesize", "reader", index=index, segment=segment) as span_args:
+        cached_audio = manifest.audio_file(index, ctx.tts_format, segment) if manifest else None
+        if cached_audio is not None:
+            logging.debug("Paragraph %i audio listed in the manifest at %s", index, cached_audio)
+            span_args["cached"] = True
+            return cached_audio
+        # Only probe the disk when the manifest doesn't know about this paragraph's audio.
+        if segment is None and (manifest is None or manifest.get(index) is None or text is None) \
+                and audio_file_path.exists():
+            logging.debug("Paragraph %i audio already exists at %s", index, audio_file_path)
+            span_args["cached"] = True
+            if manifest is not None and manifest.get(index) is not None:
+                await record_audio(manifest, index, audio_file_path, ctx.tts_format)
+            return audio_file_path
+        if not text:
+            text_file_path = story_path / f"paragraph_{index}.txt"
+            if text_file_path.exists():
+                logging.debug("Reading paragraph %i text from %s ...", index, text_file_path)
+                text = utils.read_from_file(text_file_path)
+            else:
+                raise ValueError(f"No text found for paragraph {index} in {story_path}")
+            if segment is not None:
+                span = manifest.segment_span(index, segment) if manifest else None
+                if span is None:
+                    raise ValueError(f"No segment {segment} in paragraph {index} of {story_path}")
+                text = text.strip()[span[0]:span[1]]
+        # Use the TTS service abstraction
+        await ctx.tts_service.synthesize(
+            text=text,
+            voice=ctx.tts_voice,
+            provider=getattr(ctx, 'tts_provider', 'elevenlabs'),
+            output_file=audio_file_path,
+            format=ctx.tts_format,
+            model=ctx.tts_model,
+            sample_rate=ctx.tts_sample_rate,
+            stream=ctx.tts_streaming,
+        )
     logging.debug("Saved audio for paragraph %i to %s", index, audio_file_path)
+    if manifest is not None and (segment is not None or manifest.get(index) is not None):
+        await record_audio(manifest, index, audio_file_path, ctx.tts_format, ctx.tts_sample_rate, segment, text)
     return audio_file_path
 
 
+async def record_audio(manifest, index, audio_file_path, audio_format, sample_rate=None, segment=None, text=None):
+    """
+    Records the audio file of a paragraph, or of one of its segments, and the format it was requested in,
+    in the story manifest. The file is probed off the event loop, the manifest is saved by the writer
+    and at the end of the story.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        size, duration = await loop.run_in_executor(None, probe_audio, audio_file_path)
+    except OSError as e:
+        logging.warning("Failed to read the audio file %s: %s", audio_file_path, e)
+        return
+    manifest.set_audio(
+        index,
+        audio_file_path,
+        audio_format,
+        size=size,
+        duration=duration,
+        sample_rate=sample_rate,
+        segment=segment,
+        text_sha1=text_hash(text) if segment is not None else None,
+    )
+
+
+def probe_audio(audio_file_path):
+    """
+    Size in bytes and duration in seconds (None if unknown) of an audio file.
+    """
+    return audio_file_path.stat().st_size, probe_duration(audio_file_path)
+
+
+async def save_manifest(manifest):
+    """
+    Saves the story manifest from a worker thread, as SD card writes can take a while.
+    """
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, utils.write_atomically, manifest.story_path / MANIFEST_FILE, manifest.dumps()
+        )
+    except OSError as e:
+        logging.warning("Failed to update the story manifest: %s", e)
+
+
 async def writer(ctx, story_queue, query=None):
     """
     Creates a story based on a textual query or story request.
@@ -75,6 +169,7 @@ async def writer(ctx, story_queue, query=None):
         raise RuntimeError("No query provided and no story_request set.")
     # Check if this is a continuation query
     is_continuation = utils.is_continuation_query(query, ctx.continuation_patterns)
+    manifest = None
     # Handle story continuation
     if is_continuation:
         continue_story_path = utils.find_story_for_continuation(
@@ -82,18 +177,30 @@ async def writer(ctx, story_queue, query=None):
         )
         if not continue_story_path:
             logging.warning("No existing story found to continue")
-            await story_queue.put(None)
+            await story_queue.close()
             return
         story_path = continue_story_path
-        story_context = utils.extract_story_context(story_path, max_paragraphs=10)
-        starting_paragraph_index = utils.get_next_paragraph_index(story_path)
-        logging.info(f"Continuing story '{story_context['original_query']}' from paragraph %i", starting_paragraph_index)
-        for index in range(story_context['paragraph_count']):
-            await story_queue.put((story_path, index, None))
     else:
         story_path = ctx.stories_path / utils.query_to_filename(query, prefix="")
+        if not ctx.ignore_cache and story_path.is_dir():
+            manifest = StoryManifest.load_or_build(story_path)
+            if not manifest.complete:
+                # Stopped while it was being written: tell what is there, then write the rest.
+                logging.info("Story at %s was never finished, resuming it", story_path)
+                is_continuation = True
+    if is_continuation:
+        manifest = manifest or StoryManifest.load_or_build(story_path)
+        manifest.complete = False
+        ctx.manifest = manifest
+        story_context = await story_memory.continuation_context(ctx, story_path, manifest)
+        starting_paragraph_index = manifest.paragraph_count
+        logging.info(f"Continuing story '{story_context['original_query']}' from paragraph %i", starting_paragraph_index)
+        for index, segment in manifest.playback_items(ctx.tts_format):
+            await story_queue.put((story_path, index, segment, None))
+    else:
         story_context = None
         starting_paragraph_index = 0
+    tracing.annotate(story_path=story_path, query=query)
     # Generate new content if needed
     if ctx.ignore_cache or (
         not ctx.ignore_cache and (is_continuation or (not story_path.exists() and not story_path.is_dir()))
@@ -107,92 +214,271 @@ async def writer(ctx, story_queue, query=None):
                 query=query,
                 query_local=query_local,
             )
+            # A regenerated story starts a fresh manifest, so stale audio is never reused.
+            manifest = StoryManifest(story_path)
+            ctx.manifest = manifest
         logging.debug("Reading prompt...")
         base_prompt = utils.read_from_file(ctx.prompt_file)
-        if is_continuation and story_context:
+        if is_continuation and story_context and story_context['paragraph_count']:
             continuation_context = "\n\n".join(story_context['paragraphs'])
-            prompt = f"{base_prompt}\n\nYou are continuing an existing story. Here is what has happened so far:\n\nOriginal request: {story_context['original_query']}\n\nStory so far:\n{continuation_context}\n\nNow continue this story based on the user's request: {query}"
+            summary = f"Summary of the story so far:\n{story_context['summary']}\n\n" if story_context['summary'] else ""
+            prompt = f"{base_prompt}\n\nYou are continuing an existing story. Here is what has happened so far:\n\nOriginal request: {story_context['original_query']}\n\n{summary}Most recent part of the story:\n{continuation_context}\n\nNow continue this story based on the user's request: {query}"
+            summary_tokens, recent_tokens = story_memory.context_size(story_context)
+            logging.debug("Continuation context: ~%i summary tokens, ~%i recent paragraph tokens", summary_tokens, recent_tokens)
+            tracing.annotate(summary_tokens=summary_tokens, recent_tokens=recent_tokens)
         else:
             prompt = base_prompt
-        story_stream = await generate_story(ctx, query, prompt)
+        with tracing.span("llm.request", "writer", model=ctx.llm_model):
+            story_stream = await generate_story(ctx, query, prompt)
+        segmenter = TextSegmenter(
+            granularity=ctx.segment_granularity,
+            min_chars=ctx.segment_min_chars,
+            max_chars=ctx.segment_max_chars,
+        )
         index = starting_paragraph_index
-        paragraph = []
-        async for chunk in story_stream:
-            fragment = chunk.choices[0].delta.content
-            if fragment is None:
-                break
-            paragraph.append(fragment)
-            if fragment.endswith("\n\n"):
-                paragraph_str = "".join(paragraph)
-                logging.info("Paragraph %i: %s", index, paragraph_str)
-                utils.write_to_file(
-                    story_path / f"paragraph_{index}.txt", paragraph_str
-                )
-                await story_queue.put((story_path, index, paragraph_str))
+        segments = []
+
+        async def emit(kind, text):
+            # Segments go to TTS as soon as they are cut, the paragraph files hold whole paragraphs.
+            nonlocal index, segments
+            if kind == SEGMENT:
+                segment = len(segments)
+                segments.append(text)
+                logging.info("Paragraph %i, segment %i: %s", index, segment, text)
+                tracing.mark("paragraph.text", "writer", index=index, segment=segment, chars=len(text))
+                with tracing.span("queue.wait", "writer", index=index, segment=segment):
+                    await story_queue.put((story_path, index, segment, text))
+            else:
+                utils.write_to_file(story_path / f"paragraph_{index}.txt", text)
+                manifest.set_text(index, text, segments)
+                await save_manifest(manifest)
                 index += 1
-                paragraph = []
+                segments = []
+
+        first_token = True
+        try:
+            async for chunk in story_stream:
+                fragment = chunk.choices[0].delta.content
+                if fragment is None:
+                    break
+                if first_token:
+                    tracing.mark("llm.first_token", "writer")
+                    first_token = False
+                for kind, text in segmenter.feed_events(fragment):
+                    await emit(kind, text)
+        except asyncio.CancelledError:
+            # Close the HTTP response so that the provider stops generating tokens nobody will hear.
+            await close_stream(story_stream)
+            raise
+        for kind, text in segmenter.flush_events():
+            await emit(kind, text)
+        manifest.complete = True
+        await save_manifest(manifest)
+        generated = True
         logging.debug("Finished processing the story stream.")
     else:
+        generated = False
         logging.debug("Reading cached story at %s", story_path)
-        for index in range(len(list(story_path.glob("paragraph_*.txt")))):
-            await story_queue.put((story_path, index, None))
+        manifest = manifest or StoryManifest.load_or_build(story_path)
+        ctx.manifest = manifest
+        for index, segment in manifest.playback_items(ctx.tts_format):
+            await story_queue.put((story_path, index, segment, None))
     logging.debug("Done processing the story.")
-    await story_queue.put(None)  # Indicates that we're done
+    await story_queue.close()  # Indicates that we're done
+    if generated:
+        # Runs while the last paragraphs are synthesized and played, and after the story ends.
+        story_memory.schedule_update(ctx, story_path, manifest)
 
 
 async def reader(ctx, story_queue, reading_queue):
     """
     Processes the queue of paragraphs and sends them off to be read and synthezized into audio files.
+
+    Up to ctx.tts_lookahead paragraphs are synthesized concurrently, but the audio files are always
+    handed to the speaker in paragraph order.
     """
-    while ctx.talking:
-        item = await story_queue.get()
-        if item is None:
-            logging.debug("Done reading the story.")
-            await reading_queue.put(None)
-            break
-        story_path, index, paragraph = item
-        audio_file = await synthesize_audio(ctx, story_path, index, paragraph)
-        await reading_queue.put(audio_file)
+    window = asyncio.Semaphore(max(1, ctx.tts_lookahead))
+    pending = asyncio.Queue()
+
+    async def deliver():
+        # Awaits the synthesis tasks in the order they were scheduled and frees a window slot
+        # only once the audio file has been handed off to the speaker.
+        try:
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                audio_file = await task
+                await reading_queue.put(audio_file)
+                window.release()
+        finally:
+            window.release()  # Unblocks the scheduling loop if a synthesis failed
+
+    delivery_task = asyncio.create_task(deliver())
+    scheduled = []
+    try:
+        while ctx.talking:
+            with tracing.span("queue.wait", "reader"):
+                item = await story_queue.get()
+            if item is None:
+                break
+            story_path, index, segment, text = item
+            await window.acquire()
+            if delivery_task.done():
+                break  # A synthesis failed, the error is raised below
+            task = asyncio.create_task(synthesize_audio(ctx, story_path, index, text, segment))
+            scheduled.append(task)
+            await pending.put(task)
+        await pending.put(None)
+        await delivery_task
+    finally:
+        for task in scheduled + [delivery_task]:
+            if not task.done():
+                task.cancel()
+        logging.debug("Done reading the story.")
+        await reading_queue.close()
 
 
 async def speaker(ctx, reading_queue):
     """
     Processes the queue of audio files and plays them.
+
+    Playback goes through a long-lived audio output that keeps the device open, and the next
+    paragraph is queued while the current one plays so there is no gap between them. The output
+    is opened once on the runtime and reused by every story, so no story waits for the device to open.
     """
     loop = asyncio.get_running_loop()
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        while ctx.talking:
-            audio_file = await reading_queue.get()
-            if audio_file is None:
-                logging.debug("Done playing the story.")
-                break
-            def speak():
-                utils.play_audio_file(audio_file)
-            await loop.run_in_executor(pool, speak)
+    output = getattr(ctx, "audio_output", None)
+    if output is None:
+        output = runtime.resource(
+            "audio_output",
+            lambda: audio_output.open_output(ctx.sound_driver, persistent=ctx.persistent_audio),
+            lambda output: output.close(),
+        )
+    playing = collections.deque()
+    trace = tracing.get_current()
+
+    def record_playback(handle):
+        if trace is not None and handle.started_at is not None and not handle.cancelled:
+            trace.add_span("playback", "speaker", handle.started_at, handle.finished_at, file=Path(handle.label).name)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            try:
+                while ctx.talking:
+                    with tracing.span("queue.wait", "speaker"):
+                        audio_file = await reading_queue.get()
+                    if audio_file is None:
+                        break
+                    # Decoding happens off the event loop, then at most one paragraph waits behind the one playing.
+                    with tracing.span("audio.decode", "speaker", file=audio_file.name):
+                        playing.append(await loop.run_in_executor(pool, output.enqueue, audio_file))
+                    while len(playing) > 1:
+                        handle = playing.popleft()
+                        await loop.run_in_executor(pool, handle.wait)
+                        record_playback(handle)
+                await loop.run_in_executor(pool, output.drain)
+                for handle in playing:
+                    record_playback(handle)
+            except asyncio.CancelledError:
+                # Silence the output before the pool shuts down, as its threads may be waiting on playback.
+                logging.debug("Playback interrupted.")
+                output.interrupt()
+                raise
+        logging.debug("Done playing the story.")
+    finally:
+        logging.debug("Audio output stats: %s", output.stats())
 
 
 async def run_story_loop(ctx, query=None, terminate=False):
     """
     The main loop for running the story.
+
+    Every run is traced, and the trace is saved next to the story's info.yaml.
+    The story can be interrupted at any time from any thread with stop_story(): the writer,
+    reader and speaker tasks are cancelled, which closes the LLM stream, aborts the TTS requests
+    in flight and silences the audio output. If one of the tasks fails, the others are cancelled too.
     """
     ctx.talking = True
-    story_queue = asyncio.Queue()
-    reading_queue = asyncio.Queue()
-    writer_task = asyncio.create_task(writer(ctx, story_queue, query))
-    reader_task = asyncio.create_task(reader(ctx, story_queue, reading_queue))
-    speaker_task = asyncio.create_task(speaker(ctx, reading_queue))
-    await asyncio.gather(writer_task, reader_task, speaker_task)
+    ctx.story_loop = asyncio.get_running_loop()
+    ctx.stop_requested = asyncio.Event()
+    trace = tracing.start_trace(query)
+    # Bounded so that a slow speaker holds back the reader and, through it, the LLM stream.
+    story_queue = PipelineQueue("story", ctx.queue_max_items, ctx.queue_max_bytes)
+    reading_queue = PipelineQueue("reading", ctx.queue_max_items, ctx.queue_max_bytes)
+    tasks = [
+        asyncio.create_task(writer(ctx, story_queue, query)),
+        asyncio.create_task(reader(ctx, story_queue, reading_queue)),
+        asyncio.create_task(speaker(ctx, reading_queue)),
+    ]
+    stop_task = asyncio.create_task(ctx.stop_requested.wait())
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending | {stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            pending.discard(stop_task)
+            if stop_task in done:
+                logging.info("Stopping the story...")
+                tracing.mark("story.stop", "speaker")
+                break
+            if any(not task.cancelled() and task.exception() for task in done):
+                break
+    finally:
+        stop_task.cancel()
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        if ctx.manifest is not None:
+            # Records the audio synthesized since the writer last saved it.
+            await save_manifest(ctx.manifest)
+        ctx.talking = False
+        ctx.story_loop = None
+        ctx.manifest = None
+        trace.stats["queues"] = {queue.name: queue.stats() for queue in (story_queue, reading_queue)}
+        for queue in (story_queue, reading_queue):
+            queue.log_stats()
+        save_trace(ctx, trace)
+        if terminate:
+            ctx.running = False
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def stop_story(ctx):
+    """
+    Interrupts the story being told, if any. Safe to call from any thread.
+    """
+    loop = getattr(ctx, "story_loop", None)
+    if loop is None or loop.is_closed():
+        return
     ctx.talking = False
-    if terminate:
-        ctx.running = False
+    loop.call_soon_threadsafe(ctx.stop_requested.set)
+
+
+def save_trace(ctx, trace):
+    """
+    Writes the trace of a story next to its info.yaml and logs the headline latency numbers.
+    """
+    summary = trace.summary()
+    if summary["time_to_first_audio"] is not None:
+        logging.info("Time to first audio: %.2fs", summary["time_to_first_audio"])
+    story_path = trace.metadata.get("story_path")
+    if not story_path or not story_path.is_dir():
+        return
+    try:
+        trace.write(story_path / tracing.TRACE_FILE)
+        if getattr(ctx, "chrome_trace", False):
+            trace.write_chrome_trace(story_path / tracing.CHROME_TRACE_FILE)
+    except OSError as e:
+        logging.warning("Failed to save the story trace: %s", e)
+
 
 def tell_story(ctx, query=None, terminate=False):
     """
-    Forks off a thread to tell the story.
+    Queues the story on the long-lived runtime and returns a future that completes when it's over.
     """
-    def tell_story_wrapper():
-        asyncio.run(run_story_loop(ctx, query, terminate))
-    threading.Thread(target=tell_story_wrapper).start()
+    return runtime.submit(run_story_loop, ctx, query, terminate)
 
 def main(ctx, query=None):
     """
@@ -217,7 +503,10 @@ def main(ctx, query=None):
             return
     if not query:
         raise RuntimeError("No query provided and no story_request set.")
-    tell_story(ctx, query=query, terminate=True)
-    while ctx.running:
-        time.sleep(1.0)
+    story = tell_story(ctx, query=query, terminate=True)
+    try:
+        story.result()
+    except KeyboardInterrupt:
+        stop_story(ctx)
+        raise
     logging.debug("Shutting down... bye!")
@@ -0,0 +1,232 @@
+"""
+Story Manifest
+
+Every story directory carries a small manifest.json describing its paragraphs: the text file
+and a hash of its content, and the audio file with its format, size and duration. It is written
+atomically as paragraphs are produced, so that a cached story can be scheduled for playback
+with a single small read instead of globbing and probing the SD card for every paragraph.
+
+A paragraph that was synthesized in several segments (sentences or clauses) lists them, as
+spans of its text, with the audio of each segment.
+"""
+
+import hashlib
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import soundfile as sf
+
+from fably import utils
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+PARAGRAPH_FILE = re.compile(r"paragraph_(\d+)\.(\w+)$")
+
+
+def text_hash(text: str) -> str:
+    """Hash of a paragraph's text, used to tell whether its audio is still current."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def probe_duration(audio_file: Path) -> Optional[float]:
+    """Duration of an audio file in seconds, or None if it cannot be read cheaply."""
+    if Path(audio_file).suffix.lower() == ".mp3":
+        # MP3 has no length in its header, libsndfile would scan (and complain about) every frame.
+        return None
+    try:
+        return round(sf.info(str(audio_file)).duration, 3)
+    except Exception:
+        return None
+
+
+class StoryManifest:
+    """In-memory view of a story directory's manifest.json."""
+
+    def __init__(self, story_path: Path, paragraphs: List[Optional[Dict[str, Any]]] = None, complete: bool = False):
+        self.story_path = Path(story_path)
+        self.paragraphs = paragraphs or []
+        self.complete = complete
+        # Audio of the segments of a paragraph still being written, keyed by (paragraph, segment).
+        self.pending_audio = {}
+
+    @classmethod
+    def load(cls, story_path: Path) -> Optional["StoryManifest"]:
+        """Read the manifest of a story, or return None if it is missing or unreadable."""
+        manifest_file = Path(story_path) / MANIFEST_FILE
+        try:
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable story manifest %s: %s", manifest_file, e)
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            return None
+        return cls(story_path, data.get("paragraphs", []), data.get("complete", False))
+
+    @classmethod
+    def build(cls, story_path: Path) -> "StoryManifest":
+        """
+        Build a manifest from the files of a story written before manifests existed.
+        This lists the directory once; later replays only read the manifest.
+        """
+        manifest = cls(story_path, complete=True)
+        audio_files = {}
+        for entry in sorted(Path(story_path).iterdir()):
+            match = PARAGRAPH_FILE.match(entry.name)
+            if not match:
+                continue
+            index, extension = int(match.group(1)), match.group(2)
+            if extension == "txt":
+                manifest.set_text(index, utils.read_from_file(entry))
+            else:
+                audio_files[index] = (entry, extension)
+        for index, (audio_file, extension) in audio_files.items():
+            if manifest.get(index) is not None:
+                manifest.set_audio(index, audio_file, extension, size=audio_file.stat().st_size)
+        return manifest
+
+    @classmethod
+    def load_or_build(cls, story_path: Path) -> "StoryManifest":
+        """Read the manifest of a story, building and saving it first if it doesn't have one."""
+        manifest = cls.load(story_path)
+        if manifest is None:
+            logging.debug("Building manifest for %s", story_path)
+            manifest = cls.build(story_path)
+            manifest.save()
+        return manifest
+
+    @property
+    def paragraph_count(self) -> int:
+        return len(self.paragraphs)
+
+    def get(self, index: int) -> Optional[Dict[str, Any]]:
+        """Get the entry of a paragraph, or None if it is unknown."""
+        if 0 <= index < len(self.paragraphs):
+            return self.paragraphs[index]
+        return None
+
+    def set_text(self, index: int, text: str, segments: List[str] = None):
+        """
+        Record the text of a paragraph, dropping any audio made from a different text.
+
+        segments are the pieces of the text that were synthesized one by one, in order: the audio
+        already recorded for them is kept.
+        """
+        while len(self.paragraphs) <= index:
+            self.paragraphs.append(None)
+        entry = self.paragraphs[index] = {
+            "index": index,
+            "text_file": f"paragraph_{index}.txt",
+            "text_sha1": text_hash(text),
+            "chars": len(text),
+        }
+        pending = {
+            segment: audio for (paragraph, segment), audio in self.pending_audio.items() if paragraph == index
+        }
+        for segment in pending:
+            del self.pending_audio[(index, segment)]
+        spans = []
+        position = 0
+        for segment_text in segments or []:
+            start = text.find(segment_text, position)
+            if start < 0:
+                raise ValueError(f"Segment {len(spans)} is not part of paragraph {index}")
+            position = start + len(segment_text)
+            spans.append((start, position))
+        if len(spans) == 1 and spans[0] == (0, len(text)):
+            # Synthesized in one piece, the audio of the segment is the paragraph's.
+            if 0 in pending and pending[0]["text_sha1"] == entry["text_sha1"]:
+                entry["audio"] = pending[0]
+        elif spans:
+            entry["segments"] = []
+            for segment, (start, end) in enumerate(spans):
+                segment_entry = {"start": start, "end": end, "text_sha1": text_hash(text[start:end])}
+                audio = pending.get(segment)
+                if audio is not None and audio["text_sha1"] == segment_entry["text_sha1"]:
+                    segment_entry["audio"] = audio
+                entry["segments"].append(segment_entry)
+
+    def set_audio(self, index: int, audio_file: Path, audio_format: str, size: int = None, duration: float = None,
+                  sample_rate: int = None, segment: int = None, text_sha1: str = None):
+        """
+        Record the audio file synthesized for a paragraph, with the format it was requested in.
+
+        The audio of a segment is given with the segment's index and the hash of its text. It may
+        arrive before the paragraph is complete, it is then kept until set_text() records it.
+        """
+        audio = {
+            "file": Path(audio_file).name,
+            "format": audio_format,
+            "sample_rate": sample_rate,
+            "bytes": size,
+            "duration": duration,
+            "text_sha1": text_sha1,
+        }
+        entry = self.get(index)
+        if segment is None:
+            if entry is None:
+                raise ValueError(f"Paragraph {index} has no text in the manifest of {self.story_path}")
+            audio["text_sha1"] = entry["text_sha1"]
+            entry["audio"] = audio
+        elif entry is None:
+            self.pending_audio[(index, segment)] = audio
+        elif text_sha1 == entry["text_sha1"]:
+            entry["audio"] = audio
+        elif segment < len(entry.get("segments", [])) and text_sha1 == entry["segments"][segment]["text_sha1"]:
+            entry["segments"][segment]["audio"] = audio
+
+    def audio_file(self, index: int, audio_format: str, segment: int = None) -> Optional[Path]:
+        """Path of the audio of a paragraph (or of one of its segments) in the given format, if it is current."""
+        entry = self.get(index)
+        if entry is not None and segment is not None:
+            segments = entry.get("segments", [])
+            entry = segments[segment] if segment < len(segments) else None
+        audio = entry.get("audio") if entry else None
+        if not audio or audio["format"] != audio_format or audio["text_sha1"] != entry["text_sha1"]:
+            return None
+        return self.story_path / audio["file"]
+
+    def segment_span(self, index: int, segment: int) -> Optional[Tuple[int, int]]:
+        """Start and end of a segment in its paragraph's text, or None if the paragraph has no such segment."""
+        entry = self.get(index)
+        segments = entry.get("segments", []) if entry else []
+        if segment >= len(segments):
+            return None
+        return segments[segment]["start"], segments[segment]["end"]
+
+    def playback_items(self, audio_format: str) -> List[Tuple[int, Optional[int]]]:
+        """
+        The (paragraph, segment) pieces to play the story in, segment None standing for a whole
+        paragraph. Paragraphs are played whole when their audio is current, else in the segments
+        they were written in, so that a replay starts as soon as a fresh synthesis did.
+        """
+        items = []
+        for index, entry in enumerate(self.paragraphs):
+            segments = entry.get("segments") if entry else None
+            if segments and self.audio_file(index, audio_format) is None:
+                items.extend((index, segment) for segment in range(len(segments)))
+            else:
+                items.append((index, None))
+        return items
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": MANIFEST_VERSION,
+            "complete": self.complete,
+            "paragraph_count": self.paragraph_count,
+            "paragraphs": self.paragraphs,
+        }
+
+    def dumps(self) -> str:
+        """The manifest as written to manifest.json."""
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+    def save(self):
+        """Write the manifest atomically next to the story's info.yaml."""
+        utils.write_atomically(self.story_path / MANIFEST_FILE, self.dumps())
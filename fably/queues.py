@@ -0,0 +1,134 @@
+"""
+Pipeline Queues
+
+Bounded queues used between the writer, reader and speaker. A queue holds at most a number of
+items and a number of bytes of text, so a fast LLM or TTS provider cannot pile up paragraphs
+while a slow speaker catches up: producers wait in put() instead, which in turn stops the
+writer from reading the LLM stream until there is room again.
+
+Audio travels as file paths and stays on disk until the speaker decodes it, one paragraph
+ahead of playback, so it only counts against the item limit.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from fably import tracing
+
+
+def item_size(item: Any) -> int:
+    """
+    Approximate number of bytes a pipeline item holds in memory: its text or data. An audio
+    file path counts for nothing, the audio is read from disk only when it is played.
+    """
+    if item is None:
+        return 0
+    if isinstance(item, tuple):
+        return sum(item_size(part) for part in item)
+    if isinstance(item, str):
+        return len(item.encode("utf-8"))
+    if isinstance(item, (bytes, bytearray)):
+        return len(item)
+    return 0
+
+
+class PipelineQueue:
+    """
+    FIFO queue bounded by item count and total size, with depth metrics.
+
+    An item larger than max_bytes is still accepted when the queue is empty, so a single
+    oversized paragraph can't stall the pipeline. The end of the stream is signalled with
+    close(), which never blocks, so producers can always finish even if the consumer is gone.
+
+    Args:
+        name: Name used in logs and in the trace
+        max_items: Maximum number of queued items (0 for no limit)
+        max_bytes: Maximum number of queued bytes (0 for no limit)
+        sizeof: Function returning the size of an item in bytes
+    """
+
+    def __init__(self, name: str, max_items: int = 0, max_bytes: int = 0, sizeof: Callable[[Any], int] = item_size):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._items = collections.deque()
+        self._bytes = 0
+        self._changed = asyncio.Condition()
+        self._stats = {
+            "puts": 0,
+            "put_waits": 0,
+            "put_wait_time": 0.0,
+            "max_items": 0,
+            "max_bytes": 0,
+        }
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def _full(self, size: int) -> bool:
+        if not self._items:
+            return False
+        if self.max_items and len(self._items) >= self.max_items:
+            return True
+        return bool(self.max_bytes) and self._bytes + size > self.max_bytes
+
+    def _append(self, item: Any, size: int):
+        self._items.append((item, size))
+        self._bytes += size
+        self._stats["puts"] += 1
+        self._stats["max_items"] = max(self._stats["max_items"], len(self._items))
+        self._stats["max_bytes"] = max(self._stats["max_bytes"], self._bytes)
+        self._record_depth()
+        self._changed.notify_all()
+
+    def _record_depth(self):
+        tracing.counter(f"queue.{self.name}", "queue", items=len(self._items), bytes=self._bytes)
+
+    async def put(self, item: Any):
+        """Queue an item, waiting for room if the queue is full."""
+        size = self.sizeof(item)
+        async with self._changed:
+            if self._full(size):
+                self._stats["put_waits"] += 1
+                started = time.perf_counter()
+                await self._changed.wait_for(lambda: not self._full(size))
+                self._stats["put_wait_time"] += time.perf_counter() - started
+            self._append(item, size)
+
+    async def close(self):
+        """Queue the end-of-stream marker (None) regardless of the limits."""
+        async with self._changed:
+            self._append(None, 0)
+
+    async def get(self) -> Optional[Any]:
+        """Remove and return the next item, waiting for one if the queue is empty."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._items)
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._record_depth()
+            self._changed.notify_all()
+            return item
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the limits, the current depth and the high-water marks of the queue."""
+        stats = dict(self._stats)
+        stats.update({
+            "limit_items": self.max_items,
+            "limit_bytes": self.max_bytes,
+            "items": len(self._items),
+            "bytes": self._bytes,
+            "put_wait_time": round(self._stats["put_wait_time"], 4),
+        })
+        return stats
+
+    def log_stats(self):
+        logging.debug("Queue %s stats: %s", self.name, self.stats())
@@ -0,0 +1,144 @@
+"""
+Story Runtime
+
+This module runs a single asyncio event loop on a daemon thread for the lifetime of the process.
+The CLI, the GPIO button and voice cycling hand their work to it instead of spinning up a new
+thread and event loop per request, so connection pools, caches and other warm state survive
+from one story to the next.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class StoryRuntime:
+    """
+    Owns the long-lived event loop and a job queue processed one job at a time.
+
+    Stories are submitted as jobs with submit(), so they never overlap, while short tasks
+    such as voice cycling run right away with run() without waiting for the story to end.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+        self._jobs = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._shutdown_hooks: List[Callable[[], Awaitable[Any]]] = []
+        self._resources: Dict[str, Any] = {}
+
+    def start(self):
+        """Start the event loop thread, if it is not running yet."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._run, name="fably-runtime", daemon=True)
+            self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._jobs = asyncio.Queue()
+        worker = self.loop.create_task(self._process_jobs())
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            worker.cancel()
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+            logging.debug("Runtime event loop closed")
+
+    async def _process_jobs(self):
+        while True:
+            job, future = await self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(await job())
+            except BaseException as e:
+                future.set_exception(e)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+
+    def submit(self, job: Callable[..., Awaitable[Any]], *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Queue a coroutine function to run after the jobs already submitted.
+
+        Returns:
+            A concurrent.futures.Future with the result of the job
+        """
+        self.start()
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._jobs.put_nowait, (lambda: job(*args, **kwargs), future))
+        return future
+
+    def spawn(self, coro: Awaitable[Any]) -> concurrent.futures.Future:
+        """Run a coroutine on the runtime loop right away, alongside any running job."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[Any], timeout: float = None) -> Any:
+        """Run a coroutine on the runtime loop right away and wait for its result."""
+        return self.spawn(coro).result(timeout)
+
+    def add_shutdown_hook(self, hook: Callable[[], Awaitable[Any]]):
+        """Register a coroutine function to await on the loop before it shuts down."""
+        self._shutdown_hooks.append(hook)
+
+    def resource(self, name: str, factory: Callable[[], Any], close: Optional[Callable[[Any], Any]] = None) -> Any:
+        """
+        Get a long-lived object shared by the jobs, such as an open audio device: it is created
+        with factory() on first use and closed with close() (in an executor) when the runtime shuts down.
+        """
+        with self._lock:
+            if name in self._resources:
+                return self._resources[name]
+            value = self._resources[name] = factory()
+
+        async def close_resource():
+            with self._lock:
+                if self._resources.get(name) is not value:
+                    return
+                del self._resources[name]
+            await asyncio.get_running_loop().run_in_executor(None, close, value)
+
+        if close is not None:
+            self.add_shutdown_hook(close_resource)
+        return value
+
+    def shutdown(self, timeout: float = 5.0):
+        """Run the shutdown hooks, then stop the event loop and wait for its thread to exit."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None or not thread.is_alive():
+            return
+
+        async def run_hooks():
+            for hook in self._shutdown_hooks:
+                try:
+                    await hook()
+                except Exception as e:
+                    logging.warning("Runtime shutdown hook failed: %s", e)
+
+        try:
+            asyncio.run_coroutine_threadsafe(run_hooks(), self.loop).result(timeout)
+        except Exception as e:
+            logging.warning("Runtime shutdown hooks did not complete: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        thread.join(timeout)
+
+
+# Global runtime instance
+runtime = StoryRuntime()
@@ -0,0 +1,232 @@
+"""
+Story Memory
+
+This module keeps the continuation prompt of a story roughly the same size however long the
+story gets. Instead of inlining past paragraphs, the prompt carries:
+
+- a rolling summary of the older part of the story, persisted in the story's summary.yaml and
+  extended incrementally with the LLM after each chapter, and
+- a window with the most recent paragraphs that fits in a token budget.
+
+The summary only ever covers paragraphs that fell out of the recent window, so short stories
+never cost a summarization request. It is updated in the background once a chapter is written,
+while the end of the chapter is still being read aloud.
+"""
+
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+import yaml
+
+from fably import tracing
+from fably import utils
+
+SUMMARY_FILE = "summary.yaml"
+
+# Summary updates running in the background, by story directory.
+_updates: Dict[Path, asyncio.Task] = {}
+
+# Rough average for the languages Fably speaks, good enough for budgeting without a tokenizer.
+CHARS_PER_TOKEN = 4
+
+# Paragraphs folded into the summary per LLM request when catching up on a long story.
+SUMMARY_BATCH_TOKENS = 3000
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a children's story so that it can be continued later. "
+    "Update the summary with the new paragraphs. Keep the characters, places, objects and open "
+    "plot threads, drop the wording. Write in the language of the story, in at most {words} words, "
+    "and reply with the summary only."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def load_summary(story_path: Path) -> Dict[str, Any]:
+    """
+    Read the rolling summary of a story.
+
+    Returns:
+        dict with 'summary' and 'summarized_through', the index of the last paragraph it covers (-1 for none)
+    """
+    try:
+        data = utils.read_from_yaml(Path(story_path) / SUMMARY_FILE) or {}
+    except FileNotFoundError:
+        data = {}
+    except Exception as e:
+        logging.warning("Ignoring unreadable story summary in %s: %s", story_path, e)
+        data = {}
+    return {
+        "summary": data.get("summary", ""),
+        "summarized_through": data.get("summarized_through", -1),
+    }
+
+
+def save_summary(story_path: Path, summary: str, summarized_through: int):
+    # Replaced in one go, a power cut leaves the previous summary rather than half of the new one.
+    utils.write_atomically(
+        Path(story_path) / SUMMARY_FILE,
+        yaml.dump({"summary": summary, "summarized_through": summarized_through}, default_flow_style=False),
+    )
+
+
+def read_paragraph(story_path: Path, index: int) -> str:
+    try:
+        return utils.read_from_file(Path(story_path) / f"paragraph_{index}.txt").strip()
+    except FileNotFoundError:
+        logging.warning("Paragraph %i of %s is missing", index, story_path)
+        return ""
+
+
+def read_paragraphs(story_path: Path, indices: Iterable[int]) -> List[str]:
+    return [read_paragraph(story_path, index) for index in indices]
+
+
+def recent_window(manifest, token_budget: int) -> int:
+    """
+    Find where the window of recent paragraphs starts: as many paragraphs from the end of the
+    story as fit in the token budget, and always at least the last one.
+    Sizes come from the manifest, so only the paragraphs in the window are read from disk.
+    """
+    start = manifest.paragraph_count
+    used = 0
+    while start > 0:
+        entry = manifest.get(start - 1)
+        tokens = entry["chars"] // CHARS_PER_TOKEN + 1 if entry else 0
+        if used + tokens > token_budget and start < manifest.paragraph_count:
+            break
+        used += tokens
+        start -= 1
+    return start
+
+
+async def summarize(ctx, summary: str, paragraphs: List[str]) -> str:
+    """Ask the LLM to fold new paragraphs into the summary."""
+    words = max(50, ctx.summary_tokens * 3 // 4)
+    user_message = "Summary so far:\n%s\n\nNew paragraphs:\n%s" % (summary or "(none)", "\n\n".join(paragraphs))
+    response = await ctx.llm_client.chat.completions.create(
+        model=ctx.llm_model,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT.format(words=words)},
+            {"role": "user", "content": user_message},
+        ],
+        max_tokens=ctx.summary_tokens * 2,
+        temperature=0,
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def update_summary(ctx, story_path: Path, through: int) -> Dict[str, Any]:
+    """
+    Extend the rolling summary so that it covers the paragraphs up to index `through`.
+    Only paragraphs that are not summarized yet are sent, in batches for long stories.
+    Files are read and written off the event loop, which keeps playing the story meanwhile.
+    """
+    loop = asyncio.get_running_loop()
+    state = await loop.run_in_executor(None, load_summary, story_path)
+    start = state["summarized_through"] + 1
+    if start > through:
+        return state
+
+    with tracing.span("summary.update", "writer", first=start, last=through):
+        summary = state["summary"]
+        paragraphs = await loop.run_in_executor(None, read_paragraphs, story_path, range(start, through + 1))
+        batch, batch_tokens = [], 0
+        for index, paragraph in enumerate(paragraphs, start):
+            if paragraph:
+                batch.append(paragraph)
+            batch_tokens += estimate_tokens(paragraph)
+            if batch and (batch_tokens >= SUMMARY_BATCH_TOKENS or index == through):
+                summary = await summarize(ctx, summary, batch)
+                await loop.run_in_executor(None, save_summary, story_path, summary, index)
+                batch, batch_tokens = [], 0
+
+    logging.debug("Story summary of %s now covers paragraphs 0-%i", story_path, through)
+    return {"summary": summary, "summarized_through": through}
+
+
+async def update_after_chapter(ctx, story_path: Path, manifest):
+    """
+    Fold the paragraphs that no longer fit in the recent window into the rolling summary, so the
+    next continuation can start without waiting for it. Failures are logged, the next
+    continuation catches up.
+    """
+    window_start = recent_window(manifest, ctx.context_tokens)
+    if window_start == 0:
+        return
+    try:
+        await update_summary(ctx, story_path, window_start - 1)
+    except Exception as e:
+        logging.warning("Failed to update the story summary: %s", e)
+
+
+def schedule_update(ctx, story_path: Path, manifest) -> asyncio.Task:
+    """
+    Run update_after_chapter() as a task of its own on the running loop, so the story doesn't
+    wait for the summary. A continuation of the story waits for it instead.
+    """
+    story_path = Path(story_path)
+    task = asyncio.get_running_loop().create_task(update_after_chapter(ctx, story_path, manifest))
+    _updates[story_path] = task
+
+    def forget(done):
+        if _updates.get(story_path) is done:
+            del _updates[story_path]
+
+    task.add_done_callback(forget)
+    return task
+
+
+async def continuation_context(ctx, story_path: Path, manifest) -> Dict[str, Any]:
+    """
+    Build the context of a story continuation: the original request, the rolling summary of the
+    older paragraphs and the most recent paragraphs within ctx.context_tokens.
+
+    Returns:
+        dict with 'original_query', 'summary', 'paragraphs' and 'paragraph_count'
+    """
+    story_path = Path(story_path)
+    original_query = None
+    try:
+        original_query = (utils.read_from_yaml(story_path / "info.yaml") or {}).get("query")
+    except Exception as e:
+        logging.warning("Failed to read story info from %s: %s", story_path, e)
+
+    update = _updates.get(story_path)
+    if update is not None and update.get_loop() is asyncio.get_running_loop():
+        # The previous chapter's summary is still being written, don't summarize the same paragraphs twice.
+        try:
+            await asyncio.shield(update)
+        except asyncio.CancelledError:
+            if not update.cancelled():
+                raise
+
+    loop = asyncio.get_running_loop()
+    window_start = recent_window(manifest, ctx.context_tokens)
+    state = await loop.run_in_executor(None, load_summary, story_path)
+    if state["summarized_through"] < window_start - 1:
+        # The previous chapter was interrupted before its summary was updated, or the story
+        # predates summaries: catch up on the paragraphs outside the window.
+        state = await update_summary(ctx, story_path, window_start - 1)
+    paragraphs = await loop.run_in_executor(
+        None, read_paragraphs, story_path, range(window_start, manifest.paragraph_count)
+    )
+
+    return {
+        "original_query": original_query or "Unknown",
+        "summary": state["summary"] if window_start > 0 else "",
+        "paragraphs": [paragraph for paragraph in paragraphs if paragraph],
+        "paragraph_count": manifest.paragraph_count,
+    }
+
+
+def context_size(story_context: Dict[str, Any]) -> Tuple[int, int]:
+    """Estimated tokens of the summary and of the recent paragraphs of a continuation context."""
+    return (
+        estimate_tokens(story_context["summary"]) if story_context["summary"] else 0,
+        sum(estimate_tokens(paragraph) for paragraph in story_context["paragraphs"]),
+    )
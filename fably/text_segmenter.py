@@ -0,0 +1,178 @@
+"""
+Streaming Text Segmenter
+
+This module splits the fragments streamed by the LLM into speakable segments
+(sentences, clauses or paragraphs) as soon as a boundary shows up, so that the
+first segment can be sent off to the TTS service without waiting for the whole
+paragraph to be generated. The paragraphs themselves are reported too, with their original
+text, since that's what a story is stored as.
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+GRANULARITIES = ["sentence", "clause", "paragraph"]
+
+# Kinds of the events returned by TextSegmenter.feed_events() and flush_events().
+SEGMENT = "segment"
+PARAGRAPH = "paragraph"
+
+# A paragraph break is always a hard boundary, whatever the granularity.
+PARAGRAPH_BOUNDARY = re.compile(r"\n\s*\n")
+
+# Sentence terminators, optionally followed by closing quotes or brackets, that are followed by whitespace.
+# Requiring the whitespace means that "3.14" or "..." at the end of a fragment are never cut too early.
+SENTENCE_BOUNDARY = re.compile(r"[.!?…]+[\"'”’»)\]]*(?=\s)")
+
+# Clause separators in addition to the sentence terminators.
+CLAUSE_BOUNDARY = re.compile(r"(?:[.!?…]+[\"'”’»)\]]*|[,;:]|\s[-–—])(?=\s)")
+
+
+class TextSegmenter:
+    """
+    Stateful segmenter that turns a stream of text fragments into speakable segments.
+
+    Fragments are fed in as they arrive with feed(), which returns the segments that became
+    complete, and flush() returns whatever is left once the stream is over. feed_events() and
+    flush_events() also report the end of each paragraph, with its full text.
+
+    Args:
+        granularity: One of "sentence", "clause" or "paragraph"
+        min_chars: Segments shorter than this are merged with the following ones
+                   (paragraph breaks always cut, regardless of this budget)
+        max_chars: Segments are force-split at the last whitespace before this many
+                   characters when no boundary shows up in time (0 disables the limit)
+    """
+
+    def __init__(self, granularity: str = "sentence", min_chars: int = 0, max_chars: int = 0):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown segment granularity '{granularity}', expected one of {GRANULARITIES}")
+        if max_chars and min_chars > max_chars:
+            raise ValueError("min_chars cannot be larger than max_chars")
+        self.granularity = granularity
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+        # Raw text of the paragraph being segmented, up to the buffer.
+        self._paragraph = ""
+
+        if granularity == "sentence":
+            self._boundary = SENTENCE_BOUNDARY
+        elif granularity == "clause":
+            self._boundary = CLAUSE_BOUNDARY
+        else:
+            self._boundary = None
+
+    def feed(self, fragment: str) -> List[str]:
+        """Add a fragment of text and return the segments that are now complete."""
+        return [text for kind, text in self.feed_events(fragment) if kind == SEGMENT]
+
+    def flush(self) -> Optional[str]:
+        """Return the remaining text once the stream is over, or None if there is nothing left."""
+        segments = [text for kind, text in self.flush_events() if kind == SEGMENT]
+        return segments[0] if segments else None
+
+    def feed_events(self, fragment: str) -> List[Tuple[str, str]]:
+        """
+        Add a fragment of text and return what it completed, in order: (SEGMENT, text) for
+        each segment and (PARAGRAPH, text) after the last segment of each paragraph.
+        """
+        if not fragment:
+            return []
+        self._buffer += fragment
+
+        events = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            consumed = self._buffer[:cut]
+            rest = self._buffer[cut:]
+            self._buffer = rest.lstrip()
+            whitespace = rest[:len(rest) - len(self._buffer)]
+            segment = consumed.strip()
+            if segment:
+                events.append((SEGMENT, segment))
+            if PARAGRAPH_BOUNDARY.search(consumed) or PARAGRAPH_BOUNDARY.search(whitespace):
+                self._paragraph += consumed
+                events.extend(self._end_paragraph())
+            elif "\n" in whitespace:
+                # Maybe half of a paragraph break: the other newline may come with the next fragment.
+                self._paragraph += consumed
+                self._buffer = "\n" + self._buffer
+            else:
+                self._paragraph += consumed + whitespace
+        return events
+
+    def flush_events(self) -> List[Tuple[str, str]]:
+        """The events of the remaining text once the stream is over."""
+        segment = self._buffer.strip()
+        self._paragraph += self._buffer
+        self._buffer = ""
+        events = [(SEGMENT, segment)] if segment else []
+        return events + self._end_paragraph()
+
+    def _end_paragraph(self) -> List[Tuple[str, str]]:
+        paragraph = self._paragraph.strip()
+        self._paragraph = ""
+        return [(PARAGRAPH, paragraph)] if paragraph else []
+
+    def _find_cut(self) -> Optional[int]:
+        """Find the position at which the buffer should be cut, or None if it should keep growing."""
+        text = self._buffer
+        if not text.strip():
+            return None
+
+        paragraph = PARAGRAPH_BOUNDARY.search(text)
+        limit = paragraph.start() if paragraph else len(text)
+        if self.max_chars and limit > self.max_chars:
+            limit = self.max_chars
+
+        cut = None
+        if self._boundary is not None:
+            for match in self._boundary.finditer(text, 0, limit):
+                if len(text[:match.end()].strip()) >= self.min_chars:
+                    cut = match.end()
+                    break
+
+        if cut is None and paragraph and paragraph.start() <= limit:
+            cut = paragraph.end()
+
+        if cut is None and self.max_chars and len(text) > self.max_chars:
+            # No boundary within budget: cut at the last whitespace that keeps the segment under the limit.
+            cut = text.rfind(" ", 0, self.max_chars + 1)
+            if cut <= 0:
+                cut = self.max_chars
+
+        return cut
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """
+    Split a complete text into as few pieces as possible, each at most max_chars long,
+    cutting between sentences where possible, then between clauses, then between words.
+    """
+    text = text.strip()
+    if not max_chars or len(text) <= max_chars:
+        return [text] if text else []
+
+    def segments(text, granularity, max_chars=0):
+        segmenter = TextSegmenter(granularity, max_chars=max_chars)
+        pieces = segmenter.feed(text + " ")
+        rest = segmenter.flush()
+        return pieces + [rest] if rest else pieces
+
+    parts = []
+    for sentence in segments(text, "sentence"):
+        if len(sentence) > max_chars:
+            parts.extend(segments(sentence, "clause", max_chars))
+        else:
+            parts.append(sentence)
+
+    pieces = []
+    for part in parts:
+        if pieces and len(pieces[-1]) + 1 + len(part) <= max_chars:
+            pieces[-1] = f"{pieces[-1]} {part}"
+        else:
+            pieces.append(part)
+    return pieces
@@ -0,0 +1,216 @@
+"""
+Pipeline Tracing
+
+This module provides a lightweight span recorder for the story pipeline. One StoryTrace is
+created per story by run_story_loop() and made current through a context variable, so the
+writer, reader, speaker and the TTS service can record spans without passing it around.
+
+Traces are saved as JSON next to the story's info.yaml and can be exported to the Chrome
+trace event format (chrome://tracing, Perfetto) to see which stage eats the latency budget.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+TRACE_FILE = "trace.json"
+CHROME_TRACE_FILE = "trace.chrome.json"
+
+# Lanes used when rendering the trace, in the order they appear in the pipeline.
+STAGES = ["writer", "reader", "tts", "speaker"]
+
+_current_trace = contextvars.ContextVar("fably_trace", default=None)
+
+
+class StoryTrace:
+    """Records timed spans and instant marks for a single story, relative to its start."""
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.metadata: Dict[str, Any] = {}
+        self.spans: List[Dict[str, Any]] = []
+        self.marks: List[Dict[str, Any]] = []
+        self.counters: List[Dict[str, Any]] = []
+        self.stats: Dict[str, Any] = {}
+
+    def now(self) -> float:
+        """Seconds elapsed since the start of the trace."""
+        return time.perf_counter() - self.origin
+
+    @contextlib.contextmanager
+    def span(self, name: str, stage: str, **args):
+        """Time the enclosed block. The yielded dict can be used to attach more arguments."""
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.spans.append({"name": name, "stage": stage, "start": start, "end": self.now(), "args": args})
+
+    def add_span(self, name: str, stage: str, start: float, end: float, **args):
+        """Record a span from time.perf_counter() timestamps taken elsewhere (e.g. in an audio callback)."""
+        self.spans.append({
+            "name": name,
+            "stage": stage,
+            "start": start - self.origin,
+            "end": end - self.origin,
+            "args": args,
+        })
+
+    def mark(self, name: str, stage: str, **args):
+        """Record an instant event."""
+        self.marks.append({"name": name, "stage": stage, "at": self.now(), "args": args})
+
+    def counter(self, name: str, stage: str, **values):
+        """Record the current values of a counter (e.g. the depth of a queue)."""
+        self.counters.append({"name": name, "stage": stage, "at": self.now(), "values": values})
+
+    def summary(self) -> Dict[str, Any]:
+        """Compute the per-story latency metrics from the recorded spans and marks."""
+        def spans_named(name):
+            return [span for span in self.spans if span["name"] == name]
+
+        def first_mark(name):
+            times = [mark["at"] for mark in self.marks if mark["name"] == name]
+            return min(times) if times else None
+
+        llm_requests = spans_named("llm.request")
+        first_token = first_mark("llm.first_token")
+        playback = sorted(spans_named("playback"), key=lambda span: span["start"])
+
+        queue_wait = {}
+        for span in spans_named("queue.wait"):
+            queue_wait[span["stage"]] = queue_wait.get(span["stage"], 0.0) + span["end"] - span["start"]
+
+        return {
+            "llm_first_token": first_token - llm_requests[0]["start"] if llm_requests and first_token is not None else None,
+            "time_to_first_audio": playback[0]["start"] if playback else None,
+            "tts_latency": [round(span["end"] - span["start"], 4) for span in spans_named("tts.synthesize")],
+            "queue_wait": {stage: round(seconds, 4) for stage, seconds in queue_wait.items()},
+            "playback_starts": [round(span["start"], 4) for span in playback],
+            "total": self.now(),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "metadata": {key: str(value) for key, value in self.metadata.items()},
+            "summary": self.summary(),
+            "spans": self.spans,
+            "marks": self.marks,
+            "counters": self.counters,
+            "stats": self.stats,
+        }
+
+    def write(self, output_file: Path):
+        """Write the trace as JSON."""
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        logging.debug("Trace saved to %s", output_file)
+
+    def write_chrome_trace(self, output_file: Path):
+        """Write the trace in the Chrome trace event format."""
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(to_chrome_trace(self.to_dict()), f, ensure_ascii=False)
+        logging.debug("Chrome trace saved to %s", output_file)
+
+
+def to_chrome_trace(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a trace dictionary (as written by StoryTrace.write) to Chrome trace events."""
+    def lane(stage):
+        return STAGES.index(stage) + 1 if stage in STAGES else len(STAGES) + 1
+
+    events = [
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane(stage), "args": {"name": stage}}
+        for stage in STAGES
+    ]
+    for span in trace["spans"]:
+        events.append({
+            "name": span["name"],
+            "cat": span["stage"],
+            "ph": "X",
+            "pid": 1,
+            "tid": lane(span["stage"]),
+            "ts": span["start"] * 1e6,
+            "dur": (span["end"] - span["start"]) * 1e6,
+            "args": span["args"],
+        })
+    for mark in trace["marks"]:
+        events.append({
+            "name": mark["name"],
+            "cat": mark["stage"],
+            "ph": "i",
+            "s": "t",
+            "pid": 1,
+            "tid": lane(mark["stage"]),
+            "ts": mark["at"] * 1e6,
+            "args": mark["args"],
+        })
+    for counter in trace.get("counters", []):
+        events.append({
+            "name": counter["name"],
+            "cat": counter["stage"],
+            "ph": "C",
+            "pid": 1,
+            "ts": counter["at"] * 1e6,
+            "args": counter["values"],
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"name": trace.get("name")}}
+
+
+def export_chrome_trace(trace_file: Path, output_file: Optional[Path] = None) -> Path:
+    """Convert a saved trace.json file to a Chrome trace file next to it."""
+    trace_file = Path(trace_file)
+    output_file = Path(output_file) if output_file else trace_file.with_name(CHROME_TRACE_FILE)
+    with open(trace_file, "r", encoding="utf-8") as f:
+        trace = json.load(f)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(to_chrome_trace(trace), f, ensure_ascii=False)
+    return output_file
+
+
+def start_trace(name: Optional[str] = None) -> StoryTrace:
+    """Create a trace and make it the current one for this task and the tasks it spawns."""
+    trace = StoryTrace(name)
+    _current_trace.set(trace)
+    return trace
+
+
+def get_current() -> Optional[StoryTrace]:
+    """Get the trace of the story being told, if any."""
+    return _current_trace.get()
+
+
+def span(name: str, stage: str, **args):
+    """Time a block on the current trace, or do nothing when no story is being traced."""
+    trace = _current_trace.get()
+    if trace is None:
+        return contextlib.nullcontext(args)
+    return trace.span(name, stage, **args)
+
+
+def mark(name: str, stage: str, **args):
+    """Record an instant event on the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mark(name, stage, **args)
+
+
+def counter(name: str, stage: str, **values):
+    """Record counter values on the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.counter(name, stage, **values)
+
+
+def annotate(**metadata):
+    """Attach metadata (e.g. the story path) to the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.metadata.update(metadata)
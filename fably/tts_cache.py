@@ -0,0 +1,158 @@
+"""
+TTS Audio Cache
+
+Content-addressed cache of synthesized audio shared by everything that goes through
+TTSService: stories, voice previews, announcements and regenerated stories. Entries are keyed
+by a hash of everything that changes the audio (provider, voice, model, voice settings, format,
+sample rate and the normalized text), stored as one file each, and evicted least-recently-used
+first once the cache grows past its byte budget. File modification times record the last use,
+so the LRU order survives restarts.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from fably import utils
+
+CACHE_SUFFIX = ".audio"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so that trivially different spellings share a cache entry."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class TTSCache:
+    """
+    Disk cache of synthesized audio with a byte budget and LRU eviction.
+
+    Args:
+        cache_dir: Directory holding the cached audio files
+        max_bytes: Byte budget, the least recently used entries are evicted beyond it
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 200 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # key -> size, least recently used first
+        self._bytes = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def key(provider: str, voice: str, text: str, model: Optional[str] = None,
+            voice_settings: Optional[Dict[str, Any]] = None, format: Optional[str] = None,
+            sample_rate: Optional[int] = None) -> str:
+        """Hash of everything that determines the synthesized audio."""
+        fields = [provider, voice, model, voice_settings, format, normalize_text(text)]
+        if sample_rate:
+            # Only when given, so that entries made before sample rates were requested keep their key.
+            fields.append(sample_rate)
+        material = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{CACHE_SUFFIX}"
+
+    def _load_index(self):
+        # Called with the lock held. One scan of the cache directory, on first use only.
+        if self._entries is not None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        found = []
+        for path in self.cache_dir.glob(f"*/*{CACHE_SUFFIX}"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            found.append((stat.st_mtime, path.stem, stat.st_size))
+        found.sort()
+        self._entries = collections.OrderedDict((key, size) for _, key, size in found)
+        self._bytes = sum(self._entries.values())
+        logging.debug("TTS cache at %s holds %i entries, %i bytes", self.cache_dir, len(self._entries), self._bytes)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached audio for a key, or None on a miss."""
+        with self._lock:
+            self._load_index()
+            if key not in self._entries:
+                self._stats["misses"] += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                self._bytes -= self._entries.pop(key)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        """Store audio under a key, evicting the least recently used entries beyond the budget."""
+        if self.max_bytes and len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._load_index()
+            path = self._path(key)
+            try:
+                path.parent.mkdir(exist_ok=True)
+                utils.write_atomically(path, data)
+            except OSError as e:
+                logging.warning("Failed to write to the TTS cache: %s", e)
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self._bytes += len(data)
+            self._stats["writes"] += 1
+            self._evict()
+
+    def _evict(self):
+        while self.max_bytes and self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._stats["evictions"] += 1
+            try:
+                self._path(key).unlink()
+            except OSError as e:
+                logging.debug("Failed to evict %s from the TTS cache: %s", key, e)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._load_index()
+            for key in list(self._entries):
+                try:
+                    self._path(key).unlink()
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the hit/miss/write/eviction counters and the current size of the cache."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries) if self._entries is not None else None
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
@@ -0,0 +1,192 @@
+"""
+TTS Provider Health
+
+Rolling statistics of the requests made to each TTS provider (and each of its models): latency
+percentiles, throughput and error rate over the last requests. TTSService uses them to route
+requests away from a provider that keeps failing, instead of hammering a degraded endpoint on a
+flaky home network, and to probe it again after a cool-down. The samples are saved on shutdown
+so that `fably --tts-stats` can show them and the next run starts from what was last seen.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fably import utils
+
+HEALTH_FILE = "tts_health.json"
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of values, None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RequestWindow:
+    """
+    The last requests of a provider or model.
+
+    Each sample is (time, ok, latency, bytes, duration): latency is the time to the first byte
+    of audio and duration the time until the last one, which are the same for buffered requests.
+    """
+
+    def __init__(self, size: int = 50, samples: Optional[List[List[Any]]] = None):
+        self.samples = collections.deque(samples or [], maxlen=size)
+        self.consecutive_failures = 0
+        for sample in reversed(self.samples):
+            if sample[1]:
+                break
+            self.consecutive_failures += 1
+
+    def record(self, ok: bool, latency: float, size: int = 0, duration: Optional[float] = None):
+        self.samples.append([round(time.time(), 3), ok, round(latency, 4), size, round(duration or latency, 4)])
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+
+    @property
+    def last_failure(self) -> Optional[float]:
+        for sample in reversed(self.samples):
+            if not sample[1]:
+                return sample[0]
+        return None
+
+    @property
+    def error_rate(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return sum(1 for sample in self.samples if not sample[1]) / len(self.samples)
+
+    def stats(self) -> Dict[str, Any]:
+        successes = [sample for sample in self.samples if sample[1]]
+        latencies = [sample[2] for sample in successes]
+        total_bytes = sum(sample[3] for sample in successes)
+        total_time = sum(sample[4] for sample in successes)
+        error_rate = self.error_rate
+        return {
+            "requests": len(self.samples),
+            "errors": len(self.samples) - len(successes),
+            "error_rate": round(error_rate, 3) if error_rate is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "bytes_per_second": round(total_bytes / total_time) if total_time else None,
+        }
+
+
+class HealthTracker:
+    """
+    Health of the TTS providers, from a rolling window of their last requests.
+
+    A provider is degraded after max_consecutive_failures failures in a row, or when more than
+    max_error_rate of its last requests (at least min_samples) failed. It stays degraded for
+    cooldown seconds after its last failure, then the next request probes it again.
+
+    Args:
+        window: Number of requests kept per provider and per model
+        max_error_rate: Error rate above which a provider is degraded
+        max_consecutive_failures: Failures in a row after which a provider is degraded
+        min_samples: Requests needed before the error rate is taken into account
+        cooldown: Seconds a degraded provider is avoided after its last failure
+    """
+
+    def __init__(self, window: int = 50, max_error_rate: float = 0.5, max_consecutive_failures: int = 3,
+                 min_samples: int = 5, cooldown: float = 30.0):
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.max_consecutive_failures = max_consecutive_failures
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._providers: Dict[str, RequestWindow] = {}
+        self._models: Dict[str, Dict[str, RequestWindow]] = {}
+
+    def record(self, provider: str, model: Optional[str], ok: bool, latency: float, size: int = 0,
+               duration: Optional[float] = None):
+        """Record the outcome of one request to a provider."""
+        with self._lock:
+            if provider not in self._providers:
+                self._providers[provider] = RequestWindow(self.window)
+                self._models[provider] = {}
+            models = self._models[provider]
+            model = model or "default"
+            if model not in models:
+                models[model] = RequestWindow(self.window)
+            self._providers[provider].record(ok, latency, size, duration)
+            models[model].record(ok, latency, size, duration)
+
+    def is_healthy(self, provider: str) -> bool:
+        """Whether requests should go to a provider, unknown providers are presumed healthy."""
+        with self._lock:
+            requests = self._providers.get(provider)
+            if requests is None:
+                return True
+            last_failure = requests.last_failure
+            if last_failure is None or time.time() - last_failure >= self.cooldown:
+                return True
+            if requests.consecutive_failures >= self.max_consecutive_failures:
+                return False
+            return len(requests.samples) < self.min_samples or requests.error_rate <= self.max_error_rate
+
+    def rank(self, providers: List[str]) -> List[str]:
+        """Order providers from the healthiest: lowest error rate first, then lowest p95 latency."""
+        def score(provider):
+            with self._lock:
+                requests = self._providers.get(provider)
+                stats = requests.stats() if requests is not None else {}
+            return (
+                not self.is_healthy(provider),
+                stats.get("error_rate") or 0.0,
+                stats.get("p95") or 0.0,
+            )
+
+        return sorted(providers, key=score)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Rolling statistics of every provider, with a breakdown per model."""
+        with self._lock:
+            providers = {
+                provider: dict(requests.stats(), models={
+                    model: model_requests.stats() for model, model_requests in self._models[provider].items()
+                })
+                for provider, requests in self._providers.items()
+            }
+        for provider, stats in providers.items():
+            stats["healthy"] = self.is_healthy(provider)
+        return providers
+
+    def save(self, health_file: Path):
+        """Save the request samples, so the next run knows which providers were degraded."""
+        with self._lock:
+            data = {
+                provider: {model: list(requests.samples) for model, requests in models.items()}
+                for provider, models in self._models.items()
+            }
+        try:
+            utils.write_atomically(health_file, json.dumps(data))
+        except OSError as e:
+            logging.warning("Failed to save TTS provider health: %s", e)
+
+    def load(self, health_file: Path):
+        """Restore the request samples saved by a previous run, if any."""
+        try:
+            with open(health_file, "r", encoding="utf8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable TTS provider health %s: %s", health_file, e)
+            return
+        with self._lock:
+            for provider, models in data.items():
+                self._models[provider] = {
+                    model: RequestWindow(self.window, samples) for model, samples in models.items()
+                }
+                # The provider window interleaves its models' samples in time order.
+                samples = sorted(sample for model_samples in models.values() for sample in model_samples)
+                self._providers[provider] = RequestWindow(self.window, samples[-self.window:])
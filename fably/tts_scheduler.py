@@ -0,0 +1,282 @@
+"""
+TTS Request Scheduler
+
+Every provider call made by TTSService goes through a scheduler that enforces, per provider:
+
+- a concurrency cap, matching the number of concurrent requests allowed by the plan,
+- a token bucket limiting the request rate,
+- retries with jittered exponential backoff for throttling (429), server errors (5xx) and
+  network errors, honouring the Retry-After header when the provider sends one. A provider
+  asking to wait longer than the backoff cap fails the request right away instead, so that
+  the TTS service can fall back to another provider.
+
+This way a single throttled request slows a story down instead of killing it, even when the
+device, the web interface and batch jobs share one account.
+"""
+
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fably import tracing
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class TTSProviderError(Exception):
+    """Error response from a TTS provider, with what's needed to decide whether to retry."""
+
+    def __init__(self, provider: str, status: int, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"{provider} API error: {status} - {message}")
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_STATUS
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header, given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter that can be shared by several event loops and threads.
+
+    A request that finds the bucket empty reserves its token anyway and sleeps until the
+    bucket has refilled, so waiting requests are served in order.
+
+    Args:
+        rate: Tokens added per second
+        capacity: Maximum number of tokens, i.e. the allowed burst
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def refund(self, tokens: float = 1.0):
+        """Give back tokens taken for a request that was never sent."""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        """Take tokens from the bucket, waiting if needed. Returns the time waited."""
+        delay = self._reserve(tokens)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # Cancelled before it was sent, the requests queued behind it shouldn't wait for its token.
+                self.refund(tokens)
+                raise
+        return delay
+
+
+class ProviderPolicy:
+    """
+    Limits and retry settings of one provider.
+
+    Args:
+        max_concurrency: Maximum number of requests in flight (0 for no limit)
+        rate_limit: Maximum requests per minute (0 for no limit)
+        burst: Requests allowed in a burst by the rate limit (defaults to max_concurrency)
+        max_retries: Retries after the first attempt
+        base_delay: First backoff delay in seconds, doubled on every retry
+        max_delay: Cap of the backoff delay in seconds
+    """
+
+    def __init__(self, max_concurrency: int = 3, rate_limit: float = 0, burst: Optional[int] = None,
+                 max_retries: int = 3, base_delay: float = 0.5, max_delay: float = 20.0):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(rate_limit / 60.0, burst or max(1, max_concurrency)) if rate_limit else None
+        # asyncio primitives belong to one event loop, so each loop gets its own semaphore.
+        self._semaphores = weakref.WeakKeyDictionary()
+        self.stats = {
+            "requests": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "throttled": 0,
+            "in_flight": 0,
+            "rate_wait": 0.0,
+            "backoff_wait": 0.0,
+        }
+
+    def semaphore(self) -> Optional[asyncio.Semaphore]:
+        if not self.max_concurrency:
+            return None
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        Delay before the next attempt: what the provider asked for, or full-jitter exponential backoff.
+        None if the provider asked to wait longer than max_delay.
+        """
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            return retry_after + random.uniform(0, min(1.0, 0.1 * retry_after + 0.1))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def is_transport_error(error: BaseException) -> bool:
+    """Whether a provider call failed on the way: timeouts, broken connections and truncated responses."""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed provider call is worth retrying."""
+    if isinstance(error, TTSProviderError):
+        return error.retryable
+    return is_transport_error(error)
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """
+    Whether a failed provider call says something about the provider's health: transport errors,
+    throttling and server errors. A rejected request (bad key, unknown voice, invalid text) doesn't.
+    """
+    if isinstance(error, TTSProviderError):
+        return error.status == 429 or error.status >= 500
+    return is_transport_error(error)
+
+
+class TTSScheduler:
+    """Runs provider calls under each provider's concurrency cap, rate limit and retry policy."""
+
+    def __init__(self):
+        self.default_policy_args: Dict[str, Any] = {}
+        self.policies: Dict[str, ProviderPolicy] = {}
+
+    def configure(self, provider: Optional[str] = None, **policy_args):
+        """
+        Set the policy of a provider, or the default policy of all providers when provider is None.
+        Accepts the arguments of ProviderPolicy.
+        """
+        if provider is None:
+            self.default_policy_args = dict(policy_args)
+            self.policies.clear()
+        else:
+            self.policies[provider] = ProviderPolicy(**{**self.default_policy_args, **policy_args})
+
+    def policy(self, provider: str) -> ProviderPolicy:
+        if provider not in self.policies:
+            self.policies[provider] = ProviderPolicy(**self.default_policy_args)
+        return self.policies[provider]
+
+    async def run(self, provider: str, call: Callable[[], Awaitable[Any]], hold: bool = False) -> Any:
+        """
+        Run a provider call, waiting for a slot and retrying transient failures.
+
+        With hold, a successful call keeps its slot: the result comes with a function that
+        releases it, to be called once a stream opened by the call is done downloading.
+        """
+        policy = self.policy(provider)
+        stats = policy.stats
+        attempt = 0
+        while True:
+            semaphore = policy.semaphore()
+            if semaphore is not None:
+                await semaphore.acquire()
+            held = False
+            try:
+                if policy.bucket is not None:
+                    stats["rate_wait"] += await policy.bucket.acquire()
+                stats["requests"] += 1
+                stats["in_flight"] += 1
+                try:
+                    result = await call()
+                except BaseException:
+                    stats["in_flight"] -= 1
+                    raise
+                stats["successes"] += 1
+                if not hold:
+                    stats["in_flight"] -= 1
+                    return result
+                held = True
+                return result, self._releaser(stats, semaphore)
+            except Exception as e:
+                if isinstance(e, TTSProviderError) and e.status == 429:
+                    stats["throttled"] += 1
+                if attempt >= policy.max_retries or not is_retryable(e):
+                    stats["failures"] += 1
+                    raise
+                error = e
+            finally:
+                if semaphore is not None and not held:
+                    semaphore.release()
+
+            # Back off without holding a slot, so other requests can go ahead meanwhile.
+            delay = policy.backoff(attempt, getattr(error, "retry_after", None))
+            if delay is None:
+                logging.warning("TTS provider %s asked to retry in %.0fs, giving up on it", provider, error.retry_after)
+                stats["failures"] += 1
+                raise error
+            attempt += 1
+            stats["retries"] += 1
+            stats["backoff_wait"] += delay
+            logging.warning("TTS request to %s failed (%s), retry %i/%i in %.1fs", provider, error, attempt, policy.max_retries, delay)
+            tracing.mark("tts.retry", "tts", provider=provider, attempt=attempt, delay=round(delay, 3))
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _releaser(stats: Dict[str, Any], semaphore: Optional[asyncio.Semaphore]) -> Callable[[], None]:
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                stats["in_flight"] -= 1
+                if semaphore is not None:
+                    semaphore.release()
+        return release
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the request, retry and wait counters of every provider."""
+        return {
+            provider: {key: round(value, 4) if isinstance(value, float) else value for key, value in policy.stats.items()}
+            for provider, policy in self.policies.items()
+        }
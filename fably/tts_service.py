@@ -7,18 +7,35 @@ while maintaining consistent functionality.
 """
 
 import asyncio
+import collections
+import contextlib
 import logging
+import os
+import time
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
 
 import requests
 import soundfile as sf
 
+from fably import tracing
+from fably import utils
+from fably.audio_formats import WAV_HEADER_SIZE, pcm_to_wav, seal_wav_header, transcode, wav_stream_header
+from fably.audio_stitching import sniff_format, stitch_audio
+from fably.text_segmenter import split_text
+from fably.tts_cache import TTSCache
+from fably.tts_health import HealthTracker
+from fably.tts_scheduler import TTSProviderError, TTSScheduler, is_provider_failure, parse_retry_after
+from fably.voice_catalog import VoiceCatalog
+
 
 class TTSProvider(ABC):
     """Abstract base class for TTS providers."""
     
+    # Whether the provider accepts any voice, e.g. a server that always uses its own speaker.
+    serves_any_voice = False
+    
     @abstractmethod
     async def synthesize(self, text: str, voice: str, **kwargs) -> bytes:
         """Synthesize speech from text and return audio data."""
@@ -33,6 +50,124 @@ class TTSProvider(ABC):
     def get_supported_formats(self) -> List[str]:
         """Get list of supported audio formats."""
         pass
+    
+    async def fetch_voices(self, etag: Optional[str] = None,
+                           last_modified: Optional[str] = None) -> Tuple[Optional[List[Dict[str, str]]], Dict[str, str]]:
+        """
+        Fetch the voices from the provider for the voice catalog, raising on failure.
+        Providers with HTTP validators return None as voices when they didn't change since
+        the given etag / last_modified, along with the validators of the answer.
+        """
+        return await self.get_available_voices(), {}
+    
+    async def synthesize_stream(self, text: str, voice: str, **kwargs) -> AsyncIterator[bytes]:
+        """
+        Synthesize speech and yield the audio in chunks as it arrives.
+        Providers without a streaming endpoint yield the whole audio as one chunk.
+        """
+        yield await self.synthesize(text, voice, **kwargs)
+    
+    def negotiate_format(self, sample_rate: Optional[int] = None) -> Tuple[str, Optional[int]]:
+        """
+        Pick the format (and sample rate, None for the provider's own) to request for a playback
+        device running at sample_rate: uncompressed audio when the provider offers it, so the
+        device has nothing to decode.
+        """
+        formats = self.get_supported_formats()
+        return ("wav" if "wav" in formats else formats[0]), None
+    
+    def get_character_limit(self, model: Optional[str] = None) -> Optional[int]:
+        """Get the maximum number of characters per request of a model, None if unknown."""
+        models = getattr(self, "AVAILABLE_MODELS", {})
+        info = models.get(model or getattr(self, "default_model", None))
+        return info.get("character_limit") if info else None
+    
+    async def warmup(self):
+        """Prepare the provider for the first request (e.g. open connections). Optional."""
+        pass
+    
+    async def close(self):
+        """Release the provider's resources (e.g. pooled connections). Optional."""
+        pass
+
+
+class ProviderSession:
+    """
+    Long-lived aiohttp session of an HTTP based TTS provider.
+
+    The session is created lazily on first use, keeps connections alive between requests and
+    caches DNS lookups, so only the first request of a provider pays for the DNS, TCP and TLS
+    handshakes. Connections belong to the event loop that opened them, so each loop gets its
+    own session; close() must be awaited before a loop ends (Fably's runtime does it on shutdown).
+    
+    Args:
+        base_url: Base URL of the provider, used to pre-connect
+        headers: Headers sent with every request
+        limit: Maximum number of pooled connections
+        dns_ttl: Seconds to cache DNS lookups
+        keepalive: Seconds to keep idle connections open
+        connect_timeout: Seconds allowed to establish a connection
+        read_timeout: Seconds allowed between two reads of a response
+    """
+    
+    def __init__(self, base_url: str, headers: Optional[Dict[str, str]] = None, limit: int = 8,
+                 dns_ttl: int = 300, keepalive: float = 60.0, connect_timeout: float = 5.0,
+                 read_timeout: float = 60.0):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.limit = limit
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Sessions by the event loop they were created on.
+        self._sessions = {}
+    
+    async def get(self):
+        """Get the session of the running event loop, creating it if needed."""
+        import aiohttp
+        
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is not None and not session.closed:
+            return session
+        for other in [other for other in self._sessions if other.is_closed()]:
+            if not self._sessions.pop(other).closed:
+                logging.warning("The HTTP session for %s was not closed before its event loop ended", self.base_url)
+        
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=self.connect_timeout,
+            sock_connect=self.connect_timeout,
+            sock_read=self.read_timeout,
+        )
+        session = self._sessions[loop] = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers)
+        return session
+    
+    async def preconnect(self):
+        """Open a pooled connection to the provider ahead of the first real request."""
+        session = await self.get()
+        async with session.head(self.base_url, allow_redirects=False) as response:
+            logging.debug(f"Pre-connected to %s (HTTP %s)" % (self.base_url, response.status))
+    
+    async def close(self):
+        """Close the sessions and their pooled connections, each on the event loop it belongs to."""
+        loop = asyncio.get_running_loop()
+        sessions, self._sessions = self._sessions, {}
+        for owner, session in sessions.items():
+            if session.closed:
+                continue
+            if owner is loop:
+                await session.close()
+            elif owner.is_running():
+                await asyncio.wait_for(asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), owner)), 5)
+            else:
+                logging.warning("The HTTP session for %s was not closed before its event loop ended", self.base_url)
 
 
 class ElevenLabsTTSProvider(TTSProvider):
@@ -72,23 +207,29 @@ class ElevenLabsTTSProvider(TTSProvider):
         }
     }
     
-    SUPPORTED_FORMATS = ["mp3", "wav", "flac", "ogg"]
+    SUPPORTED_FORMATS = ["mp3", "wav", "pcm", "flac", "ogg"]
+    
+    # Sample rates of the raw PCM output formats (pcm_<rate>), WAV is made by adding a header.
+    PCM_SAMPLE_RATES = [16000, 22050, 24000, 44100]
+    DEFAULT_PCM_SAMPLE_RATE = 24000
+    # pcm_44100 is only available on the Pro plan and up, other plans get a 403 for it.
+    MAX_PCM_SAMPLE_RATE = 24000
     
-    def __init__(self, api_key: str, base_url: str = "https://api.elevenlabs.io"):
+    def __init__(self, api_key: str, base_url: str = "https://api.elevenlabs.io",
+                 max_pcm_sample_rate: int = MAX_PCM_SAMPLE_RATE):
         self.api_key = api_key
+        self.max_pcm_sample_rate = max_pcm_sample_rate
         self.base_url = base_url.rstrip("/")
         self.headers = {
             "Accept": "audio/mpeg",
             "Content-Type": "application/json",
             "xi-api-key": api_key
         }
+        self.session = ProviderSession(self.base_url, headers=self.headers)
         self._voice_cache = None
         self.default_model = "eleven_multilingual_v2"  # Updated from eleven_monolingual_v1
     
-    async def synthesize(self, text: str, voice: str, **kwargs) -> bytes:
-        """Synthesize speech using ElevenLabs API."""
-        url = f"{self.base_url}/v1/text-to-speech/{voice}"
-        
+    def _request_body(self, text: str, kwargs: Dict) -> Dict:
         # ElevenLabs voice settings
         voice_settings = kwargs.get("voice_settings", {
             "stability": 0.5,
@@ -102,52 +243,309 @@ class ElevenLabsTTSProvider(TTSProvider):
             "model_id": kwargs.get("model", self.default_model),  # Use updated default
             "voice_settings": voice_settings
         }
+        # Text around a chunk of a longer paragraph keeps the intonation continuous across chunks.
+        for context_key in ("previous_text", "next_text"):
+            if kwargs.get(context_key):
+                data[context_key] = kwargs[context_key]
+        return data
+    
+    def _pcm_sample_rate(self, sample_rate: Optional[int]) -> int:
+        # The requested rate if offered (and allowed by the plan), else the highest one below it,
+        # which the device upsamples.
+        if not sample_rate:
+            return self.DEFAULT_PCM_SAMPLE_RATE
+        allowed = [rate for rate in self.PCM_SAMPLE_RATES if rate <= self.max_pcm_sample_rate]
+        lower = [rate for rate in allowed if rate <= sample_rate]
+        return max(lower) if lower else min(allowed)
+    
+    def _output_params(self, kwargs: Dict) -> Tuple[Dict[str, str], Dict[str, str], Optional[int]]:
+        """Query parameters, headers and PCM sample rate of a request for the format in kwargs."""
+        if kwargs.get("format", "mp3") == "mp3":
+            return {}, {"Accept": "audio/mpeg"}, None
+        # Everything but MP3 is made from raw PCM.
+        sample_rate = self._pcm_sample_rate(kwargs.get("sample_rate"))
+        return {"output_format": f"pcm_{sample_rate}"}, {"Accept": "*/*"}, sample_rate
+    
+    def negotiate_format(self, sample_rate: Optional[int] = None) -> Tuple[str, Optional[int]]:
+        """Raw PCM in a WAV container, at the device's rate when ElevenLabs offers it."""
+        return "wav", self._pcm_sample_rate(sample_rate)
+    
+    async def _raise_for_status(self, response):
+        if response.status != 200:
+            error_text = await response.text()
+            raise TTSProviderError(
+                "ElevenLabs", response.status, error_text,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            )
+    
+    async def synthesize(self, text: str, voice: str, **kwargs) -> bytes:
+        """Synthesize speech using ElevenLabs API."""
+        url = f"{self.base_url}/v1/text-to-speech/{voice}"
         
-        # Use aiohttp for async requests
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=data, headers=self.headers) as response:
-                if response.status == 200:
-                    return await response.read()
-                else:
-                    error_text = await response.text()
-                    raise Exception(f"ElevenLabs API error: %s - %s" % (response.status, error_text))
+        params, headers, sample_rate = self._output_params(kwargs)
+        
+        session = await self.session.get()
+        async with session.post(url, json=self._request_body(text, kwargs), params=params, headers=headers) as response:
+            try:
+                await self._raise_for_status(response)
+                audio_data = await response.read()
+            except asyncio.CancelledError:
+                # Drop the connection instead of reading the rest of the audio nobody will hear.
+                response.close()
+                raise
+        
+        audio_format = kwargs.get("format", "mp3")
+        if audio_format in ("mp3", "pcm"):
+            return audio_data
+        audio_data = pcm_to_wav(audio_data, sample_rate)
+        if audio_format == "wav":
+            return audio_data
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, transcode, audio_data, audio_format)
+    
+    async def synthesize_stream(self, text: str, voice: str, **kwargs) -> AsyncIterator[bytes]:
+        """
+        Synthesize speech using the ElevenLabs streaming endpoint, yielding audio as it is generated.
+        WAV comes with a header for a stream of unknown length, formats that need transcoding come whole.
+        """
+        audio_format = kwargs.get("format", "mp3")
+        if audio_format not in ("mp3", "pcm", "wav"):
+            yield await self.synthesize(text, voice, **kwargs)
+            return
+        url = f"{self.base_url}/v1/text-to-speech/{voice}/stream"
+        params, headers, sample_rate = self._output_params(kwargs)
+        
+        session = await self.session.get()
+        async with session.post(url, json=self._request_body(text, kwargs), params=params, headers=headers) as response:
+            try:
+                await self._raise_for_status(response)
+                if audio_format == "wav":
+                    yield wav_stream_header(sample_rate)
+                async for chunk in response.content.iter_any():
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                # Same as above: an abandoned stream must not keep downloading.
+                response.close()
+                raise
     
     async def get_available_voices(self) -> List[Dict[str, str]]:
         """Get ElevenLabs available voices with metadata."""
         if self._voice_cache:
             return self._voice_cache
         
+        try:
+            voices, _ = await self.fetch_voices()
+        except TTSProviderError as e:
+            logging.warning("Failed to fetch ElevenLabs voices, using empty list: %s", e)
+            return []
+        self._voice_cache = voices
+        return voices
+    
+    async def fetch_voices(self, etag: Optional[str] = None,
+                           last_modified: Optional[str] = None) -> Tuple[Optional[List[Dict[str, str]]], Dict[str, str]]:
+        """Fetch the ElevenLabs voices, conditionally when validators of a previous answer are given."""
         url = f"{self.base_url}/v1/voices"
+        headers = {"Accept": "application/json"}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
         
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=self.headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    voices = []
-                    
-                    for voice in data.get("voices", []):
-                        voices.append({
-                            "id": voice["voice_id"],
-                            "name": voice["name"],
-                            "description": voice.get("description", ""),
-                            "gender": voice.get("labels", {}).get("gender", "unknown"),
-                            "accent": voice.get("labels", {}).get("accent", ""),
-                            "age": voice.get("labels", {}).get("age", ""),
-                            "use_case": voice.get("labels", {}).get("use case", ""),
-                            "provider": "elevenlabs"
-                        })
-                    
-                    self._voice_cache = voices
-                    return voices
-                else:
-                    logging.warning("Failed to fetch ElevenLabs voices, using empty list")
-                    return []
+        session = await self.session.get()
+        async with session.get(url, headers=headers) as response:
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            if response.status == 304:
+                return None, validators
+            await self._raise_for_status(response)
+            data = await response.json()
+        
+        voices = []
+        for voice in data.get("voices", []):
+            voices.append({
+                "id": voice["voice_id"],
+                "name": voice["name"],
+                "description": voice.get("description", ""),
+                "gender": voice.get("labels", {}).get("gender", "unknown"),
+                "accent": voice.get("labels", {}).get("accent", ""),
+                "age": voice.get("labels", {}).get("age", ""),
+                "use_case": voice.get("labels", {}).get("use case", ""),
+                "provider": "elevenlabs"
+            })
+        self._voice_cache = voices
+        return voices, validators
     
     def get_supported_formats(self) -> List[str]:
         """Get ElevenLabs supported audio formats."""
         return self.SUPPORTED_FORMATS
+    
+    async def warmup(self):
+        """Pre-connect to the API so the first paragraph doesn't pay for the handshakes."""
+        await self.session.preconnect()
+    
+    async def close(self):
+        await self.session.close()
+
+
+class OpenAICompatibleTTSProvider(TTSProvider):
+    """
+    Provider for servers implementing OpenAI's /v1/audio/speech endpoint, such as the
+    WhisperSpeech server in servers/tts_server running on the local network.
+    
+    Audio is requested as WAV or raw PCM, which such servers produce without encoding
+    anything. Other formats are transcoded locally, so the audio always matches the format
+    that was asked for, even when the server ignores response_format.
+    """
+    
+    SUPPORTED_FORMATS = ["wav", "pcm"]
+    serves_any_voice = True
+    
+    def __init__(self, base_url: str, api_key: Optional[str] = None, default_model: str = "tts-1",
+                 name: str = "local"):
+        self.base_url = base_url.rstrip("/")
+        if self.base_url.endswith("/v1"):
+            self.base_url = self.base_url[:-3]
+        self.name = name
+        self.default_model = default_model
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        self.session = ProviderSession(self.base_url, headers=headers)
+    
+    def _request_body(self, text: str, voice: str, kwargs) -> Dict:
+        audio_format = kwargs.get("format") or "wav"
+        data = {
+            "model": kwargs.get("model") or self.default_model,
+            "input": text,
+            "voice": voice,
+            "response_format": audio_format if audio_format in self.SUPPORTED_FORMATS else "wav",
+        }
+        if kwargs.get("speed"):
+            data["speed"] = kwargs["speed"]
+        return data
+    
+    async def _raise_for_status(self, response):
+        if response.status != 200:
+            error_text = await response.text()
+            raise TTSProviderError(
+                self.name, response.status, error_text,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            )
+    
+    async def synthesize(self, text: str, voice: str, **kwargs) -> bytes:
+        """Synthesize speech with the server's /v1/audio/speech endpoint."""
+        url = f"{self.base_url}/v1/audio/speech"
+        audio_format = kwargs.get("format") or "wav"
+        
+        session = await self.session.get()
+        async with session.post(url, json=self._request_body(text, voice, kwargs)) as response:
+            try:
+                await self._raise_for_status(response)
+                audio_data = await response.read()
+            except asyncio.CancelledError:
+                response.close()
+                raise
+        
+        if sniff_format(audio_data) == audio_format:
+            return audio_data
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, transcode, audio_data, audio_format)
+    
+    async def synthesize_stream(self, text: str, voice: str, **kwargs) -> AsyncIterator[bytes]:
+        """
+        Synthesize speech with stream_format "audio", yielding each sentence as the server
+        generates it. A streamed WAV starts with a header for a stream of unknown length, which
+        comes as a chunk of its own. Formats that need transcoding come whole.
+        """
+        audio_format = kwargs.get("format") or "wav"
+        if audio_format not in self.SUPPORTED_FORMATS:
+            yield await self.synthesize(text, voice, **kwargs)
+            return
+        url = f"{self.base_url}/v1/audio/speech"
+        data = dict(self._request_body(text, voice, kwargs), stream_format="audio")
+        
+        session = await self.session.get()
+        async with session.post(url, json=data) as response:
+            try:
+                await self._raise_for_status(response)
+                if audio_format == "wav":
+                    # The header must come whole for the saved audio to get its real sizes.
+                    head = b""
+                    while len(head) < WAV_HEADER_SIZE and not response.content.at_eof():
+                        head += await response.content.read(WAV_HEADER_SIZE - len(head))
+                    if sniff_format(head) != "wav":
+                        # A server that ignored response_format, the audio can't be streamed.
+                        audio_data = head + await response.read()
+                        loop = asyncio.get_running_loop()
+                        yield await loop.run_in_executor(None, transcode, audio_data, audio_format)
+                        return
+                    yield head
+                async for chunk in response.content.iter_any():
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                # An abandoned stream must not keep the server generating sentences nobody hears.
+                response.close()
+                raise
+    
+    def _default_voice(self) -> Dict[str, str]:
+        return {
+            "id": "default",
+            "name": "Local Voice",
+            "description": f"Default voice of the TTS server at {self.base_url}",
+            "provider": self.name
+        }
+    
+    async def get_available_voices(self) -> List[Dict[str, str]]:
+        """The voices listed by the server, or just its default voice if it can't be asked."""
+        try:
+            voices, _ = await self.fetch_voices()
+        except Exception as e:
+            logging.warning("Failed to fetch the voices of %s, using its default voice: %s", self.base_url, e)
+            return [self._default_voice()]
+        return voices
+    
+    async def fetch_voices(self, etag: Optional[str] = None,
+                           last_modified: Optional[str] = None) -> Tuple[Optional[List[Dict[str, str]]], Dict[str, str]]:
+        """
+        Fetch the voice presets from the server's /v1/voices endpoint. Servers without it
+        (it isn't part of OpenAI's API) pick the speaker themselves: a single default voice.
+        """
+        url = f"{self.base_url}/v1/voices"
+        session = await self.session.get()
+        async with session.get(url) as response:
+            if response.status in (404, 405):
+                return [self._default_voice()], {}
+            await self._raise_for_status(response)
+            data = await response.json()
+        
+        voices = []
+        for voice in data.get("voices", []):
+            if voice["id"] == "default":
+                voices.append(self._default_voice())
+                continue
+            voices.append({
+                "id": voice["id"],
+                "name": voice.get("name", voice["id"]),
+                "description": f"Voice preset of the TTS server at {self.base_url}",
+                "provider": self.name
+            })
+        return voices, {}
+    
+    def get_supported_formats(self) -> List[str]:
+        """Formats requested from the server, others are transcoded locally."""
+        return self.SUPPORTED_FORMATS
+    
+    def negotiate_format(self, sample_rate: Optional[int] = None) -> Tuple[str, Optional[int]]:
+        """WAV at the server's own rate, the response format is all the API lets us choose."""
+        return "wav", None
+    
+    async def warmup(self):
+        await self.session.preconnect()
+    
+    async def close(self):
+        await self.session.close()
 
 
 class GeminiTTSProvider(TTSProvider):
@@ -198,6 +596,26 @@ class GeminiTTSProvider(TTSProvider):
         return self.SUPPORTED_FORMATS
 
 
+class SynthesisResult:
+    """Outcome of one item of TTSService.synthesize_many()."""
+    
+    def __init__(self, index: int, text: str, voice: str, output_file: Optional[Path]):
+        self.index = index
+        self.text = text
+        self.voice = voice
+        self.output_file = output_file
+        self.audio: Optional[bytes] = None
+        self.error: Optional[Exception] = None
+    
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+    
+    def __repr__(self):
+        status = "ok" if self.ok else f"error={self.error!r}"
+        return f"SynthesisResult(index={self.index}, {status})"
+
+
 class TTSService:
     """Unified TTS service that manages multiple providers."""
     
@@ -206,12 +624,92 @@ class TTSService:
         self.default_provider = "elevenlabs"
         self.default_voice = "nova"
         self.default_format = "mp3"
+        self.cache: Optional[TTSCache] = None
+        self.scheduler = TTSScheduler()
+        self.fallbacks: Dict[str, str] = {}
+        self.voice_catalog: Optional[VoiceCatalog] = None
+        self.health = HealthTracker()
+        self.health_file: Optional[Path] = None
+    
+    def enable_cache(self, cache_dir: Path, max_bytes: int):
+        """Cache synthesized audio on disk, within a byte budget (0 disables the cache)."""
+        self.cache = TTSCache(cache_dir, max_bytes) if max_bytes else None
+        if self.cache is not None:
+            logging.debug(f"TTS cache enabled at %s (%s bytes)" % (cache_dir, max_bytes))
+    
+    def enable_voice_catalog(self, catalog_file: Path, ttl: float):
+        """Keep the voices of all providers in a catalog file, revalidated after ttl seconds."""
+        self.voice_catalog = VoiceCatalog(catalog_file, ttl)
+        logging.debug("Voice catalog at %s (TTL %ss)", catalog_file, ttl)
+    
+    def track_health(self, health_file: Path):
+        """Keep the provider health statistics in a file between runs."""
+        self.health_file = health_file
+        self.health.load(health_file)
     
     def add_provider(self, name: str, provider: TTSProvider):
         """Add a TTS provider."""
         self.providers[name] = provider
         logging.debug(f"Added TTS provider: %s" % name)
     
+    def set_fallback_provider(self, provider_name: str, fallback_name: Optional[str]):
+        """Use another provider when a request to this one fails for good (None removes the fallback)."""
+        if fallback_name is None:
+            self.fallbacks.pop(provider_name, None)
+        elif fallback_name not in self.providers:
+            raise ValueError(f"Provider '{fallback_name}' not found")
+        else:
+            self.fallbacks[provider_name] = fallback_name
+            logging.debug(f"TTS provider %s falls back to %s" % (provider_name, fallback_name))
+    
+    def _fallback_for(self, provider_name: str, voice: str, error: Exception) -> str:
+        """
+        The provider to retry a failed request with, re-raises the error when there is none
+        that can serve the voice.
+        """
+        fallback = self.fallbacks.get(provider_name)
+        if fallback is None or fallback not in self.providers:
+            raise error
+        if not self.can_serve(fallback, voice):
+            logging.debug("TTS provider %s has no voice %s, not falling back to it", fallback, voice)
+            raise error
+        logging.warning(f"TTS synthesis with %s failed (%s), falling back to %s" % (provider_name, str(error), fallback))
+        tracing.mark("tts.fallback", "tts", provider=provider_name, fallback=fallback)
+        return fallback
+    
+    def can_serve(self, provider_name: str, voice: str) -> bool:
+        """Whether a provider has a voice, as far as the voice catalog knows."""
+        provider = self.providers.get(provider_name)
+        if provider is None:
+            return False
+        if provider.serves_any_voice:
+            return True
+        voices = self.voice_catalog.cached_voices(provider_name) if self.voice_catalog is not None else None
+        return voices is not None and any(entry["id"] == voice for entry in voices)
+    
+    def route(self, provider_name: str, voice: str) -> str:
+        """
+        The provider a request for provider_name should go to: provider_name itself while it is
+        healthy, otherwise the healthiest of its fallbacks that can serve the voice, if any is healthy.
+        """
+        if self.health.is_healthy(provider_name):
+            return provider_name
+        candidates = []
+        fallback = self.fallbacks.get(provider_name)
+        while fallback is not None and fallback != provider_name and fallback not in candidates:
+            candidates.append(fallback)
+            fallback = self.fallbacks.get(fallback)
+        candidates = [
+            candidate for candidate in candidates
+            if self.health.is_healthy(candidate) and self.can_serve(candidate, voice)
+        ]
+        if not candidates:
+            return provider_name
+        target = self.health.rank(candidates)[0]
+        logging.info(f"TTS provider %s is degraded, routing to %s" % (provider_name, target))
+        tracing.mark("tts.route", "tts", provider=provider_name, target=target)
+        return target
+    
     def set_default_provider(self, provider_name: str):
         """Set the default TTS provider."""
         if provider_name in self.providers:
@@ -229,11 +727,19 @@ class TTSService:
             voice: Voice ID to use (provider-specific)
             provider: Provider name to use (defaults to default_provider)
             output_file: Path to save audio file
+            cache: Set to False to bypass the audio cache
+            stream: Download the audio from the provider's streaming endpoint straight into output_file
+                    (see synthesize_stream()) instead of buffering it in memory first
             **kwargs: Additional provider-specific parameters
             
         Returns:
             Path to saved audio file if output_file specified, None otherwise
         """
+        if kwargs.pop("stream", False) and output_file is not None:
+            async for _ in self.synthesize_stream(text, voice, provider, output_file, **kwargs):
+                pass
+            return output_file
+
         if text is None:
             raise ValueError("text parameter cannot be None")
         if voice is None:
@@ -247,9 +753,37 @@ class TTSService:
             raise ValueError(f"Provider '{provider_name}' not available")
         
         provider_instance = self.providers[provider_name]
+        use_cache = kwargs.pop("cache", True) and self.cache is not None
         
         try:
-            audio_data = await provider_instance.synthesize(text, voice_id, **kwargs)
+            with tracing.span("tts.synthesize", "tts", provider=provider_name, chars=len(text)) as span_args:
+                audio_data = None
+                if use_cache:
+                    loop = asyncio.get_running_loop()
+                    cache_key = TTSCache.key(
+                        provider_name, voice_id, text,
+                        model=kwargs.get("model"),
+                        voice_settings=kwargs.get("voice_settings"),
+                        format=kwargs.get("format"),
+                        sample_rate=kwargs.get("sample_rate"),
+                    )
+                    audio_data = await loop.run_in_executor(None, self.cache.get, cache_key)
+                    span_args["cached"] = audio_data is not None
+                if audio_data is None:
+                    target = self.route(provider_name, voice_id)
+                    if target == provider_name:
+                        try:
+                            audio_data = await self._synthesize_chunked(provider_name, provider_instance, text, voice_id, kwargs)
+                        except Exception as e:
+                            target = self._fallback_for(provider_name, voice_id, e)
+                    if target != provider_name:
+                        audio_data = await self._synthesize_elsewhere(target, text, voice_id, kwargs)
+                        # Audio from another provider must not be served later as if the requested one had made it.
+                        use_cache = False
+                        span_args["served_by"] = target
+                    if use_cache:
+                        await loop.run_in_executor(None, self.cache.put, cache_key, audio_data)
+                span_args["bytes"] = len(audio_data)
             
             if output_file is not None:
                 # Write audio data to file
@@ -264,31 +798,326 @@ class TTSService:
             logging.error(f"TTS synthesis failed with %s: %s" % (provider_name, str(e)))
             raise
     
-    async def get_all_voices(self) -> Dict[str, List[Dict[str, str]]]:
-        """Get voices from all providers."""
-        all_voices = {}
+    async def synthesize_stream(self, text: str, voice: str, provider: str, output_file: Optional[Path] = None,
+                                **kwargs) -> AsyncIterator[bytes]:
+        """
+        Synthesize speech and yield the audio in chunks as the provider sends it, so playback
+        can start while the rest is still being downloaded.
+        
+        With output_file, the chunks are also written to a temporary file next to it that is
+        renamed into place once the audio is complete, so nobody ever plays a partial file.
+        Opening the stream goes through the scheduler (limits and retries) but a stream that
+        breaks after the first chunk is not retried. Cached audio comes as a single chunk, and so
+        does text over the model's character limit, which has to be split and stitched.
+        
+        Args: as for synthesize()
+        """
+        if text is None:
+            raise ValueError("text parameter cannot be None")
+        if voice is None:
+            raise ValueError("voice parameter cannot be None")
+        if provider is None:
+            raise ValueError("provider parameter cannot be None")
+        if provider not in self.providers:
+            raise ValueError(f"Provider '{provider}' not available")
+        
+        provider_instance = self.providers[provider]
+        use_cache = kwargs.pop("cache", True) and self.cache is not None
+        loop = asyncio.get_running_loop()
         
-        for provider_name, provider in self.providers.items():
+        limit = provider_instance.get_character_limit(kwargs.get("model"))
+        if limit and len(text) > limit:
+            audio_data = await self.synthesize(text, voice, provider, cache=use_cache, **kwargs)
+            if output_file is not None:
+                await loop.run_in_executor(None, utils.write_atomically, output_file, audio_data)
+            yield audio_data
+            return
+        
+        if use_cache:
+            cache_key = TTSCache.key(
+                provider, voice, text,
+                model=kwargs.get("model"),
+                voice_settings=kwargs.get("voice_settings"),
+                format=kwargs.get("format"),
+                sample_rate=kwargs.get("sample_rate"),
+            )
+            audio_data = await loop.run_in_executor(None, self.cache.get, cache_key)
+            if audio_data is not None:
+                tracing.mark("tts.cached", "tts", provider=provider, chars=len(text))
+                if output_file is not None:
+                    await loop.run_in_executor(None, utils.write_atomically, output_file, audio_data)
+                yield audio_data
+                return
+        
+        model = kwargs.get("model")
+        started = first_chunk_latency = None
+        
+        async def open_stream():
+            # The first chunk comes after the provider accepted the request, so errors show up here and can be retried.
+            nonlocal started, first_chunk_latency
+            started = time.monotonic()
+            stream = provider_instance.synthesize_stream(text, voice, **kwargs)
             try:
-                voices = await provider.get_available_voices()
-                all_voices[provider_name] = voices
+                first_chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                first_chunk = b""
+            except BaseException as e:
+                if is_provider_failure(e):
+                    self.health.record(provider, model, False, time.monotonic() - started)
+                await stream.aclose()
+                raise
+            first_chunk_latency = time.monotonic() - started
+            return stream, first_chunk
+        
+        part_file = output_file.with_name(f".{output_file.name}.part") if output_file is not None else None
+        chunks = [] if use_cache else None
+        
+        stream, first_chunk, release = None, b"", None
+        try:
+            with tracing.span("tts.stream", "tts", provider=provider, chars=len(text)) as span_args:
+                target = self.route(provider, voice)
+                if target == provider:
+                    try:
+                        # The provider generates until the download ends, which holds the scheduler slot until then.
+                        (stream, first_chunk), release = await self.scheduler.run(provider, open_stream, hold=True)
+                    except Exception as e:
+                        target = self._fallback_for(provider, voice, e)
+                if target != provider:
+                    # Another provider's audio comes whole and, as in synthesize(), isn't cached.
+                    audio_data = await self._synthesize_elsewhere(target, text, voice, kwargs)
+                    stream, first_chunk, use_cache, chunks = None, audio_data, False, None
+                    span_args["served_by"] = target
+                tracing.mark("tts.first_chunk", "tts", provider=provider)
+                received = 0
+                try:
+                    with open(part_file, "wb") if part_file is not None else contextlib.nullcontext() as f:
+                        
+                        def record(chunk):
+                            nonlocal received
+                            received += len(chunk)
+                            if f is not None:
+                                f.write(chunk)
+                            if chunks is not None:
+                                chunks.append(chunk)
+                            return chunk
+                        
+                        if first_chunk:
+                            yield record(first_chunk)
+                        if stream is not None:
+                            async for chunk in stream:
+                                yield record(chunk)
+                        
+                        # A WAV stream starts with a header for an unknown length, the saved audio gets the real one.
+                        header = seal_wav_header(first_chunk[:WAV_HEADER_SIZE], received)
+                        if header is not None:
+                            if f is not None:
+                                f.seek(0)
+                                f.write(header)
+                            if chunks is not None:
+                                chunks[0] = header + chunks[0][WAV_HEADER_SIZE:]
+                finally:
+                    if stream is not None:
+                        await stream.aclose()
+                    if release is not None:
+                        release()
+                if stream is not None:
+                    self.health.record(provider, model, True, first_chunk_latency, received, time.monotonic() - started)
+                span_args["bytes"] = received
+            
+            if part_file is not None:
+                os.replace(part_file, output_file)
+                logging.debug(f"Audio streamed to %s" % output_file)
+            if use_cache:
+                await loop.run_in_executor(None, self.cache.put, cache_key, b"".join(chunks))
+        
+        except BaseException as e:
+            if part_file is not None and part_file.exists():
+                part_file.unlink()
+            if isinstance(e, Exception):
+                logging.error(f"TTS streaming failed with %s: %s" % (provider, str(e)))
+            raise
+    
+    async def synthesize_many(self, items: Iterable[Tuple[str, str, Optional[Path]]], provider: Optional[str] = None,
+                              concurrency: int = 4, **kwargs) -> AsyncIterator[SynthesisResult]:
+        """
+        Synthesize many texts concurrently, e.g. to re-render a whole story with another voice.
+        
+        Up to `concurrency` items are in flight at once (the provider's own limits still apply),
+        and results are yielded in submission order as soon as each one and those before it are done.
+        A failed item is reported in its result and doesn't stop the batch.
+        
+        Args:
+            items: (text, voice, output_file) tuples, output_file may be None to get the audio bytes back
+            provider: Provider name to use (defaults to default_provider)
+            concurrency: Maximum number of items synthesized at the same time
+            **kwargs: Parameters passed to synthesize() for every item
+        """
+        provider = provider or self.default_provider
+        items = iter(enumerate(items))
+        in_flight = collections.deque()
+        
+        async def run(result: SynthesisResult) -> SynthesisResult:
+            try:
+                audio = await self.synthesize(result.text, result.voice, provider, result.output_file, **kwargs)
+                result.audio = audio if result.output_file is None else None
+            except Exception as e:
+                result.error = e
+            return result
+        
+        def submit_next() -> bool:
+            item = next(items, None)
+            if item is None:
+                return False
+            index, (text, voice, output_file) = item
+            in_flight.append(asyncio.ensure_future(run(SynthesisResult(index, text, voice, output_file))))
+            return True
+        
+        try:
+            while len(in_flight) < max(1, concurrency) and submit_next():
+                pass
+            while in_flight:
+                result = await in_flight.popleft()
+                submit_next()
+                yield result
+        finally:
+            # The caller stopped iterating (or was cancelled): drop the work nobody will collect.
+            for task in in_flight:
+                task.cancel()
+    
+    async def _request(self, provider_name: str, model: Optional[str], call) -> bytes:
+        """
+        Run a provider call through the scheduler, recording the outcome of every attempt in the provider
+        health. Requests the provider rejected (4xx but 429) are not held against it.
+        """
+        async def attempt():
+            started = time.monotonic()
+            try:
+                audio_data = await call()
             except Exception as e:
-                logging.warning(f"Failed to get voices from %s: %s" % (provider_name, str(e)))
-                all_voices[provider_name] = []
+                if is_provider_failure(e):
+                    self.health.record(provider_name, model, False, time.monotonic() - started)
+                raise
+            self.health.record(provider_name, model, True, time.monotonic() - started, len(audio_data))
+            return audio_data
+        
+        return await self.scheduler.run(provider_name, attempt)
+    
+    async def _synthesize_elsewhere(self, provider_name: str, text: str, voice_id: str, kwargs: Dict) -> bytes:
+        """Synthesize with another provider than requested, without the model that only means something to the requested one."""
+        other_kwargs = {key: value for key, value in kwargs.items() if key != "model"}
+        return await self._synthesize_chunked(provider_name, self.providers[provider_name], text, voice_id, other_kwargs)
+    
+    async def _synthesize_chunked(self, provider_name: str, provider_instance: TTSProvider, text: str,
+                                  voice_id: str, kwargs: Dict) -> bytes:
+        """
+        Synthesize text that may exceed the model's character limit: it is split at sentence
+        boundaries into pieces under the limit, which are synthesized concurrently and stitched.
+        """
+        limit = provider_instance.get_character_limit(kwargs.get("model"))
+        pieces = split_text(text, limit) if limit else [text]
+        model = kwargs.get("model")
+        if len(pieces) <= 1:
+            return await self._request(provider_name, model, lambda: provider_instance.synthesize(text, voice_id, **kwargs))
+        
+        logging.debug(f"Splitting %i characters into %i requests for %s" % (len(text), len(pieces), provider_name))
+        
+        audio_format = kwargs.get("format")
+        piece_format = audio_format
+        if audio_format == "mp3" and "wav" in provider_instance.get_supported_formats():
+            # Every MP3 carries its encoder's delay and padding, which would play as a gap at each
+            # boundary: the pieces are joined as samples and encoded once instead.
+            piece_format = "wav"
+        
+        def synthesize_piece(index):
+            piece_kwargs = dict(kwargs, format=piece_format)
+            piece_kwargs["previous_text"] = pieces[index - 1] if index > 0 else None
+            piece_kwargs["next_text"] = pieces[index + 1] if index + 1 < len(pieces) else None
+            return self._request(
+                provider_name, model, lambda: provider_instance.synthesize(pieces[index], voice_id, **piece_kwargs)
+            )
+        
+        tasks = [asyncio.ensure_future(synthesize_piece(index)) for index in range(len(pieces))]
+        try:
+            chunks = await asyncio.gather(*tasks)
+        finally:
+            # If one piece failed (or we were cancelled), the others are of no use.
+            for task in tasks:
+                task.cancel()
+        loop = asyncio.get_running_loop()
+        audio_data = await loop.run_in_executor(None, stitch_audio, chunks, piece_format)
+        if piece_format != audio_format:
+            audio_data = await loop.run_in_executor(None, transcode, audio_data, audio_format)
+        return audio_data
+    
+    async def get_all_voices(self, refresh: bool = False) -> Dict[str, List[Dict[str, str]]]:
+        """Get voices from all providers, queried concurrently (see get_voices_by_provider())."""
+        names = list(self.providers.keys())
+        results = await asyncio.gather(
+            *(self.get_voices_by_provider(name, refresh) for name in names), return_exceptions=True
+        )
+        all_voices = {}
+        for provider_name, voices in zip(names, results):
+            if isinstance(voices, Exception):
+                logging.warning("Failed to get voices from %s: %s", provider_name, voices)
+                voices = []
+            all_voices[provider_name] = voices
         
         return all_voices
     
-    async def get_voices_by_provider(self, provider_name: str) -> List[Dict[str, str]]:
-        """Get voices for a specific provider."""
+    async def get_voices_by_provider(self, provider_name: str, refresh: bool = False) -> List[Dict[str, str]]:
+        """
+        Get voices for a specific provider. With the voice catalog enabled, they come from the
+        catalog unless refresh is set, and the network is only waited on for a provider never seen before.
+        """
         if provider_name not in self.providers:
             raise ValueError(f"Provider '{provider_name}' not available")
         
-        return await self.providers[provider_name].get_available_voices()
+        provider = self.providers[provider_name]
+        if self.voice_catalog is not None:
+            return await self.voice_catalog.voices(provider_name, provider, refresh)
+        return await provider.get_available_voices()
+    
+    async def warmup(self):
+        """
+        Warm up all providers concurrently, e.g. pre-connect to their APIs, and fill the voice
+        catalog so that cycling voices never waits on the network. Failures are only logged.
+        """
+        names = list(self.providers.keys())
+        results = await asyncio.gather(
+            *(self.providers[name].warmup() for name in names), return_exceptions=True
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logging.debug(f"Warm-up of TTS provider %s failed: %s" % (name, result))
+        if self.voice_catalog is not None:
+            await self.get_all_voices()
+    
+    async def close(self):
+        """Close the resources of all providers, e.g. their pooled HTTP sessions."""
+        if self.cache is not None:
+            logging.debug(f"TTS cache stats: %s" % self.cache.stats())
+        logging.debug(f"TTS scheduler stats: %s" % self.scheduler.stats())
+        if self.health_file is not None:
+            self.health.save(self.health_file)
+        for name, provider in self.providers.items():
+            try:
+                await provider.close()
+            except Exception as e:
+                logging.warning(f"Failed to close TTS provider %s: %s" % (name, str(e)))
     
     def get_available_providers(self) -> List[str]:
         """Get list of available provider names."""
         return list(self.providers.keys())
     
+    def negotiate_format(self, provider_name: str = None, sample_rate: Optional[int] = None) -> Tuple[str, Optional[int]]:
+        """Format and sample rate to request from a provider for a device playing at sample_rate."""
+        provider_name = provider_name or self.default_provider
+        
+        if provider_name not in self.providers:
+            raise ValueError(f"Provider '{provider_name}' not available")
+        
+        return self.providers[provider_name].negotiate_format(sample_rate)
+    
     def get_supported_formats(self, provider_name: str = None) -> List[str]:
         """Get supported formats for a provider."""
         provider_name = provider_name or self.default_provider
@@ -306,17 +1135,27 @@ tts_service = TTSService()
 def initialize_tts_service(elevenlabs_key: str = None,
                           gemini_key: str = None,
                           elevenlabs_url: str = "https://api.elevenlabs.io",
-                          gemini_url: str = "https://generativelanguage.googleapis.com/v1beta"):
+                          gemini_url: str = "https://generativelanguage.googleapis.com/v1beta",
+                          local_url: str = None,
+                          elevenlabs_max_sample_rate: int = ElevenLabsTTSProvider.MAX_PCM_SAMPLE_RATE):
     """Initialize the global TTS service with available providers (OpenAI removed)."""
     
     if elevenlabs_key:
         try:
-            elevenlabs_provider = ElevenLabsTTSProvider(elevenlabs_key, elevenlabs_url)
+            elevenlabs_provider = ElevenLabsTTSProvider(elevenlabs_key, elevenlabs_url, elevenlabs_max_sample_rate)
             tts_service.add_provider("elevenlabs", elevenlabs_provider)
             logging.info("ElevenLabs TTS provider initialized")
         except Exception as e:
             logging.warning(f"Failed to initialize ElevenLabs provider: %s" % str(e))
     
+    if local_url:
+        try:
+            local_provider = OpenAICompatibleTTSProvider(local_url)
+            tts_service.add_provider("local", local_provider)
+            logging.info(f"Local TTS provider initialized at %s" % local_url)
+        except Exception as e:
+            logging.warning(f"Failed to initialize local TTS provider: %s" % str(e))
+    
     if gemini_key:
         try:
             gemini_provider = GeminiTTSProvider(gemini_key, gemini_url)
@@ -328,6 +1167,8 @@ def initialize_tts_service(elevenlabs_key: str = None,
     # Set default provider preference (ElevenLabs if available)
     if "elevenlabs" in tts_service.providers:
         tts_service.set_default_provider("elevenlabs")
+    elif "local" in tts_service.providers:
+        tts_service.set_default_provider("local")
     elif "gemini" in tts_service.providers:
         tts_service.set_default_provider("gemini")
     else:
@@ -11,7 +11,9 @@ import time
 import colorsys
 import zipfile
 import queue
+import subprocess
 import sys
+import threading
 
 from pathlib import Path, PurePosixPath
 
@@ -42,6 +44,11 @@ MAX_FILE_LENGTH = 255
 SOUNDS_PATH = "sounds"
 QUERY_SAMPLE_RATE = 16000
 
+# The external player currently running, so that stop_playback() can kill it from another thread.
+_player_lock = threading.Lock()
+_player_process = None
+_playback_stopped = threading.Event()
+
 
 def rotate_rgb_color(rgb_value, step_size=1):
     """
@@ -238,6 +245,8 @@ def play_audio_file(audio_file, audio_driver="alsa"):
     Enhanced with better error handling for Raspberry Pi, IQaudio Codec Zero, and PortAudio issues.
     """
     logging.debug("Playing audio from %s with %s", audio_file, audio_driver)
+    audio_file = Path(audio_file)
+    _playback_stopped.clear()
     
     # Handle sounddevice unavailability
     if audio_driver == "sounddevice" and not SOUNDDEVICE_AVAILABLE:
@@ -256,41 +265,46 @@ def play_audio_file(audio_file, audio_driver="alsa"):
             if audio_file.suffix == ".mp3":
                 # Try mpg123 first, fallback to other players
                 for player_cmd in [
-                    f"mpg123 -q '{audio_file}'",
-                    f"mpv --no-video --really-quiet '{audio_file}'", 
-                    f"ffplay -nodisp -autoexit '{audio_file}'",
-                    f"mplayer -really-quiet '{audio_file}'"
+                    ["mpg123", "-q", str(audio_file)],
+                    ["mpv", "--no-video", "--really-quiet", str(audio_file)],
+                    ["ffplay", "-nodisp", "-autoexit", str(audio_file)],
+                    ["mplayer", "-really-quiet", str(audio_file)]
                 ]:
-                    result = os.system(f"{player_cmd} 2>/dev/null")
-                    if result == 0:
+                    result = _run_player(player_cmd)
+                    if result == 0 or _playback_stopped.is_set():
                         success = True
                         break
             else:
                 # Try aplay with various configurations including IQaudio Codec Zero
                 # User tested: plughw:0,0 works for IQaudio Codec Zero on Pi Zero 2W
                 device_attempts = [
-                    f"aplay -D plughw:0,0 '{audio_file}'",                   # WORKING: User tested IQaudio Codec Zero
-                    f"aplay -q '{audio_file}'",                              # Default (.asoundrc config)
-                    f"aplay -D hw:0,0 '{audio_file}'",                       # First hardware device
-                    f"aplay -D iqaudio_playback '{audio_file}'",             # IQaudio Codec Zero optimized
-                    f"aplay -D hw:IQaudIOCODEC,0 '{audio_file}'",            # IQaudio direct hardware
-                    f"aplay -D plug:default '{audio_file}'",                 # Plug interface with conversion
-                    f"aplay -D hw:1,0 '{audio_file}'",                       # Second hardware device
-                    f"aplay -D default:CARD=IQaudIOCODEC '{audio_file}'",    # IQaudio card default
-                    f"aplay -D plughw:IQaudIOCODEC,0 '{audio_file}'",        # IQaudio with format conversion
-                    f"aplay -D iqaudio_simple '{audio_file}'",               # Simple fallback config
-                    f"aplay -D default '{audio_file}'"                       # System default
+                    ["aplay", "-D", "plughw:0,0"],                   # WORKING: User tested IQaudio Codec Zero
+                    ["aplay", "-q"],                                 # Default (.asoundrc config)
+                    ["aplay", "-D", "hw:0,0"],                       # First hardware device
+                    ["aplay", "-D", "iqaudio_playback"],             # IQaudio Codec Zero optimized
+                    ["aplay", "-D", "hw:IQaudIOCODEC,0"],            # IQaudio direct hardware
+                    ["aplay", "-D", "plug:default"],                 # Plug interface with conversion
+                    ["aplay", "-D", "hw:1,0"],                       # Second hardware device
+                    ["aplay", "-D", "default:CARD=IQaudIOCODEC"],    # IQaudio card default
+                    ["aplay", "-D", "plughw:IQaudIOCODEC,0"],        # IQaudio with format conversion
+                    ["aplay", "-D", "iqaudio_simple"],               # Simple fallback config
+                    ["aplay", "-D", "default"]                       # System default
                 ]
                 
                 for cmd in device_attempts:
-                    logging.debug(f"Trying: %s", cmd)
-                    result = os.system(f"{cmd} 2>/dev/null")
+                    cmd = cmd + [str(audio_file)]
+                    logging.debug(f"Trying: %s", " ".join(cmd))
+                    result = _run_player(cmd)
                     if result == 0:
-                        logging.debug(f"Success with: %s", cmd)
+                        logging.debug(f"Success with: %s", " ".join(cmd))
+                        success = True
+                        break
+                    elif _playback_stopped.is_set():
+                        logging.debug("Playback stopped: %s", " ".join(cmd))
                         success = True
                         break
                     else:
-                        logging.debug(f"Failed with exit code %i: %s", result, cmd)
+                        logging.debug(f"Failed with exit code %i: %s", result, " ".join(cmd))
                 
                 # If ALSA failed completely and sounddevice is available, try it
                 if not success and SOUNDDEVICE_AVAILABLE:
@@ -327,6 +341,40 @@ def play_audio_file(audio_file, audio_driver="alsa"):
         raise
 
 
+def _run_player(args):
+    """
+    Run an external audio player and wait for it to exit, returning its exit code.
+    The process is tracked so that stop_playback() can kill it from another thread.
+    """
+    global _player_process
+    with _player_lock:
+        if _playback_stopped.is_set():
+            return -1
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            return 127  # Player not installed
+        _player_process = process
+    try:
+        return process.wait()
+    finally:
+        with _player_lock:
+            if _player_process is process:
+                _player_process = None
+
+
+def stop_playback():
+    """
+    Stop whatever play_audio_file() is currently playing, from any thread.
+    """
+    _playback_stopped.set()
+    with _player_lock:
+        if _player_process is not None and _player_process.poll() is None:
+            _player_process.kill()
+    if SOUNDDEVICE_AVAILABLE:
+        sd.stop()
+
+
 def query_to_filename(query, prefix=""):
     """
     Convert a query from a voice assistant into a file name that can be used to save the story.
@@ -364,6 +412,23 @@ def write_to_file(path, text):
         f.write(text)
 
 
+def write_atomically(path, data):
+    """
+    Write text or bytes to a file at the given path so that readers never see a partial file:
+    the data goes to a temporary file in the same directory which then replaces the target.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    mode, encoding = ("wb", None) if isinstance(data, (bytes, bytearray)) else ("w", "utf8")
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
 def read_from_file(path):
     """
     Read the contents of a file at the given path and return the text.
@@ -663,55 +728,6 @@ def get_next_paragraph_index(story_path):
     return max(indices) + 1 if indices else 0
 
 
-def extract_story_context(story_path, max_paragraphs=None):
-    """
-    Extract the context from an existing story for continuation.
-    
-    Args:
-        story_path: Path to the story directory
-        max_paragraphs: Maximum number of paragraphs to include (None for all)
-        
-    Returns:
-        dict: Story context with 'original_query', 'paragraphs', and 'paragraph_count'
-    """
-    story_path = Path(story_path)
-    context = {
-        'original_query': None,
-        'paragraphs': [],
-        'paragraph_count': 0
-    }
-    
-    if not story_path.exists():
-        return context
-    
-    # Read original query from info.yaml
-    info_file = story_path / "info.yaml"
-    if info_file.exists():
-        try:
-            info_data = read_from_yaml(info_file)
-            context['original_query'] = info_data.get('query', 'Unknown')
-        except Exception as e:
-            logging.warning(f"Failed to read story info from %s: %s", info_file, e)
-    
-    # Read all paragraph files
-    paragraph_files = list(story_path.glob("paragraph_*.txt"))
-    paragraph_files.sort(key=lambda x: int(re.search(r'paragraph_(\d+)', x.name).group(1)))
-    
-    # Limit paragraphs if specified
-    if max_paragraphs:
-        paragraph_files = paragraph_files[:max_paragraphs]
-    
-    for file in paragraph_files:
-        try:
-            content = read_from_file(file)
-            context['paragraphs'].append(content.strip())
-        except Exception as e:
-            logging.warning(f"Failed to read paragraph from %s: %s", file, e)
-    
-    context['paragraph_count'] = len(context['paragraphs'])
-    return context
-
-
 # Audio Quality and Noise Reduction Utilities
 
 
@@ -0,0 +1,116 @@
+"""
+Voice Catalog
+
+Disk-persisted catalog of the voices offered by each TTS provider, so listing or cycling voices
+doesn't go to the network every time:
+
+- Voices younger than the TTL are served straight from the catalog file.
+- Older voices are still served right away while the provider is asked for changes in the
+  background, with the ETag / Last-Modified validators of the previous answer so an unchanged
+  catalog costs a 304 response. The background refresh needs a loop that outlives the caller,
+  Fably's runtime: on any other loop (e.g. one made by asyncio.run) the caller waits for it.
+- Only a provider that was never fetched before makes the caller wait.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from fably import utils
+from fably.runtime import runtime
+
+CATALOG_FILE = "voice_catalog.json"
+
+
+class VoiceCatalog:
+    """
+    Voices of every provider, with the time they were fetched and their HTTP validators.
+
+    Args:
+        catalog_file: JSON file holding the catalog between runs
+        ttl: Seconds after which voices are revalidated with the provider
+    """
+
+    def __init__(self, catalog_file: Path, ttl: float = 24 * 3600):
+        self.catalog_file = Path(catalog_file)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.catalog_file, "r", encoding="utf8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable voice catalog %s: %s", self.catalog_file, e)
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _save(self):
+        # Called with the lock held.
+        try:
+            utils.write_atomically(self.catalog_file, json.dumps(self._entries, indent=2, ensure_ascii=False))
+        except OSError as e:
+            logging.warning("Failed to save the voice catalog: %s", e)
+
+    def cached_voices(self, provider_name: str) -> Optional[List[Dict[str, str]]]:
+        """The voices of a provider known so far, without going to the network. None if never fetched."""
+        entry = self._entries.get(provider_name)
+        return entry["voices"] if entry is not None else None
+
+    def is_fresh(self, provider_name: str) -> bool:
+        entry = self._entries.get(provider_name)
+        return entry is not None and time.time() - entry.get("fetched_at", 0) < self.ttl
+
+    async def voices(self, provider_name: str, provider, refresh: bool = False) -> List[Dict[str, str]]:
+        """
+        Get the voices of a provider, fetching them only if they were never fetched before
+        (or if refresh is set). Stale voices are returned as they are and revalidated in the background.
+        """
+        entry = self._entries.get(provider_name)
+        if entry is not None and not refresh and self.is_fresh(provider_name):
+            return entry["voices"]
+        # Concurrent callers share one request to the provider.
+        task = self._refreshing.get(provider_name)
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self.refresh(provider_name, provider))
+            self._refreshing[provider_name] = task
+        if entry is None or refresh or runtime.loop is not asyncio.get_running_loop():
+            # Shielded so that a caller giving up doesn't cancel the request the others wait on.
+            return await asyncio.shield(task)
+        return entry["voices"]
+
+    async def refresh(self, provider_name: str, provider) -> List[Dict[str, str]]:
+        """Revalidate the voices of a provider. On failure the voices known so far are kept."""
+        entry = self._entries.get(provider_name) or {}
+        try:
+            voices, validators = await provider.fetch_voices(entry.get("etag"), entry.get("last_modified"))
+        except Exception as e:
+            logging.warning("Failed to fetch the voices of %s: %s", provider_name, e)
+            return entry.get("voices", [])
+
+        with self._lock:
+            if voices is None:
+                logging.debug("Voices of %s not modified", provider_name)
+                voices = entry.get("voices", [])
+                validators = {
+                    "etag": validators.get("etag") or entry.get("etag"),
+                    "last_modified": validators.get("last_modified") or entry.get("last_modified"),
+                }
+            else:
+                logging.debug("Fetched %i voices of %s", len(voices), provider_name)
+            self._entries[provider_name] = {
+                "fetched_at": time.time(),
+                "etag": validators.get("etag"),
+                "last_modified": validators.get("last_modified"),
+                "voices": voices,
+            }
+            self._save()
+        return voices
@@ -0,0 +1,228 @@
+"""
+Dynamic request batching for the WhisperSpeech TTS server.
+
+Requests that arrive close together are collected into one batch and run through the t2s and
+s2a models together: every autoregressive step then decodes a token for all of them at once,
+which costs little more than decoding it for one. A batch is closed when it is full, when no
+new request arrived for a window, or when its first request waited the maximum time.
+
+Every batch size is generated once at startup, so that no request pays for compiling the
+models for the size of its batch. A model variant that can't be batched is generated one
+request at a time instead, which is logged and reported by /metrics.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import torch
+import torch.nn.functional as F
+from whisperspeech import inference, languages
+
+
+def generate_stoks(t2s, texts, lang, cpss, T=0.7, top_k=None):
+    """Semantic tokens of several texts, decoded together (like t2s.generate for one text)."""
+    t2s.ensure_tokenizer()
+    dev = t2s.device
+    N = t2s.stoks_len
+    eot = t2s.tokenizer.eot
+    end = t2s.stoks_codes + t2s.tunables.padding_token_offset
+
+    ttoks = []
+    for text in texts:
+        tokens = torch.tensor(t2s.tokenizer.encode(text), device=dev)
+        ttoks.append(F.pad(tokens, (1, t2s.ttoks_len - len(tokens) - 1), value=eot))
+    ttoks = torch.stack(ttoks)
+    langs = torch.tensor([languages.to_id(lang)] * len(texts), device=dev)
+    cpss = torch.tensor(cpss, device=dev)
+    T = torch.tensor(T, device=dev)
+
+    toks = torch.zeros((len(texts), N), dtype=torch.long, device=dev)
+    toks[:, 0] = end
+    toks_positions = torch.arange(N + 1, device=dev)
+    xenc, xenc_positions, cps_emb = t2s.run_encoder(ttoks, langs, cpss)
+    toks[:, 1] = t2s.generate_one(toks[:, :1].contiguous(), toks_positions[:1], cps_emb, xenc, xenc_positions, T, top_k)[:, 0]
+    last = N - 1
+    with inference.inference_context():
+        for i in range(1, N - 1):
+            toks[:, i + 1] = t2s.generate_next(toks[:, i:i + 1], toks_positions[i:i + 1], cps_emb, xenc, xenc_positions, T, top_k)[:, 0]
+            if (toks[:, 1:i + 2] == end).any(dim=1).all():
+                last = i + 1
+                break
+
+    # Each text stops at its own end token, the others kept the batch going.
+    stoks = []
+    for row in toks[:, 1:last + 1]:
+        ends = (row == end).nonzero()
+        stoks.append(row[:ends[0, 0]] if len(ends) else row)
+    return stoks
+
+
+def generate_atoks(s2a, stoks, speakers, T=0.7, top_k=None):
+    """Acoustic tokens of several semantic token sequences, decoded together (like s2a.generate)."""
+    dev = s2a.device
+    lengths = [len(x) * 3 for x in stoks]
+    N = max(lengths)
+    stoks = torch.stack([
+        F.pad(x.to(dev), (1, s2a.stoks_len - len(x) - 1), value=s2a.stoks_codes - 1) for x in stoks
+    ])
+    speakers = torch.stack(speakers).to(device=dev, dtype=s2a.dtype)
+    toks = torch.full((len(stoks), s2a.quantizers, s2a.ctx_n), s2a.codes + 1, dtype=torch.long, device=dev)
+    T = torch.tensor(T, device=dev)
+
+    start = 1
+    xenc, xenc_positions, _ = s2a.run_encoder(stoks, speakers)
+    toks_positions = torch.arange(N, device=dev)
+    initial = s2a.generate_one(toks[:, :, :start], toks_positions[:start], None, xenc, xenc_positions, T, top_k)
+    toks[:, :start, start:start + 1] = initial[:, :start]
+    start += 1
+    with inference.inference_context():
+        for i in range(start, min(N, s2a.ctx_n - 1)):
+            toks[:, :i, i:i + 1] = s2a.generate_next(toks[:, :, i - 1:i], toks_positions[i - 1:i], None, xenc, xenc_positions, T, top_k)[:, :i]
+
+    toks = toks[:, :, 1:N]
+    for j in range(s2a.quantizers):
+        toks[:, j] = torch.roll(toks[:, j], -j)
+    return [row[:, :length - 4] for row, length in zip(toks, lengths)]
+
+
+@torch.inference_mode()
+def generate_batch(pipe, texts, speakers, lang, cpss):
+    """Audio of several texts, generated with one pass of the t2s and s2a models."""
+    texts = [text.replace('\n', ' ') for text in texts]
+    speakers = [pipe.default_speaker if speaker is None else speaker for speaker in speakers]
+    stoks = generate_stoks(pipe.t2s, texts, lang, cpss)
+    atoks = generate_atoks(pipe.s2a, stoks, speakers)
+    return [pipe.vocoder.decode(x) for x in atoks]
+
+
+class Request:
+    """A text waiting in the batcher for its audio (or its error)."""
+
+    def __init__(self, text, speaker, cps):
+        self.text = text
+        self.speaker = speaker
+        self.cps = cps
+        self.done = threading.Event()
+        self.audio = None
+        self.error = None
+
+
+class Batcher:
+    """
+    Collects concurrent requests and generates them in batches on a single model thread.
+
+    Args:
+        pipe: WhisperSpeech pipeline, optimized for at least max_batch_size
+        lang: Language of the requests
+        max_batch_size: Most requests generated together
+        batch_window: Seconds to wait for another request before closing a batch
+        max_wait: Seconds the first request of a batch waits at most for the others
+    """
+
+    def __init__(self, pipe, lang, max_batch_size=4, batch_window=0.02, max_wait=0.1):
+        self.pipe = pipe
+        self.lang = lang
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        # Seconds spent generating, to tell how busy the model is.
+        self.busy_time = 0.0
+        # Cleared when the models turn out not to support batched generation.
+        self.batching = max_batch_size > 1
+        self.thread = threading.Thread(target=self.run, name='tts-batcher', daemon=True)
+        self.thread.start()
+
+    def generate(self, text, speaker=None, cps=15):
+        """Generate the audio of a text, waiting for the batch it was put in."""
+        request = Request(text, speaker, cps)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.audio
+
+    def stop(self):
+        """Let the model thread end, once the requests already queued are generated."""
+        self.requests.put(None)
+
+    def next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = min(self.batch_window, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Stopping: generate this batch, then end.
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def status(self):
+        """What the pool reports of this batcher in /metrics."""
+        return {'busy_time': self.busy_time, 'batching': self.batching}
+
+    def warmup(self, cps=15):
+        """Generate a batch of every size once, before serving, so compiling for a size doesn't delay requests."""
+        for size in range(2, self.max_batch_size + 1):
+            if not self.batching:
+                break
+            started = time.monotonic()
+            self.generate_batch([Request('this is a test', None, cps) for _ in range(size)])
+            logging.info('Warmed up batches of %i in %.1fs', size, time.monotonic() - started)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            started = time.monotonic()
+            try:
+                self.generate_batch(batch)
+            except Exception as e:
+                logging.exception('Failed to generate a batch of %i requests', len(batch))
+                for request in batch:
+                    request.error = e
+            elapsed = time.monotonic() - started
+            self.busy_time += elapsed
+            logging.info('Generated a batch of %i requests in %.2fs', len(batch), elapsed)
+            for request in batch:
+                request.done.set()
+
+    def generate_batch(self, batch):
+        if len(batch) > 1 and self.batching:
+            try:
+                audio = generate_batch(
+                    self.pipe,
+                    [request.text for request in batch],
+                    [request.speaker for request in batch],
+                    self.lang,
+                    [request.cps for request in batch],
+                )
+            except (AttributeError, NotImplementedError, TypeError):
+                # A model variant the batched decoding doesn't handle: it won't get any better, so
+                # stop batching. Errors of the generation itself (e.g. out of memory) fail the batch.
+                logging.exception('Batched generation is not supported by these models, generating requests one by one')
+                self.batching = False
+            else:
+                for request, request_audio in zip(batch, audio):
+                    request.audio = request_audio
+                return
+
+        for request in batch:
+            try:
+                request.audio = self.pipe.generate(request.text, speaker=request.speaker, lang=self.lang, cps=request.cps)
+            except Exception as e:
+                logging.exception('Failed to generate "%s"', request.text)
+                request.error = e
@@ -0,0 +1,56 @@
+"""
+Audio encoding for the responses of the WhisperSpeech TTS server.
+
+Audio is sent as 16 bit mono PCM, raw or in a WAV container, like OpenAI's speech endpoint does.
+A streamed response is generated one sentence at a time: its WAV header is sent before any audio
+exists, with the sizes set to their maximum, which decoders read as "until the end of the data".
+"""
+
+import re
+import struct
+
+SAMPLE_RATE = 24000
+CHANNELS = 1
+SAMPLE_WIDTH = 2
+STREAM_SIZE = 0xFFFFFFFF
+
+# Shorter sentences are joined to the next one, WhisperSpeech mumbles on very short texts.
+MIN_SENTENCE_LENGTH = 20
+
+SENTENCE_END = re.compile(r'(?<=[.!?;:])\s+')
+
+
+def split_sentences(text):
+    """Split a text into the sentences generated one at a time when streaming."""
+    sentences = []
+    pending = ''
+    for sentence in SENTENCE_END.split(text.strip()):
+        pending = f'{pending} {sentence}' if pending else sentence
+        if len(pending) >= MIN_SENTENCE_LENGTH:
+            sentences.append(pending)
+            pending = ''
+    if pending:
+        if sentences:
+            sentences[-1] = f'{sentences[-1]} {pending}'
+        else:
+            sentences.append(pending)
+    return sentences
+
+
+def to_pcm(audio):
+    """16 bit little-endian PCM samples of a generated audio tensor."""
+    samples = (audio.flatten().clamp(-1, 1) * 32767).short()
+    return samples.cpu().numpy().astype('<i2').tobytes()
+
+
+def wav_header(sample_rate, data_size=None):
+    """WAV header of data_size bytes of PCM, or of a stream of unknown length if data_size is None."""
+    byte_rate = sample_rate * CHANNELS * SAMPLE_WIDTH
+    riff_size = STREAM_SIZE if data_size is None else 36 + data_size
+    data_size = STREAM_SIZE if data_size is None else data_size
+    return (
+        b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, CHANNELS, sample_rate, byte_rate,
+                                CHANNELS * SAMPLE_WIDTH, SAMPLE_WIDTH * 8)
+        + b'data' + struct.pack('<I', data_size)
+    )
@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 
-import tempfile
+import logging
+import os
 
 import click
-from flask import Flask, request, jsonify, send_file
-from whisperspeech.pipeline import Pipeline
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+from streaming import SAMPLE_RATE, split_sentences, wav_header
+from workers import NoWorkerError, WorkerPool
+
+COMPILE_CACHE = '~/.cache/fably/tts_server/torch_compile'
+VOICE_CACHE = '~/.cache/fably/tts_server/voices'
+
+MIMETYPES = {
+    'wav': 'audio/wav',
+    'pcm': 'audio/pcm',
+}
 
 app = Flask(__name__)
 
@@ -17,22 +28,62 @@ def speech_handler():
         return jsonify({"error": "Invalid request. 'input' field is required."}), 400
 
     text = data['input']
+    voice = data.get('voice')
+    response_format = data.get('response_format', 'wav')
+    if response_format not in MIMETYPES:
+        return jsonify({"error": f"Unsupported response_format '{response_format}', use wav or pcm."}), 400
 
-    language = app.config['LANGUAGE']
-    model = app.config['TTS_MODEL']
+    pool = app.config['WORKER_POOL']
     speed = app.config['TTS_SPEED']
+    mimetype = MIMETYPES[response_format]
+
+    if data.get('stream_format') == 'audio' or app.config['STREAM']:
+        return Response(stream_with_context(stream_speech(text, voice, response_format, pool, speed)), mimetype=mimetype)
+
+    # Requests go to the least loaded worker, which batches concurrent ones, see workers.py.
+    try:
+        pcm = pool.generate(text, voice=voice, cps=speed)
+    except NoWorkerError as e:
+        return jsonify({"error": str(e)}), 503
+    except TimeoutError as e:
+        return jsonify({"error": str(e)}), 504
+    if response_format == 'wav':
+        pcm = wav_header(SAMPLE_RATE, len(pcm)) + pcm
+
+    return Response(pcm, mimetype=mimetype), 200
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-        tmp_file_path = tmp_file.name
 
-    model.generate_to_file(tmp_file_path, text, speaker=None, lang=language, cps=speed)
+def stream_speech(text, voice, response_format, pool, speed):
+    """Generate the audio one sentence at a time, so the first one plays while the others are generated."""
+    if response_format == 'wav':
+        yield wav_header(SAMPLE_RATE)
+    for sentence in split_sentences(text):
+        try:
+            pcm = pool.generate(sentence, voice=voice, cps=speed)
+        except Exception:
+            # The status is already sent, all that's left is to cut the stream short.
+            logging.exception('Failed to generate "%s", ending the stream', sentence)
+            return
+        yield pcm
 
-    return send_file(tmp_file_path, mimetype='audio/wav'), 200
+
+@app.route('/v1/voices', methods=['GET'])
+def voices_handler():
+    # "default" is the model's own speaker, the others are the presets of --voices_dir.
+    voices = ['default'] + app.config['WORKER_POOL'].voices()
+    return jsonify({"voices": [{"id": voice, "name": voice} for voice in voices]}), 200
 
 
 @app.route('/status', methods=['GET'])
 def status_handler():
-    return jsonify({"status": "Service is up and running"}), 200
+    # Degraded while some workers restart, down (and unavailable) while none is running.
+    health = app.config['WORKER_POOL'].health()
+    return jsonify(health), 503 if health['status'] == 'down' else 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    return jsonify(app.config['WORKER_POOL'].metrics()), 200
 
 
 @click.command()
@@ -41,22 +92,62 @@ def status_handler():
 @click.option('--language', default='en', help='The language to expect.')
 @click.option('--tts_model', default='tiny', help='WhisperSpeech model to use (e.g., tiny, base, small, hq-fast).')
 @click.option('--tts_speed', default=15, help='Characters per second to speak.')
-def main(host, port, language, tts_model, tts_speed):
+@click.option('--max_batch_size', default=4, help='Most requests generated together in one batch.')
+@click.option('--batch_window', default=20, help='Milliseconds to wait for another request before starting a batch.')
+@click.option('--max_batch_wait', default=100, help='Milliseconds a request waits at most for others to join its batch.')
+@click.option('--stream', is_flag=True, help='Stream every response sentence by sentence, not only those asking for stream_format "audio".')
+@click.option('--workers', default=1, help='Worker processes, each with its own copy of the models (0 for one per --threads_per_worker cores).')
+@click.option('--cores', default=os.cpu_count(), help='CPU cores shared by the workers.')
+@click.option('--threads_per_worker', default=4, help='Cores given to each worker when --workers is 0.')
+@click.option('--device', type=click.Choice(['auto', 'cpu', 'cuda', 'mps']), default='auto', help='Device to run the models on.')
+@click.option('--torch_compile/--no-torch_compile', default=True, help='Compile the models, slower to start but faster to generate.')
+@click.option('--quantize', is_flag=True, help='Quantize the models to int8 (CPU only), faster but slightly lower quality.')
+@click.option('--compile_cache', default=COMPILE_CACHE, help='Directory keeping the compiled models between restarts.')
+@click.option('--voices_dir', default=None, help='Directory of reference recordings, each a voice named after its file (narrator.wav is "narrator"), listed by /v1/voices.')
+@click.option('--voice_cache', default=VOICE_CACHE, help='Directory keeping the speaker embeddings of the voices.')
+@click.option('--request_timeout', default=120, help='Seconds a request waits for its audio before failing.')
+def main(host, port, language, tts_model, tts_speed, max_batch_size, batch_window, max_batch_wait, stream,
+         workers, cores, threads_per_worker, device, torch_compile, quantize, compile_cache, voices_dir, voice_cache,
+         request_timeout):
+    logging.basicConfig(level=logging.INFO)
+
+    if workers <= 0:
+        workers = max(1, cores // threads_per_worker)
+    threads = max(1, cores // workers)
+    logging.info('Starting %i TTS workers with %i threads each', workers, threads)
+
+    # Inherited by the workers, so they are set before torch gets imported there.
+    os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+    os.environ.setdefault('MKL_NUM_THREADS', str(threads))
+    # Inductor keeps its compiled graphs in /tmp by default, which doesn't survive a reboot.
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.expanduser(compile_cache))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+    pool = WorkerPool(workers, {
+        'tts_model': tts_model,
+        'device': None if device == 'auto' else device,
+        'torch_compile': torch_compile,
+        'quantize': quantize,
+        'language': language,
+        'tts_speed': tts_speed,
+        'max_batch_size': max_batch_size,
+        'batch_window': batch_window / 1000,
+        'max_wait': max_batch_wait / 1000,
+        'threads': threads,
+        'voices_dir': voices_dir,
+        'voice_cache': voice_cache,
+    }, request_timeout=request_timeout)
+    # Workers load, test and benchmark the models before the service is exposed.
+    pool.start()
 
-    model = Pipeline(
-        t2s_ref=f"whisperspeech/whisperspeech:t2s-{tts_model}-en+pl.model",
-        s2a_ref=f"whisperspeech/whisperspeech:s2a-q4-{tts_model}-en+pl.model",
-        torch_compile=True
-    )
-
-    app.config['LANGUAGE'] = language
-    app.config['TTS_MODEL'] = model
     app.config['TTS_SPEED'] = tts_speed
+    app.config['STREAM'] = stream
+    app.config['WORKER_POOL'] = pool
 
-    # Test that models work before exposing the service.
-    model.generate("this is a test", speaker=None, lang=language, cps=tts_speed)
-
-    app.run(host=host, port=port)
+    try:
+        app.run(host=host, port=port, threaded=True)
+    finally:
+        pool.stop()
 
 
 if __name__ == '__main__':
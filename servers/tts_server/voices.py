@@ -0,0 +1,91 @@
+"""
+Voice presets for the WhisperSpeech TTS server.
+
+A preset is a reference recording in the voices directory, named after its file: narrator.wav
+is selected with "voice": "narrator". The speaker embeddings of all presets are extracted when a
+worker starts, before it serves requests, and saved to the cache directory so later runs don't
+extract them again. Re-recording a file invalidates its saved embedding; recordings added or
+changed while the server runs are picked up when it restarts.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import torch
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg')
+
+# Voices that mean "no preset", as sent by clients that don't know the server's voices.
+DEFAULT_VOICES = ('', 'default')
+
+
+class VoicePresets:
+    """
+    Speaker embeddings of the reference recordings in a directory.
+
+    Args:
+        pipe: WhisperSpeech pipeline, which extracts the embeddings
+        voices_dir: Directory of reference recordings, or None for no presets
+        cache_dir: Directory the embeddings are saved to
+    """
+
+    def __init__(self, pipe, voices_dir, cache_dir):
+        self.pipe = pipe
+        self.voices_dir = Path(voices_dir) if voices_dir else None
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.embeddings = {}
+        self.unknown = set()
+
+    def references(self):
+        """The reference recording of every preset, by voice."""
+        if self.voices_dir is None:
+            return {}
+        references = {}
+        # A voice recorded in several formats uses the first of AUDIO_EXTENSIONS.
+        for extension in AUDIO_EXTENSIONS:
+            for path in sorted(self.voices_dir.glob(f'*{extension}')):
+                if path.stem not in DEFAULT_VOICES and path.is_file():
+                    references.setdefault(path.stem, path)
+        return references
+
+    def preload(self):
+        """Extract (or load from the cache) the embeddings of all presets. Returns the voices available."""
+        for voice, reference in self.references().items():
+            stat = reference.stat()
+            try:
+                self.embeddings[voice] = self.load(voice, reference, (stat.st_mtime, stat.st_size))
+            except Exception:
+                logging.exception('Failed to extract the speaker embedding of voice "%s", skipping it', voice)
+        return sorted(self.embeddings)
+
+    def speaker(self, voice):
+        """The speaker embedding of a voice, None (the default speaker) if there is no such preset."""
+        if not voice or voice in DEFAULT_VOICES:
+            return None
+        embedding = self.embeddings.get(voice)
+        if embedding is None and voice not in self.unknown:
+            # Requests run in threads, at worst two of them log the same voice.
+            self.unknown.add(voice)
+            logging.warning('No preset for voice "%s", using the default speaker', voice)
+        return embedding
+
+    def load(self, voice, reference, version):
+        cache_file = self.cache_dir / f'{voice}.pt'
+        try:
+            saved = torch.load(cache_file, map_location='cpu')
+            if tuple(saved['version']) == version:
+                return saved['embedding'].to(self.pipe.device)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning('Ignoring unreadable speaker embedding %s: %s', cache_file, e)
+
+        logging.info('Extracting the speaker embedding of voice "%s" from %s', voice, reference)
+        embedding = self.pipe.extract_spk_emb(str(reference))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Several workers may extract the same voice, each replaces the file in one go.
+        partial = cache_file.with_name(f'.{cache_file.name}.{os.getpid()}')
+        torch.save({'version': list(version), 'embedding': embedding.cpu()}, partial)
+        os.replace(partial, cache_file)
+        return embedding
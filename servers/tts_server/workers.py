@@ -0,0 +1,414 @@
+"""
+Pool of pre-started worker processes for the WhisperSpeech TTS server.
+
+Each worker loads the models once, warms them up, and then generates the requests sent to it
+with its own Batcher, using its share of the CPU cores. The Flask process only dispatches: every
+request goes to the worker with the fewest requests in flight, and the finished PCM comes back
+over a shared queue. The pool keeps the statistics reported by /metrics.
+
+A worker that dies fails the requests it had in flight and is started again; requests go to the
+other workers while it loads the models.
+"""
+
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Real-time factors kept for the metrics, per worker.
+RTF_WINDOW = 50
+
+# Seconds before restarting a worker that died while loading, so one that can't start doesn't spin.
+RESTART_DELAY = 5
+
+# Seconds a request waits for its audio before giving up on the worker.
+REQUEST_TIMEOUT = 120
+
+# Timed at startup, to report how much faster than real time the workers generate.
+BENCHMARK_TEXT = 'Once upon a time, in a little house at the edge of the forest, lived a curious fox.'
+
+
+def load_pipeline(config):
+    import torch
+    from whisperspeech.pipeline import Pipeline
+
+    tts_model = config['tts_model']
+    pipe = Pipeline(
+        t2s_ref=f"whisperspeech/whisperspeech:t2s-{tts_model}-en+pl.model",
+        s2a_ref=f"whisperspeech/whisperspeech:s2a-q4-{tts_model}-en+pl.model",
+        optimize=False,
+        device=config['device']
+    )
+    # Half precision only pays off on a GPU, CPUs compute it slower than float32.
+    dtype = torch.float32 if pipe.device == 'cpu' else torch.float16
+    for model in (pipe.t2s, pipe.s2a):
+        # The key/value caches of the decoders must hold a whole batch.
+        model.optimize(max_batch_size=config['max_batch_size'], dtype=dtype, torch_compile=config['torch_compile'])
+    if config['quantize']:
+        if pipe.device != 'cpu':
+            logging.warning('Int8 quantization is only available on the CPU, ignoring it on %s', pipe.device)
+        else:
+            quantize(pipe)
+    return pipe
+
+
+def quantize(pipe):
+    """Quantize the linear layers of the t2s and s2a models to int8, their activations stay float32."""
+    import torch
+
+    for model in (pipe.t2s, pipe.s2a):
+        # In place: the compiled generate_next of the model is bound to it.
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def benchmark(batcher, config):
+    """Warm the models up, then time the generation of BENCHMARK_TEXT. Returns the real-time factor."""
+    from streaming import SAMPLE_RATE
+
+    # Timed the way requests are served: through the batcher, which may generate differently than pipe.generate.
+    # The first generation compiles the models (or loads them from the compile cache).
+    batcher.generate("this is a test", speaker=None, cps=config['tts_speed'])
+    started = time.monotonic()
+    audio = batcher.generate(BENCHMARK_TEXT, speaker=None, cps=config['tts_speed'])
+    elapsed = time.monotonic() - started
+    duration = audio.shape[-1] / SAMPLE_RATE
+    logging.info('Generated %.1fs of audio in %.1fs', duration, elapsed)
+    return elapsed / duration
+
+
+def start_models(config):
+    """
+    Load the models, warm every batch size up and benchmark them. Returns the batcher, the
+    real-time factor and the mode the models run in, as reported by /metrics.
+    """
+    from batching import Batcher
+
+    pipe = load_pipeline(config)
+    batcher = Batcher(
+        pipe,
+        config['language'],
+        max_batch_size=config['max_batch_size'],
+        batch_window=config['batch_window'],
+        max_wait=config['max_wait'],
+    )
+    try:
+        rtf = benchmark(batcher, config)
+        batcher.warmup(config['tts_speed'])
+    except Exception:
+        batcher.stop()
+        raise
+    # Utilization only counts the time spent on requests.
+    batcher.busy_time = 0.0
+    mode = {
+        'device': pipe.device,
+        'torch_compile': config['torch_compile'],
+        'quantized': config['quantize'] and pipe.device == 'cpu',
+    }
+    return batcher, rtf, mode
+
+
+def worker_main(index, config, requests, results):
+    """Entry point of a worker process: load the models, then generate requests until told to stop."""
+    import torch
+    from whisperspeech import inference
+
+    from streaming import SAMPLE_RATE, to_pcm
+    from voices import VoicePresets
+
+    logging.basicConfig(level=logging.INFO, format=f'[worker {index}] %(levelname)s %(message)s')
+    config = dict(config, device=config['device'] or inference.get_compute_device())
+    torch.set_num_threads(config['threads'])
+    if config['device'] == 'cpu':
+        # Autoregressive decoding has little to run side by side, extra inter-op threads
+        # would only compete with the other workers for the cores.
+        torch.set_num_interop_threads(1)
+
+    try:
+        batcher, rtf, mode = start_models(config)
+    except Exception:
+        # Quantizing can fail anywhere from quantize_dynamic to the first run of the compiled models.
+        if not config['quantize']:
+            raise
+        logging.exception('The quantized models failed, loading them again without quantization')
+        batcher, rtf, mode = start_models(dict(config, quantize=False))
+    logging.info('Models running on %s, compiled %s, quantized %s, batching %s',
+                 mode['device'], mode['torch_compile'], mode['quantized'], batcher.batching)
+    # Extracting an embedding takes seconds, requests must not wait for it.
+    presets = VoicePresets(batcher.pipe, config['voices_dir'], config['voice_cache'])
+    voices = presets.preload()
+    results.put(('ready', index, os.getpid(), rtf, mode, voices, batcher.status()))
+
+    def generate(request_id, text, voice, cps):
+        started = time.monotonic()
+        try:
+            speaker = presets.speaker(voice)
+            pcm = to_pcm(batcher.generate(text, speaker=speaker, cps=cps))
+        except Exception as e:
+            results.put(('error', index, request_id, f'{type(e).__name__}: {e}', batcher.status()))
+            return
+        generation_time = time.monotonic() - started
+        audio_duration = len(pcm) / (2 * SAMPLE_RATE)
+        results.put(('done', index, request_id, pcm, generation_time, audio_duration, batcher.status()))
+
+    # Requests wait on their batch in threads, so that concurrent ones can be batched together.
+    with ThreadPoolExecutor(config['max_batch_size']) as executor:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            executor.submit(generate, *request)
+
+
+class NoWorkerError(RuntimeError):
+    """No worker is running, they are all being restarted."""
+
+
+class PendingRequest:
+    """A request sent to a worker, waiting for its PCM (or its error) to come back."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        # The worker may be restarted, the request only belongs to the process it was sent to.
+        self.process = worker.process
+        self.done = threading.Event()
+        self.pcm = None
+        self.error = None
+
+
+class Worker:
+    """A worker process as the pool sees it: its queue of requests, its state and its statistics."""
+
+    def __init__(self, index, process, requests):
+        self.index = index
+        self.process = process
+        self.requests = requests
+        self.pid = None
+        self.started_at = None
+        self.died_at = None
+        self.restarts = 0
+        self.startup_rtf = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.batching = None
+        self.mode = None
+        self.voices = []
+        self.rtfs = collections.deque(maxlen=RTF_WINDOW)
+
+    @property
+    def alive(self):
+        return self.started_at is not None and self.process.is_alive()
+
+    def ready(self, pid, rtf, mode, voices, status):
+        self.pid = pid
+        self.mode = mode
+        self.voices = voices
+        self.started_at = time.monotonic()
+        self.died_at = None
+        self.startup_rtf = rtf
+        self.batching = status['batching']
+        self.busy_time = status['busy_time']
+
+    def restart(self, process, requests):
+        """Replace the dead process, the statistics of the worker carry on."""
+        self.process = process
+        self.requests = requests
+        self.pid = None
+        self.started_at = None
+        self.died_at = None
+        self.in_flight = 0
+        self.restarts += 1
+        process.start()
+
+    def metrics(self):
+        uptime = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            'pid': self.pid,
+            'alive': self.alive,
+            'restarts': self.restarts,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'mode': self.mode,
+            'batching': self.batching,
+            'utilization': round(min(1.0, self.busy_time / uptime), 3) if uptime else None,
+            'rtf': round(sum(self.rtfs) / len(self.rtfs), 3) if self.rtfs else None,
+            'startup_rtf': round(self.startup_rtf, 3) if self.startup_rtf is not None else None,
+        }
+
+
+class WorkerPool:
+    """
+    Worker processes, each with its own copy of the models.
+
+    Args:
+        workers: Number of worker processes
+        config: Settings of the workers: tts_model, device (None for the best available),
+            torch_compile, quantize, language, tts_speed, max_batch_size, batch_window,
+            max_wait, threads (torch threads of each worker), voices_dir and voice_cache
+        request_timeout: Seconds a request waits for its audio at most
+    """
+
+    def __init__(self, workers, config, request_timeout=REQUEST_TIMEOUT):
+        # Forking a process that already loaded torch isn't safe, workers start from scratch.
+        self.context = multiprocessing.get_context('spawn')
+        self.config = config
+        self.request_timeout = request_timeout
+        self.results = self.context.Queue()
+        self.workers = [Worker(index, *self.spawn(index)) for index in range(workers)]
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.stopping = False
+        self.rtfs = collections.deque(maxlen=RTF_WINDOW)
+
+    def spawn(self, index):
+        """A new, not yet started, process for worker index and the queue of its requests."""
+        requests = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main, args=(index, self.config, requests, self.results),
+            name=f'tts-worker-{index}', daemon=True,
+        )
+        return process, requests
+
+    def start(self):
+        """Start the workers and wait until all of them loaded and warmed up their models."""
+        for worker in self.workers:
+            worker.process.start()
+        ready = 0
+        while ready < len(self.workers):
+            try:
+                message = self.results.get(timeout=5)
+            except queue.Empty as e:
+                dead = [worker.index for worker in self.workers if not worker.process.is_alive()]
+                if dead:
+                    raise RuntimeError(f'TTS workers {dead} exited while loading the models') from e
+                continue
+            self.worker_ready(message)
+            ready += 1
+        threading.Thread(target=self.collect_results, name='tts-results', daemon=True).start()
+
+    def generate(self, text, voice=None, cps=15):
+        """Generate the PCM of a text on the least loaded worker, with a voice preset if one is given."""
+        with self.lock:
+            workers = [worker for worker in self.workers if worker.alive]
+            if not workers:
+                raise NoWorkerError('No TTS worker is running, they are being restarted')
+            worker = min(workers, key=lambda w: w.in_flight)
+            worker.in_flight += 1
+            request_id = next(self.ids)
+            request = self.pending[request_id] = PendingRequest(worker)
+        worker.requests.put((request_id, text, voice, cps))
+        if not request.done.wait(self.request_timeout):
+            with self.lock:
+                timed_out = self.pending.pop(request_id, None) is not None
+                if timed_out:
+                    worker.in_flight -= 1
+                    worker.failed += 1
+            if timed_out:
+                raise TimeoutError(f'TTS worker {worker.index} gave no audio in {self.request_timeout}s')
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.pcm
+
+    def worker_ready(self, message):
+        _, index, pid, rtf, mode, voices, status = message
+        worker = self.workers[index]
+        with self.lock:
+            worker.ready(pid, rtf, mode, voices, status)
+        logging.info('TTS worker %i ready (pid %i), real-time factor %.2f', index, pid, rtf)
+        if rtf > 1:
+            logging.warning('TTS worker %i generates slower than real time, listeners will hear gaps', index)
+
+    def collect_results(self):
+        while True:
+            # Checked on every message too: a busy pool may never leave the queue idle.
+            self.check_workers()
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                continue
+            kind, _, request_id = message[:3]
+            if kind == 'ready':
+                self.worker_ready(message)
+                continue
+            with self.lock:
+                request = self.pending.pop(request_id, None)
+                if request is None:
+                    # Timed out, or its worker died and was already failed.
+                    continue
+                worker = request.worker
+                worker.in_flight -= 1
+                worker.busy_time = message[-1]['busy_time']
+                worker.batching = message[-1]['batching']
+                if kind == 'done':
+                    _, _, _, pcm, generation_time, audio_duration, _ = message
+                    worker.completed += 1
+                    if audio_duration:
+                        worker.rtfs.append(generation_time / audio_duration)
+                        self.rtfs.append(generation_time / audio_duration)
+                else:
+                    pcm = None
+                    worker.failed += 1
+            request.pcm = pcm
+            if kind == 'error':
+                request.error = message[3]
+            request.done.set()
+
+    def check_workers(self):
+        """Fail the requests of dead workers and start those workers again."""
+        now = time.monotonic()
+        with self.lock:
+            dead = [
+                (request_id, request) for request_id, request in self.pending.items()
+                if not request.process.is_alive()
+            ]
+            for request_id, request in dead:
+                del self.pending[request_id]
+                request.worker.failed += 1
+            for worker in self.workers:
+                if self.stopping or worker.process.is_alive():
+                    continue
+                if worker.died_at is None:
+                    worker.died_at = now
+                    logging.error('TTS worker %i exited with code %s, restarting it', worker.index, worker.process.exitcode)
+                # One that served requests is restarted at once, it got through loading before.
+                if worker.started_at is not None or now - worker.died_at >= RESTART_DELAY:
+                    worker.restart(*self.spawn(worker.index))
+        for _, request in dead:
+            request.error = f'TTS worker {request.worker.index} died'
+            request.done.set()
+
+    def voices(self):
+        """The voice presets the running workers serve."""
+        with self.lock:
+            return sorted({voice for worker in self.workers if worker.alive for voice in worker.voices})
+
+    def health(self):
+        """Workers that serve requests, out of all of them."""
+        with self.lock:
+            alive = sum(worker.alive for worker in self.workers)
+        status = 'up' if alive == len(self.workers) else 'degraded' if alive else 'down'
+        return {'status': status, 'alive': alive, 'workers': len(self.workers)}
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'queue_depth': len(self.pending),
+                'rtf': round(sum(self.rtfs) / len(self.rtfs), 3) if self.rtfs else None,
+                'workers': [worker.metrics() for worker in self.workers],
+            }
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=5)
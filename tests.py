@@ -342,32 +342,475 @@ def test_startup_time():
         return False
 
 
+def test_tts_streaming():
+    """Test streaming TTS against a local stand-in for the provider's streaming endpoint"""
+    print("\n📡 Testing streaming TTS...")
+    
+    import tempfile
+    from aiohttp import web
+    from fably.tts_service import ElevenLabsTTSProvider, TTSService
+    
+    chunk_count = 5
+    chunk_delay = 0.2
+    audio = bytes(range(256)) * 64
+    chunk_size = len(audio) // chunk_count
+    
+    async def stream_audio(request):
+        # Sends the audio in chunks with pauses, like a provider that is still generating it.
+        response = web.StreamResponse(headers={"Content-Type": "audio/mpeg"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for offset in range(0, len(audio), chunk_size):
+            await response.write(audio[offset:offset + chunk_size])
+            await asyncio.sleep(chunk_delay)
+        await response.write_eof()
+        return response
+    
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/text-to-speech/{voice}/stream", stream_audio)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        
+        service = TTSService()
+        service.add_provider("elevenlabs", ElevenLabsTTSProvider("test-key", f"http://127.0.0.1:{port}"))
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                output_file = Path(tmp) / "paragraph_0.mp3"
+                start = time.time()
+                first_chunk_time = None
+                received = []
+                async for chunk in service.synthesize_stream("Merhaba", "voice", "elevenlabs", output_file):
+                    if first_chunk_time is None:
+                        first_chunk_time = time.time() - start
+                        # The file only shows up once the audio is complete.
+                        assert not output_file.exists()
+                    received.append(chunk)
+                total_time = time.time() - start
+                assert b"".join(received) == audio, "streamed audio differs from what was sent"
+                assert output_file.read_bytes() == audio, "saved audio differs from what was sent"
+                assert list(Path(tmp).iterdir()) == [output_file], "temporary files were left behind"
+                return len(received), first_chunk_time, total_time
+        finally:
+            await service.close()
+            await runner.cleanup()
+    
+    try:
+        chunks, first_chunk_time, total_time = asyncio.run(run())
+    except AssertionError as e:
+        print(f"❌ Streaming test failed: {e}")
+        return False
+    
+    print(f"✅ {chunks} chunks, first after {first_chunk_time:.2f}s, complete after {total_time:.2f}s")
+    if first_chunk_time < total_time / 2:
+        print("✅ Audio available before the download finished")
+        return True
+    print("❌ Audio only available once the download finished")
+    return False
+
+
+def test_tts_scheduler():
+    """Test the retry, backoff and rate limiting of the TTS request scheduler"""
+    print("\n⏱️  Testing the TTS scheduler...")
+    
+    from fably.tts_scheduler import TokenBucket, TTSProviderError, TTSScheduler
+    
+    def failing(errors, result="ok"):
+        # A provider call that raises the given errors one by one, then returns the result.
+        calls = []
+        
+        async def call():
+            calls.append(time.monotonic())
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return result
+        return call, calls
+    
+    async def run():
+        scheduler = TTSScheduler()
+        scheduler.configure(max_concurrency=2, max_retries=3, base_delay=0.01, max_delay=0.5)
+        
+        # Server errors are retried.
+        call, calls = failing([TTSProviderError("test", 503), TTSProviderError("test", 502)])
+        assert await scheduler.run("retry", call) == "ok", "the retried request did not succeed"
+        assert len(calls) == 3, f"expected 3 attempts, got {len(calls)}"
+        
+        # Client errors are not.
+        call, calls = failing([TTSProviderError("test", 401)])
+        try:
+            await scheduler.run("client", call)
+            raise AssertionError("a 401 was retried into a success")
+        except TTSProviderError:
+            pass
+        assert len(calls) == 1, "a 401 was retried"
+        
+        # Retry-After is honoured within the backoff cap...
+        call, calls = failing([TTSProviderError("test", 429, retry_after=0.2)])
+        await scheduler.run("throttled", call)
+        assert calls[1] - calls[0] >= 0.2, "Retry-After was not honoured"
+        
+        # ...and beyond it the request fails right away, so another provider can take over.
+        call, calls = failing([TTSProviderError("test", 429, retry_after=3600)])
+        started = time.monotonic()
+        try:
+            await scheduler.run("overloaded", call)
+            raise AssertionError("a request asked to wait an hour succeeded")
+        except TTSProviderError:
+            pass
+        assert time.monotonic() - started < 0.5, "the scheduler waited for a Retry-After above the cap"
+        
+        # The concurrency cap holds.
+        in_flight = []
+        peak = []
+        
+        async def slow():
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.05)
+            in_flight.pop()
+        await asyncio.gather(*(scheduler.run("capped", slow) for _ in range(6)))
+        assert max(peak) == 2, f"{max(peak)} requests ran at once with a cap of 2"
+        
+        # A request cancelled while waiting for the rate limit gives its token back.
+        bucket = TokenBucket(rate=10, capacity=1)
+        await bucket.acquire()
+        waiting = asyncio.ensure_future(bucket.acquire())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+        delay = await bucket.acquire()
+        assert delay < 0.15, f"the cancelled request's token was not refunded (waited {delay:.2f}s)"
+        
+        return scheduler.stats()
+    
+    try:
+        stats = asyncio.run(run())
+    except AssertionError as e:
+        print(f"❌ Scheduler test failed: {e}")
+        return False
+    
+    print(f"✅ Retries, backoff cap, concurrency cap and rate limit refunds behave ({stats['retry']['retries']} retries)")
+    return True
+
+
+def test_text_segmenter():
+    """Test the sentence and paragraph boundaries and the length limit of the text segmenter"""
+    print("\n✂️  Testing the text segmenter...")
+    
+    from fably.text_segmenter import PARAGRAPH, SEGMENT, TextSegmenter, split_text
+    
+    def events(segmenter, fragments):
+        found = []
+        for fragment in fragments:
+            found.extend(segmenter.feed_events(fragment))
+        return found + segmenter.flush_events()
+    
+    try:
+        # Sentences are cut as soon as the whitespace after them arrives, even mid-fragment.
+        segmenter = TextSegmenter("sentence")
+        assert segmenter.feed("Bir varmış. Bir yok") == ["Bir varmış."], "the first sentence was not cut"
+        assert segmenter.feed("muş! Evvel") == ["Bir yokmuş!"], "a sentence split across fragments was not joined"
+        assert segmenter.flush() == "Evvel", "the rest of the stream was lost"
+        
+        # A paragraph break whose newlines come in separate fragments still ends the paragraph.
+        found = events(TextSegmenter("sentence"), ["Once upon a time.\n", "\nThe end."])
+        expected = [
+            (SEGMENT, "Once upon a time."),
+            (PARAGRAPH, "Once upon a time."),
+            (SEGMENT, "The end."),
+            (PARAGRAPH, "The end."),
+        ]
+        assert found == expected, f"unexpected events across a split paragraph break: {found}"
+        
+        # Short sentences are merged up to min_chars, but never across a paragraph.
+        found = events(TextSegmenter("sentence", min_chars=10), ["Hi. Ho. Hey there.\n\nBye."])
+        segments = [text for kind, text in found if kind == SEGMENT]
+        assert segments == ["Hi. Ho. Hey there.", "Bye."], f"unexpected merged segments: {segments}"
+        
+        # Without a boundary in time, segments are cut at the last space under max_chars.
+        text = "one two three four five six seven eight nine ten"
+        segmenter = TextSegmenter("sentence", max_chars=15)
+        segments = segmenter.feed(text)
+        rest = segmenter.flush()
+        if rest:
+            segments.append(rest)
+        assert all(len(segment) <= 15 for segment in segments), f"a segment is over max_chars: {segments}"
+        assert " ".join(segments) == text, f"words were lost or split: {segments}"
+        
+        # split_text prefers sentence, then clause boundaries, and packs pieces up to the limit.
+        pieces = split_text("First one. Second, longer sentence here. Third.", 25)
+        assert pieces == ["First one. Second,", "longer sentence here.", "Third."], f"unexpected pieces: {pieces}"
+        assert split_text("Short.", 25) == ["Short."], "a short text was split"
+    except AssertionError as e:
+        print(f"❌ Segmenter test failed: {e}")
+        return False
+    
+    print("✅ Sentence, paragraph and max_chars boundaries behave")
+    return True
+
+
+def test_pipeline_queues():
+    """Test the item and byte limits of the pipeline queues"""
+    print("\n📦 Testing the pipeline queues...")
+    
+    from fably.queues import PipelineQueue, item_size
+    
+    async def blocked(queue, item):
+        # Whether putting the item has to wait for room.
+        put = asyncio.ensure_future(queue.put(item))
+        await asyncio.sleep(0.01)
+        if put.done():
+            return False
+        put.cancel()
+        try:
+            await put
+        except asyncio.CancelledError:
+            pass
+        return True
+    
+    async def run():
+        assert item_size(("story", 0, None, "çok")) == len("story") + len("çok".encode("utf-8")), \
+            "text is not counted in UTF-8 bytes"
+        
+        # The item limit.
+        queue = PipelineQueue("items", max_items=2)
+        await queue.put("a")
+        await queue.put("b")
+        assert await blocked(queue, "c"), "a third item fit in a queue of two"
+        assert await queue.get() == "a", "items came out of order"
+        assert not await blocked(queue, "c"), "there was no room after a get"
+        
+        # The byte limit, which an oversized item only ignores when the queue is empty.
+        queue = PipelineQueue("bytes", max_bytes=10)
+        await queue.put("x" * 6)
+        assert await blocked(queue, "y" * 6), "the byte limit was exceeded"
+        assert not await blocked(queue, "z" * 4), "an item that fits was refused"
+        assert queue.nbytes == 10, f"the queue counts {queue.nbytes} bytes instead of 10"
+        await queue.get()
+        await queue.get()
+        assert not await blocked(queue, "w" * 50), "an oversized item stalled an empty queue"
+        
+        # close() never blocks, and the end of the stream comes out last.
+        await queue.close()
+        assert await queue.get() == "w" * 50 and await queue.get() is None, "the end of the stream was misplaced"
+        
+        stats = queue.stats()
+        assert stats["max_bytes"] == 50 and stats["bytes"] == 0, f"unexpected queue stats: {stats}"
+    
+    try:
+        asyncio.run(run())
+    except AssertionError as e:
+        print(f"❌ Queue test failed: {e}")
+        return False
+    
+    print("✅ Item and byte limits hold, oversized items and close() don't stall")
+    return True
+
+
+def test_story_manifest():
+    """Test the story manifest round trip and the detection of stale audio"""
+    print("\n📒 Testing the story manifest...")
+    
+    import tempfile
+    from fably.manifest import StoryManifest, text_hash
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            story_path = Path(tmp)
+            manifest = StoryManifest(story_path)
+            manifest.set_text(0, "Bir varmış.")
+            manifest.set_audio(0, story_path / "paragraph_0.mp3", "mp3", size=1234)
+            # A paragraph synthesized in segments, whose audio arrived before its text.
+            manifest.set_audio(1, story_path / "paragraph_1_0.mp3", "mp3", segment=0, text_sha1=text_hash("Bir yokmuş."))
+            manifest.set_audio(1, story_path / "paragraph_1_1.mp3", "mp3", segment=1, text_sha1=text_hash("Evvel zaman."))
+            manifest.set_text(1, "Bir yokmuş. Evvel zaman.", segments=["Bir yokmuş.", "Evvel zaman."])
+            manifest.complete = True
+            manifest.save()
+            
+            loaded = StoryManifest.load(story_path)
+            assert loaded is not None, "the saved manifest could not be read"
+            assert loaded.dumps() == manifest.dumps(), "the manifest changed in a round trip"
+            assert loaded.complete, "the complete flag was lost"
+            assert loaded.audio_file(0, "mp3") == story_path / "paragraph_0.mp3", "the audio of paragraph 0 was lost"
+            assert loaded.audio_file(0, "wav") is None, "audio was returned for the wrong format"
+            assert loaded.segment_span(1, 1) == (12, 24), f"unexpected segment span {loaded.segment_span(1, 1)}"
+            assert loaded.playback_items("mp3") == [(0, None), (1, 0), (1, 1)], \
+                f"unexpected playback items {loaded.playback_items('mp3')}"
+            
+            # Editing the text makes the old audio stale, keeping the segments that didn't change.
+            loaded.set_text(0, "Bir varmış, bir yokmuş.")
+            assert loaded.audio_file(0, "mp3") is None, "stale audio was returned for edited text"
+            loaded.set_text(1, "Bir yokmuş. Evvel zaman içinde.", segments=["Bir yokmuş.", "Evvel zaman içinde."])
+            assert loaded.audio_file(1, "mp3", segment=0) is None, "a re-set paragraph kept audio it had no record of"
+            
+            # An unreadable or outdated manifest is ignored rather than trusted.
+            (story_path / "manifest.json").write_text("{", encoding="utf-8")
+            assert StoryManifest.load(story_path) is None, "a corrupt manifest was loaded"
+            (story_path / "manifest.json").write_text('{"version": 0}', encoding="utf-8")
+            assert StoryManifest.load(story_path) is None, "a manifest of another version was loaded"
+    except AssertionError as e:
+        print(f"❌ Manifest test failed: {e}")
+        return False
+    
+    print("✅ Manifest round trip and stale audio detection behave")
+    return True
+
+
+def test_tts_cache():
+    """Test the keys and the LRU eviction of the TTS cache"""
+    print("\n🗄️  Testing the TTS cache...")
+    
+    import tempfile
+    from fably.tts_cache import TTSCache
+    
+    key = TTSCache.key
+    try:
+        # Keys depend on everything that changes the audio, and on nothing else.
+        base = key("openai", "nova", "Bir varmış.", model="tts-1", format="mp3")
+        assert key("openai", "nova", "  Bir   varmış. ", model="tts-1", format="mp3") == base, \
+            "whitespace changed the key"
+        assert key("openai", "nova", "Bir varmış.", model="tts-1", format="mp3", sample_rate=None) == base, \
+            "an unset sample rate changed the key"
+        variants = [
+            key("elevenlabs", "nova", "Bir varmış.", model="tts-1", format="mp3"),
+            key("openai", "alloy", "Bir varmış.", model="tts-1", format="mp3"),
+            key("openai", "nova", "Bir yokmuş.", model="tts-1", format="mp3"),
+            key("openai", "nova", "Bir varmış.", model="tts-1-hd", format="mp3"),
+            key("openai", "nova", "Bir varmış.", model="tts-1", format="wav"),
+            key("openai", "nova", "Bir varmış.", model="tts-1", format="mp3", sample_rate=24000),
+            key("openai", "nova", "Bir varmış.", model="tts-1", format="mp3", voice_settings={"speed": 1.2}),
+        ]
+        assert base not in variants and len(set(variants)) == len(variants), "different audio shares a key"
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = TTSCache(Path(tmp), max_bytes=25)
+            cache.put("a" * 64, b"A" * 10)
+            cache.put("b" * 64, b"B" * 10)
+            assert cache.get("a" * 64) == b"A" * 10, "a cached entry was not returned"
+            # "b" is now the least recently used entry, and goes first.
+            cache.put("c" * 64, b"C" * 10)
+            assert cache.get("b" * 64) is None, "the least recently used entry was kept"
+            assert cache.get("a" * 64) is not None and cache.get("c" * 64) is not None, "a recent entry was evicted"
+            cache.put("d" * 64, b"D" * 100)
+            assert cache.get("d" * 64) is None, "an entry over the whole budget was stored"
+            
+            # The LRU order survives a restart.
+            reopened = TTSCache(Path(tmp), max_bytes=25)
+            reopened.put("e" * 64, b"E" * 10)
+            assert reopened.get("a" * 64) is None and reopened.get("c" * 64) is not None, \
+                "the LRU order was lost in a restart"
+            stats = cache.stats()
+            assert stats["evictions"] == 1 and stats["bytes"] <= 25, f"unexpected cache stats: {stats}"
+    except AssertionError as e:
+        print(f"❌ Cache test failed: {e}")
+        return False
+    
+    print("✅ Cache keys and LRU eviction behave")
+    return True
+
+
+def test_audio_stitching():
+    """Test joining the audio of text chunks into a single file"""
+    print("\n🧵 Testing audio stitching...")
+    
+    import io
+    import wave
+    from fably.audio_stitching import mp3_frames, sniff_format, stitch_audio
+    
+    def wav(frames, rate=24000):
+        output = io.BytesIO()
+        with wave.open(output, "wb") as writer:
+            writer.setnchannels(1)
+            writer.setsampwidth(2)
+            writer.setframerate(rate)
+            writer.writeframes(frames)
+        return output.getvalue()
+    
+    def mp3_frame(marker=b""):
+        # An MPEG-1 Layer III frame at 128 kbps and 44.1 kHz: 417 bytes.
+        return (b"\xff\xfb\x90\x00" + marker).ljust(417, b"\x00")
+    
+    def id3(payload):
+        return b"ID3\x03\x00\x00\x00\x00\x00" + bytes([len(payload)]) + payload
+    
+    try:
+        # WAV chunks are joined under one header, their samples untouched.
+        first, second = b"\x01\x00" * 100, b"\x02\x00" * 50
+        stitched = stitch_audio([wav(first), wav(second)], "wav")
+        with wave.open(io.BytesIO(stitched), "rb") as reader:
+            assert reader.getframerate() == 24000, "the sample rate changed"
+            assert reader.readframes(reader.getnframes()) == first + second, "samples were lost or changed"
+        try:
+            stitch_audio([wav(first), wav(second, rate=16000)], "wav")
+            raise AssertionError("chunks with different sample rates were stitched")
+        except ValueError:
+            pass
+        
+        # MP3 chunks keep only the first ID3 tag and lose their Xing/Info frames.
+        frame = mp3_frame()
+        chunk = id3(b"tag") + mp3_frame(b"\x00" * 32 + b"Info") + frame + frame
+        assert sniff_format(chunk) == "mp3" and sniff_format(frame) == "mp3", "MP3 was not recognised"
+        assert mp3_frames(chunk) == frame + frame, "the tag or the Info frame was kept"
+        stitched = stitch_audio([chunk, chunk + b"TAG".ljust(128, b"\x00")])
+        assert stitched == id3(b"tag") + frame * 4, "unexpected stitched MP3"
+        
+        # Raw PCM is simply concatenated, and a single chunk is returned as is.
+        assert stitch_audio([b"\x01\x02", b"\x03\x04"], "pcm") == b"\x01\x02\x03\x04", "PCM was not concatenated"
+        assert stitch_audio([chunk], "mp3") is chunk, "a single chunk was re-encoded"
+    except AssertionError as e:
+        print(f"❌ Stitching test failed: {e}")
+        return False
+    
+    print("✅ WAV, MP3 and PCM chunks stitch cleanly")
+    return True
+
+
 # ================================================================================
 # MAIN TEST FUNCTIONS
 # ================================================================================
 
 def run_asyncio_test(multithreaded, paragraphs):
-    """Run the asyncio pipeline test"""
+    """Run the asyncio pipeline test (offline, see `fably --bench pipeline`)"""
+    from fably import bench
+    from fably.runtime import runtime
+
     print(f"\n🔄 Running asyncio pipeline test...")
-    print(f"Mode: {'Multi-threaded' if multithreaded else 'Single-threaded'}")
+    print(f"Mode: {'Concurrent TTS' if multithreaded else 'Sequential TTS'}")
     print(f"Paragraphs: {paragraphs}")
     
-    start_time = time.time()
-    asyncio.run(async_main(multithreaded, paragraphs))
-    elapsed = time.time() - start_time
-    
-    # Calculate expected optimal time
-    expected = WRITER_TIME + READER_TIME + paragraphs * SPEAKER_TIME
-    delta = elapsed - expected
+    options = {
+        "paragraphs": paragraphs,
+        "sentences": 3,
+        "words": 12,
+        "tokens_per_second": 30.0,
+        "first_token_latency": 0.5,
+        "tts_latency": 0.4,
+        "tts_seconds_per_char": 0.002,
+        "tts_bytes_per_char": 1000,
+        "sink_bytes_per_second": 160000,
+        # Multi-threaded mode is the default pipeline, synthesizing paragraphs ahead of playback.
+        "tts_lookahead": 3 if multithreaded else 1,
+        "segment_granularity": "sentence",
+    }
+    try:
+        result = runtime.run(bench.run_once(options))
+    finally:
+        runtime.shutdown()
     
     print(f"\n📊 Asyncio Test Results:")
-    print(f"Actual time: {elapsed:.2f} seconds")
-    print(f"Expected optimal: {expected:.2f} seconds")
-    print(f"Difference: {delta:.2f} seconds ({'faster' if delta < 0 else 'slower'} than optimal)")
+    print(f"Time to first audio: {result['time_to_first_audio']:.2f} seconds")
+    print(f"Longest gap between paragraphs: {result['max_gap']:.2f} seconds")
+    print(f"Total time: {result['total']:.2f} seconds")
     
-    if delta < 2.0:
+    if result['max_gap'] < 0.1:
         print("✅ Excellent asyncio performance")
-    elif delta < 5.0:
+    elif result['max_gap'] < 0.5:
         print("⚠️  Acceptable asyncio performance")
     else:
         print("❌ Poor asyncio performance")
@@ -390,7 +833,14 @@ def run_all_tests():
         ("Web Interface", test_web_interface),
         ("Raspberry Pi Features", test_raspberry_pi_features),
         ("Memory Usage", test_memory_usage),
-        ("Startup Performance", test_startup_time)
+        ("Startup Performance", test_startup_time),
+        ("TTS Streaming", test_tts_streaming),
+        ("TTS Scheduler", test_tts_scheduler),
+        ("Text Segmenter", test_text_segmenter),
+        ("Pipeline Queues", test_pipeline_queues),
+        ("Story Manifest", test_story_manifest),
+        ("TTS Cache", test_tts_cache),
+        ("Audio Stitching", test_audio_stitching)
     ]
     
     passed = 0
@@ -429,7 +879,8 @@ def run_all_tests():
 @click.command()
 @click.option(
     "--test-type",
-    type=click.Choice(['all', 'asyncio', 'quick', 'imports', 'audio', 'web']),
+    type=click.Choice(['all', 'asyncio', 'quick', 'imports', 'audio', 'web', 'streaming', 'scheduler',
+                      'segmenter', 'queues', 'manifest', 'cache', 'stitching']),
     default='quick',
     help="Type of test to run"
 )
@@ -482,6 +933,27 @@ def main(test_type, multithreaded, paragraphs):
         
     elif test_type == 'web':
         test_web_interface()
+        
+    elif test_type == 'streaming':
+        test_tts_streaming()
+        
+    elif test_type == 'scheduler':
+        test_tts_scheduler()
+        
+    elif test_type == 'segmenter':
+        test_text_segmenter()
+        
+    elif test_type == 'queues':
+        test_pipeline_queues()
+        
+    elif test_type == 'manifest':
+        test_story_manifest()
+        
+    elif test_type == 'cache':
+        test_tts_cache()
+        
+    elif test_type == 'stitching':
+        test_audio_stitching()
 
 
 if __name__ == "__main__":
@@ -59,6 +59,7 @@ class FablyWebContext:
             "elevenlabs_api_key": os.getenv("ELEVENLABS_API_KEY", ""),
             "elevenlabs_url": "https://api.elevenlabs.io/v1",
             "elevenlabs_model": "eleven_multilingual_v2",
+            "tts_format": "mp3",
             "gemini_api_key": os.getenv("GEMINI_API_KEY", ""),
             "gemini_url": "https://generativelanguage.googleapis.com/v1beta",
             "llm_temperature": 1.0,
@@ -158,13 +159,18 @@ def load_story_info(story_path: str) -> Tuple[Dict, List[str]]:
 
 async def get_available_voices() -> List[Tuple[str, str]]:
     """
-    Gets a list of available TTS voices from different providers.
+    Gets a list of available TTS voices from different providers, served from the voice catalog shared with the device.
     """
     voices = []
     if ctx.config.get("elevenlabs_api_key"):
-        elevenlabs_voices = ["rachel", "adam", "arnold", "josh", "sam"]
-        for voice in elevenlabs_voices:
-            voices.append((f"ElevenLabs: {voice.title()}", f"elevenlabs:{voice}"))
+        all_voices = await get_tts_service().get_all_voices()
+        for provider, provider_voices in all_voices.items():
+            for voice in provider_voices:
+                voices.append((f"{provider.title()}: {voice['name']}", f"{provider}:{voice['id']}"))
+        if not voices:
+            elevenlabs_voices = ["rachel", "adam", "arnold", "josh", "sam"]
+            for voice in elevenlabs_voices:
+                voices.append((f"ElevenLabs: {voice.title()}", f"elevenlabs:{voice}"))
     return voices
 
 
@@ -245,33 +251,106 @@ def batch_save_paragraphs(story_path: str, paragraph_texts: List[str]) -> str:
     """
     if not story_path:
         return "❌ Hikaye seçilmedi"
+    from fably.manifest import StoryManifest, text_hash
+
     try:
         story_dir = Path(story_path)
+        manifest = StoryManifest.load_or_build(story_dir)
         saved_count = 0
         for i, text in enumerate(paragraph_texts):
             if text and text.strip():
+                text = text.strip()
                 with open(story_dir / f'paragraph_{i}.txt', 'w', encoding='utf-8') as f:
-                    f.write(text.strip())
+                    f.write(text)
                 saved_count += 1
+                entry = manifest.get(i)
+                if entry is None or entry["text_sha1"] != text_hash(text):
+                    # The audio was made from the old text: the device must synthesize it again.
+                    manifest.set_text(i, text)
+                    for audio_file in [*story_dir.glob(f'paragraph_{i}.*'), *story_dir.glob(f'paragraph_{i}_*.*')]:
+                        if audio_file.suffix != '.txt':
+                            audio_file.unlink()
+        manifest.save()
         return f"✅ {saved_count} paragraf kaydedildi"
     except Exception as e:
         return f"❌ Kaydetme hatası: {str(e)}"
 
 
+def run_on_runtime(coro):
+    """
+    Runs a coroutine on Fably's long-lived event loop and waits for its result, so the TTS
+    connections and the voice catalog refresh outlive the request.
+    """
+    from fably.runtime import runtime
+
+    return runtime.run(coro)
+
+
+def get_tts_service():
+    """
+    Returns Fably's TTS service, registering the ElevenLabs provider from the settings on first use.
+    """
+    from fably import utils
+    from fably.runtime import runtime
+    from fably.tts_service import ElevenLabsTTSProvider, tts_service
+    from fably.voice_catalog import CATALOG_FILE
+
+    if "elevenlabs" not in tts_service.providers and ctx.config.get("elevenlabs_api_key"):
+        # Its connections stay open on the runtime loop between requests.
+        runtime.add_shutdown_hook(tts_service.close)
+        # The provider adds the API version to its paths itself.
+        base_url = ctx.config.get("elevenlabs_url", "https://api.elevenlabs.io").rstrip("/")
+        if base_url.endswith("/v1"):
+            base_url = base_url[:-3]
+        tts_service.add_provider("elevenlabs", ElevenLabsTTSProvider(ctx.config["elevenlabs_api_key"], base_url))
+    if tts_service.voice_catalog is None:
+        tts_service.enable_voice_catalog(utils.resolve(CATALOG_FILE), 24 * 3600)
+    return tts_service
+
+
 async def batch_regenerate_audio(story_path: str, voice: str, paragraph_texts: List[str]) -> str:
     """
     Regenerates audio for all paragraphs using the selected voice.
+    Paragraphs are synthesized concurrently, a failed paragraph doesn't stop the others.
     """
     if not story_path or not voice:
         return "❌ Hikaye ve ses seçilmeli"
+    from fably.manifest import StoryManifest
+
+    service = get_tts_service()
     try:
+        provider, voice_id = voice.split(":", 1)
+        story_dir = Path(story_path)
+        paragraphs = [(i, text.strip()) for i, text in enumerate(paragraph_texts) if text and text.strip()]
+        manifest = StoryManifest.load_or_build(story_dir)
+        # The device looks for the audio in the format it saved the story in, whatever the web settings say.
+        saved_formats = [entry["audio"]["format"] for entry in manifest.paragraphs if entry and entry.get("audio")]
+        if saved_formats:
+            audio_format = saved_formats[0]
+        else:
+            audio_format = ctx.config.get("tts_format", "mp3")
+            if audio_format == "auto":
+                audio_format = "mp3"
+        items = [(text, voice_id, story_dir / f"paragraph_{i}.{audio_format}") for i, text in paragraphs]
+
         regenerated_count = 0
-        for i, text in enumerate(paragraph_texts):
-            if text and text.strip():
-                audio_result = await synthesize_with_provider(text, voice)
-                if audio_result:
-                    regenerated_count += 1
-        return f"✅ {regenerated_count} paragraf sesi yeniden oluşturuldu"
+        failed = []
+        async for result in service.synthesize_many(
+            items, provider=provider, concurrency=4, format=audio_format, model=ctx.config.get("elevenlabs_model")
+        ):
+            index = paragraphs[result.index][0]
+            if not result.ok:
+                failed.append(str(index + 1))
+                continue
+            regenerated_count += 1
+            manifest.set_text(index, result.text)
+            manifest.set_audio(index, result.output_file, audio_format, size=result.output_file.stat().st_size)
+        manifest.save()
+
+        message = f"✅ {regenerated_count} paragraf sesi yeniden oluşturuldu"
+        if failed:
+            message += f" (başarısız: {', '.join(failed)})"
+        return message
     except Exception as e:
         return f"❌ Ses oluşturma hatası: {str(e)}"
 
@@ -280,7 +359,7 @@ def refresh_voices() -> gr.Dropdown:
     """
     Refreshes the voice selection dropdown with currently available voices.
     """
-    voice_options = asyncio.run(get_available_voices())
+    voice_options = run_on_runtime(get_available_voices())
     current_voice = f"{ctx.config['tts_provider']}:{ctx.config['tts_voice']}"
     is_current_voice_available = any(v[1] == current_voice for v in voice_options)
     
@@ -679,7 +758,7 @@ def create_fably_interface():
 
         def handle_audio_regeneration(story_path, voice, *paragraph_texts):
             try:
-                result = asyncio.run(batch_regenerate_audio(story_path, voice, list(paragraph_texts)))
+                result = run_on_runtime(batch_regenerate_audio(story_path, voice, list(paragraph_texts)))
                 return f"✅ Sesler yeniden oluşturuldu: {result}"
             except Exception as e:
                 return f"❌ Sesler oluşturulamadı: {str(e)}"
@@ -728,7 +807,7 @@ def create_fably_interface():
             return gr.update(choices=valid_voices, value=valid_voices[0][1], visible=True), f"✅ {len(valid_voices)} ElevenLabs sesi yüklendi."
 
         def initialize_voice_dropdowns():
-            voice_options = asyncio.run(get_available_voices())
+            voice_options = run_on_runtime(get_available_voices())
             current_voice_spec = f"{ctx.config['tts_provider']}:{ctx.config['tts_voice']}"
             default_value = None
             for _, value in voice_options:
@@ -950,8 +1029,13 @@ def create_fably_interface():
 
 def main():
     """Entry point for launching the Fably web interface from other modules."""
+    from fably.runtime import runtime
+
     fably_app = create_fably_interface()
-    fably_app.launch(server_name="0.0.0.0", server_port=7860)
+    try:
+        fably_app.launch(server_name="0.0.0.0", server_port=7860)
+    finally:
+        runtime.shutdown()
 
 
 # --- Main execution block ---
@@ -960,4 +1044,9 @@ if __name__ == "__main__":
     fably_app = create_fably_interface()
     
     # Launch the web server
-    fably_app.launch(server_name="0.0.0.0", server_port=7860)
\ No newline at end of file
+    from fably.runtime import runtime
+
+    try:
+        fably_app.launch(server_name="0.0.0.0", server_port=7860)
+    finally:
+        runtime.shutdown()
\ No newline at end of file